@@ -1,5 +1,6 @@
 import socket
 import select
+import time
 import zlib
 import unittest
 from io import StringIO
@@ -7,6 +8,26 @@ from unittest import mock
 import sys
 import os
 
+# the deadline heap and the connection limit are shared with the other
+# servers, they live in common/ at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.connections import MAX_CONNECTIONS, Deadlines, run_select_loop, turn_away
+
+# seconds from the first byte of a compressed command to the end of its
+# zlib stream
+COMMAND_TIMEOUT = 30
+# seconds a control connection may sit between commands
+IDLE_TIMEOUT = 300
+# bytes a command may take, compressed or not, before the client is told
+# so and closed
+MAX_REQUEST_SIZE = 4096
+TIMED_OUT = zlib.compress(b'421 Timeout, closing control connection\r\n')
+TOO_MANY = zlib.compress(b'421 Too many connections, try again later\r\n')
+TOO_LONG = zlib.compress(b'500 Command too long, closing control connection\r\n')
+NOT_ZLIB = zlib.compress(b'501 Command is not zlib data, closing control connection\r\n')
+NOT_UTF8 = zlib.compress(b'501 Command is not UTF-8\r\n')
+
+
 class FTPServer:
     def __init__(self, host='127.0.0.1', port=2000):
         """Create a new FTP server listening on the specified host and port."""
@@ -20,25 +41,79 @@ class FTPServer:
         
         self.inputs = [self.sock]
         self.client_data = {}
+        self.deadlines = Deadlines()
         
         print(f"Listening on {self.host}:{self.port}")
 
     def start(self):
         while True:
-            readable, _, _ = select.select(self.inputs, [], [])
+            readable, _, _ = select.select(self.inputs, [], [], self.deadlines.timeout(time.monotonic()))
             for s in readable:
                 if s is self.sock:
                     client_sock, client_addr = self.sock.accept()
+                    if len(self.client_data) >= MAX_CONNECTIONS:
+                        turn_away(client_sock, TOO_MANY)
+                        continue
                     self.inputs.append(client_sock)
+                    self.client_data[client_sock] = b""
+                    self.deadlines.set(client_sock, time.monotonic() + IDLE_TIMEOUT)
                     print(f"Connection from {client_addr}")
                 else:
-                    self.handle_client(s)
+                    self.read_client(s)
+
+            for s in self.deadlines.expired(time.monotonic()):
+                self.close_client(s, TIMED_OUT)
+
+    def read_client(self, client_sock):
+        """Receive from a client and run its command once the whole compressed command is in."""
+        try:
+            data = client_sock.recv(1024)
+        except OSError:
+            data = b""
+        if not data:
+            self.close_client(client_sock)
+            return
+        started = not self.client_data[client_sock]
+        self.client_data[client_sock] += data
+        if len(self.client_data[client_sock]) > MAX_REQUEST_SIZE:
+            self.close_client(client_sock, TOO_LONG)
+            return
+        # a read can end one command and carry the next ones, whole or in
+        # part, so run commands until what is left is incomplete
+        while self.client_data[client_sock]:
+            # an incomplete stream decompresses without error as far as it
+            # goes, only data that is not zlib at all raises
+            stream = zlib.decompressobj()
+            try:
+                stream.decompress(self.client_data[client_sock], MAX_REQUEST_SIZE)
+            except zlib.error:
+                self.close_client(client_sock, NOT_ZLIB)
+                return
+            if stream.unconsumed_tail:
+                self.close_client(client_sock, TOO_LONG)
+                return
+            if not stream.eof:
+                # the rest of the command does not move this deadline
+                if started:
+                    self.deadlines.set(client_sock, time.monotonic() + COMMAND_TIMEOUT)
+                return
+            # handle_client() inflates the first stream and ignores the rest
+            self.handle_client(client_sock)
+            if client_sock not in self.client_data:
+                return
+            self.client_data[client_sock] = stream.unused_data
+            started = True
+        self.deadlines.set(client_sock, time.monotonic() + IDLE_TIMEOUT)
 
     def handle_client(self, client_sock):
         """Handle a new client connection."""
         # Read the data from the client socket and decompress
         data = self.client_data.get(client_sock, b"")
-        decompressed_data = zlib.decompress(data).decode('utf-8')
+        try:
+            decompressed_data = zlib.decompress(data).decode('utf-8')
+        except UnicodeDecodeError:
+            client_sock.sendall(NOT_UTF8)
+            return
         command = decompressed_data.strip()
         
         print(f"Received command: {command}")
@@ -53,12 +128,21 @@ class FTPServer:
             client_sock.sendall(zlib.compress(f'257 "{current_dir}"\r\n'.encode('utf-8')))
         elif command.startswith("QUIT"):
             client_sock.sendall(zlib.compress(b'221 Goodbye\r\n'))
-            self.inputs.remove(client_sock)
-            del self.client_data[client_sock]
-            client_sock.close()
+            self.close_client(client_sock)
         else:
             client_sock.sendall(zlib.compress(b'502 Command not implemented\r\n'))
 
+    def close_client(self, client_sock, message=None):
+        """Forget a client and close it, after a last reply if there is one."""
+        self.inputs.remove(client_sock)
+        del self.client_data[client_sock]
+        self.deadlines.discard(client_sock)
+        if message is not None:
+            turn_away(client_sock, message)
+        else:
+            client_sock.close()
+
+
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
     def write(self, txt):
@@ -106,6 +190,92 @@ class TestFTPServer(unittest.TestCase):
         self.server.handle_client(client_sock)
         client_sock.sendall.assert_called_with(zlib.compress(b'502 Command not implemented\r\n'))
 
+    def test_handle_client_not_utf8(self):
+        client_sock = mock.Mock()
+        self.server.client_data = {client_sock: zlib.compress(b'USER \xff\r\n')}
+        self.server.handle_client(client_sock)
+        client_sock.sendall.assert_called_with(NOT_UTF8)
+        client_sock.close.assert_not_called()
+
+    def connect(self, *socks):
+        """Register mock clients as if they had just connected at time 0."""
+        for sock in socks:
+            self.server.inputs.append(sock)
+            self.server.client_data[sock] = b""
+            self.server.deadlines.set(sock, IDLE_TIMEOUT)
+
+    def test_timeouts(self):
+        idle, slow = mock.Mock(), mock.Mock()
+        command = zlib.compress(b'PWD\r\n')
+        # an incomplete zlib stream, started at 1 and still short at 20
+        slow.recv.side_effect = [command[:4], command[4:-2]]
+        self.connect(idle, slow)
+        steps = [(1, [slow]), (20, [slow]), (1 + COMMAND_TIMEOUT, []), (IDLE_TIMEOUT, [])]
+        timeouts = run_select_loop(self.server.start, steps)
+        self.assertEqual(timeouts, [IDLE_TIMEOUT, COMMAND_TIMEOUT, COMMAND_TIMEOUT - 19,
+                                    IDLE_TIMEOUT - 1 - COMMAND_TIMEOUT, None])
+        for sock in (idle, slow):
+            sock.send.assert_called_once_with(TIMED_OUT)
+            sock.sendall.assert_not_called()
+            sock.close.assert_called_once()
+        self.assertEqual(self.server.inputs, [self.server.sock])
+        self.assertEqual(self.server.client_data, {})
+
+    def test_pipelined_commands(self):
+        client = mock.Mock()
+        user, pwd, password = (zlib.compress(c) for c in (b'USER a\r\n', b'PWD\r\n', b'PASS b\r\n'))
+        # two whole commands and the start of a third in one read
+        client.recv.side_effect = [user + pwd + password[:4], password[4:]]
+        self.connect(client)
+        timeouts = run_select_loop(self.server.start, [(1, [client]), (5, [client])])
+        self.assertEqual(timeouts, [IDLE_TIMEOUT, COMMAND_TIMEOUT, IDLE_TIMEOUT])
+        replies = [zlib.decompress(c.args[0]) for c in client.sendall.call_args_list]
+        self.assertEqual(len(replies), 3)
+        self.assertTrue(replies[0].startswith(b'331'))
+        self.assertTrue(replies[1].startswith(b'257'))
+        self.assertTrue(replies[2].startswith(b'230'))
+        self.assertEqual(self.server.client_data[client], b"")
+        client.close.assert_not_called()
+
+    def test_command_too_long(self):
+        # a stream that never ends, and one that inflates past the limit
+        compressor = zlib.compressobj()
+        endless = compressor.compress(os.urandom(MAX_REQUEST_SIZE * 2)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        for reads in ([endless[i:i + 1024] for i in range(0, MAX_REQUEST_SIZE + 1, 1024)],
+                      [zlib.compress(b'USER ' + b'a' * MAX_REQUEST_SIZE)]):
+            client_sock = mock.Mock()
+            client_sock.recv.side_effect = reads
+            self.connect(client_sock)
+            run_select_loop(self.server.start, [(0, [client_sock])] * len(reads))
+            client_sock.send.assert_called_once_with(TOO_LONG)
+            client_sock.sendall.assert_not_called()
+            client_sock.close.assert_called_once()
+            self.assertEqual(self.server.inputs, [self.server.sock])
+
+    def test_not_zlib(self):
+        client_sock = mock.Mock()
+        client_sock.recv.return_value = b'PWD\r\n'
+        self.connect(client_sock)
+        run_select_loop(self.server.start, [(0, [client_sock])])
+        client_sock.send.assert_called_once_with(NOT_ZLIB)
+        client_sock.close.assert_called_once()
+        self.assertEqual(self.server.client_data, {})
+
+    def test_too_many_connections(self):
+        listener = mock.Mock()
+        client_sock = mock.Mock()
+        listener.accept.return_value = (client_sock, ('127.0.0.1', 54321))
+        real_sock, self.server.sock = self.server.sock, listener
+        self.server.inputs = [listener]
+        try:
+            with mock.patch.dict(globals(), MAX_CONNECTIONS=0):
+                run_select_loop(self.server.start, [(0, [listener])])
+        finally:
+            self.server.sock = real_sock
+        client_sock.send.assert_called_once_with(TOO_MANY)
+        client_sock.close.assert_called_once()
+        self.assertEqual(self.server.inputs, [listener])
+
 if __name__ == "__main__":
     if len(sys.argv) == 2 and sys.argv[1] == 'run':
         ftp_server = FTPServer()
@@ -31,16 +31,17 @@ def client():
     request = "GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
     client_socket.sendall(request.encode('utf-8'))
 
-    # Receive the response
-    response = b""
+    # Receive the response, the server keeps the connection open so stop
+    # once the whole body is in
+    response = ""
     while True:
         data = client_socket.recv(1024)
         if not data:
             break
-        response += data
-
-    # Decode and print the response
-    response = response.decode('utf-8')
+        # latin1 maps every byte to one character, so a compressed body survives
+        response += data.decode('latin1')
+        if "\r\n\r\n" in response and len(response) >= get_first_length(response) + 4:
+            break
 
     # Get the status code
     status_line = response.split("\r\n")[0]
@@ -57,11 +58,13 @@ def client():
     # Close the socket
     client_socket.close()
 
-    # Decompress and parse JSON content
-    header_length = get_first_length(response)
-    body = response[header_length:]
-    decompressed_body = zlib.decompress(body.encode('latin1')).decode('utf-8')
-    json_data = json.loads(decompressed_body)
+    # Decompress if the server deflated the body and parse JSON content
+    header_end = response.find("\r\n\r\n")
+    header = response[:header_end]
+    body = response[header_end + 4:get_first_length(response) + 4].encode('latin1')
+    if any(line.lower() == "content-encoding: deflate" for line in header.split("\r\n")):
+        body = zlib.decompress(body)
+    json_data = json.loads(body.decode('utf-8'))
     
     # Print the JSON content
     print(f"JSON Response: {json_data}")
@@ -97,6 +100,26 @@ class TestHttpClient(unittest.TestCase):
         instance.connect.assert_called_once_with(('localhost', 8080))
         print(f"connect called with: {instance.connect.call_args}")
 
+    @patch('builtins.print')
+    @patch('socket.socket')
+    def test_client(self, mock_socket, mock_print):
+        print('Testing client ...')
+        payload = json.dumps({"status": 200, "message": "Hello world!"}).encode('utf-8')
+        deflated = zlib.compress(payload)
+        for response in (
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+            b"Content-Encoding: deflate\r\nContent-Length: %d\r\n\r\n" % len(deflated) + deflated,
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(payload) + payload,
+        ):
+            mock_print.reset_mock()
+            # split reads, and the connection is left open afterwards
+            mock_socket.return_value.recv.side_effect = [response[:30], response[30:], b""]
+            client()
+            mock_print.assert_any_call("Status: 200 OK")
+            mock_print.assert_any_call(f"JSON Response: {json.loads(payload)}")
+            self.assertEqual(mock_socket.return_value.recv.call_count, 2)
+            mock_socket.return_value.recv.reset_mock()
+
 if __name__ == '__main__':
     if len(sys.argv) == 2 and sys.argv[1] == 'run':
         client()
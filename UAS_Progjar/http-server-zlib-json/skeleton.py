@@ -1,35 +1,183 @@
+import collections
+import contextlib
+import functools
 import json
+import os
 import socket
 import sys
 import select
+import threading
+import time
 import unittest
 import zlib
 from io import StringIO
 from unittest.mock import MagicMock, patch
 
-def get_content(status):
-    """Return the content based on the status code provided"""
+# the router and the connection limits are shared with the other servers,
+# they live in common/ at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.connections import MAX_CONNECTIONS, Deadlines, run_select_loop, turn_away
+from common.router import Router
+
+# zlib level used for response bodies, 1 (fastest) to 9 (smallest)
+COMPRESSION_LEVEL = 6
+# bodies shorter than this are sent uncompressed, the deflate header and
+# checksum would eat most or all of the saving
+MIN_COMPRESS_SIZE = 64
+# deflate every body whatever its size, for clients that always decompress
+ALWAYS_DEFLATE = False
+
+# path -> status, anything else is a 404
+ROUTES = {
+    '/index.html': 200,
+    '/hello.html': 200,
+}
+REASONS = {200: 'OK', 404: 'Not Found', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+def get_payload(status):
+    """Return the JSON body for the status code provided"""
     if status == 200:
         message = "Hello world!"
     elif status == 404:
         message = "404 Not found"
     elif status == 500:
         message = "500 Internal Server Error"
+    elif status == 503:
+        message = "503 Service Unavailable"
     else:
         message = "Unknown status"
     
-    content = json.dumps({"status": status, "message": message})
-
-    # Compress the JSON response using zlib
-    compressed_content = zlib.compress(content.encode('utf-8'))
-
-    return compressed_content
-
-def create_server():
+    return json.dumps({"status": status, "message": message}).encode('utf-8')
+
+def get_content(status, level=COMPRESSION_LEVEL):
+    """Return the content based on the status code provided, compressed with zlib"""
+    return zlib.compress(get_payload(status), level)
+
+@functools.lru_cache(maxsize=None)
+def get_response(status, level=COMPRESSION_LEVEL, min_compress_size=MIN_COMPRESS_SIZE,
+                 always_deflate=ALWAYS_DEFLATE):
+    """Return the complete response for a status code.
+
+    The payload is JSON-encoded and deflated once per status and setting.
+    It is deflated only if it is at least min_compress_size bytes and the
+    result is actually smaller, otherwise it goes out as plain JSON; with
+    always_deflate it is deflated regardless.
+    """
+    body = get_payload(status)
+    header = f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}\r\nContent-Type: application/json\r\n"
+    if len(body) >= min_compress_size or always_deflate:
+        compressed = zlib.compress(body, level)
+        if len(compressed) < len(body) or always_deflate:
+            body = compressed
+            header += "Content-Encoding: deflate\r\n"
+    header += f"Content-Length: {len(body)}\r\n\r\n"
+    return header.encode('utf-8') + body
+
+def build_router(level=COMPRESSION_LEVEL, min_compress_size=MIN_COMPRESS_SIZE, always_deflate=ALWAYS_DEFLATE):
+    """Return a Router mapping every route, for any method, to its built response."""
+    router = Router()
+    for path, status in ROUTES.items():
+        router.add('*', path, get_response(status, level, min_compress_size, always_deflate))
+    return router
+
+# request heads longer than this close the connection
+MAX_HEADER_SIZE = 8192
+RECV_SIZE = 4096
+# seconds a client has to send a whole request head, from its first byte
+# (or from connecting), however slowly it trickles in
+HEADER_TIMEOUT = 10
+# seconds an idle keep-alive connection, or a client that stopped reading
+# its responses, is kept open
+KEEP_ALIVE_TIMEOUT = 15
+
+class Connection:
+    """Per-client state of the select loop.
+
+    Received bytes are kept until a whole request head (up to the blank
+    line) is in, and responses are queued until the socket has taken all
+    of them, so neither a request split over several packets nor a client
+    that reads slowly holds up the other clients.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = b''
+        # body bytes of the last request still to be read and ignored
+        self.skip = 0
+        # memoryviews of the responses, the first one possibly partly sent
+        self.outgoing = collections.deque()
+        # when the request being received started, None between requests
+        self.head_started = time.monotonic()
+
+    def feed(self, data):
+        """Add received bytes, return the request heads completed by them."""
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        self.received += data
+        heads = []
+        while not self.skip:
+            end = self.received.find(b'\r\n\r\n')
+            if end < 0:
+                break
+            head = self.received[:end].decode('latin-1')
+            heads.append(head)
+            self.head_started = None
+            body = content_length(head)
+            rest = self.received[end + 4:]
+            self.received = rest[body:]
+            self.skip = max(0, body - len(rest))
+        return heads
+
+    def deadline(self, now):
+        """When to close the connection unless it makes progress before then."""
+        if self.outgoing:
+            # waiting for the client to read, every send moves this on
+            return now + KEEP_ALIVE_TIMEOUT
+        if self.received or self.skip or self.head_started is not None:
+            if self.head_started is None:
+                self.head_started = now
+            return self.head_started + HEADER_TIMEOUT
+        return now + KEEP_ALIVE_TIMEOUT
+
+    def overflowed(self):
+        return len(self.received) > MAX_HEADER_SIZE
+
+    def queue(self, response):
+        self.outgoing.append(memoryview(response))
+
+    def flush(self):
+        """Send as much as the socket takes without blocking, return True once nothing is left."""
+        while self.outgoing:
+            try:
+                sent = self.sock.send(self.outgoing[0])
+            except (BlockingIOError, InterruptedError):
+                return False
+            if sent < len(self.outgoing[0]):
+                self.outgoing[0] = self.outgoing[0][sent:]
+                return False
+            self.outgoing.popleft()
+        return True
+
+def content_length(head):
+    for line in head.split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            try:
+                return max(0, int(value))
+            except ValueError:
+                return 0
+    return 0
+
+# sent to clients turned away because the server is full
+BUSY = get_response(503)
+
+def create_server(port=8080):
     """Create a server socket and listen for incoming connections"""
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(('localhost', 8080))
+    server_socket.bind(('localhost', port))
     server_socket.listen(5)
     return server_socket
 
@@ -39,47 +187,148 @@ def get_header(data):
     print(f"request header: {headers}")
     return headers[0].split(' ')[1]
 
-def serve():
+def serve(port=8080, level=COMPRESSION_LEVEL, min_compress_size=MIN_COMPRESS_SIZE, always_deflate=ALWAYS_DEFLATE):
     """Start the server and process incoming requests"""
 
     # Create the server socket
-    server_socket = create_server()
+    server_socket = create_server(port)
     input_socket = [server_socket]
+    # clients with queued output wait for write readiness and are not read
+    # from until it is all sent
+    output_socket = []
+    connections = {}
+    deadlines = Deadlines()
+
+    # every response is built once, requests only look them up
+    router = build_router(level, min_compress_size, always_deflate)
+    not_found = get_response(404, level, min_compress_size, always_deflate)
+
+    def close(sock):
+        sock.close()
+        connections.pop(sock, None)
+        deadlines.discard(sock)
+        for sockets in (input_socket, output_socket):
+            if sock in sockets:
+                sockets.remove(sock)
+
+    def flush(conn):
+        try:
+            done = conn.flush()
+        except OSError:
+            close(conn.sock)
+            return
+        if done and conn.sock in output_socket:
+            output_socket.remove(conn.sock)
+            input_socket.append(conn.sock)
+        elif not done and conn.sock in input_socket:
+            input_socket.remove(conn.sock)
+            output_socket.append(conn.sock)
+        deadlines.set(conn.sock, conn.deadline(time.monotonic()))
 
     try:
         while True:
-            read_ready, _, _ = select.select(input_socket, [], [])
+            read_ready, write_ready, _ = select.select(input_socket, output_socket, [], deadlines.timeout(time.monotonic()))
             
             for sock in read_ready:
                 if sock == server_socket:
                     client_socket, addr = server_socket.accept()
+                    if len(connections) >= MAX_CONNECTIONS:
+                        turn_away(client_socket, BUSY)
+                        continue
+                    client_socket.setblocking(False)
                     input_socket.append(client_socket)
-
-                else:                
-                    data = sock.recv(1024).decode('utf-8')
-                    if data:
-                        resource = get_header(data)
-                        if resource == '/index.html':
-                            status = 200
-                        elif resource == '/hello.html':
-                            status = 200
-                        else:
-                            status = 404
-                        content = get_content(status)
-                        compressed_content = zlib.compress(content.encode('utf-8'))
-                        response = f"HTTP/1.1 {status} OK\r\n"
-                        response += f"Content-Length: {len(compressed_content)}\r\n"
-                        response += f"Content-Encoding: deflate\r\n"
-                        response += "\r\n"
-                        sock.sendall(response.encode('utf-8') + compressed_content)
-                    else:
-                        sock.close()
-                        input_socket.remove(sock)
+                    conn = connections[client_socket] = Connection(client_socket)
+                    deadlines.set(client_socket, conn.deadline(time.monotonic()))
+                    continue
+
+                conn = connections.get(sock)
+                if conn is None:
+                    continue
+                try:
+                    data = sock.recv(RECV_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    data = b''
+                if not data:
+                    close(sock)
+                    continue
+                try:
+                    for head in conn.feed(data):
+                        resource = get_header(head).partition('?')[0]
+                        match = router.match(head.split(' ', 1)[0], resource)
+                        conn.queue(match[0] if match else not_found)
+                except IndexError:
+                    # no target in the request line
+                    close(sock)
+                    continue
+                if conn.overflowed():
+                    close(sock)
+                elif conn.outgoing:
+                    flush(conn)
+                else:
+                    deadlines.set(sock, conn.deadline(time.monotonic()))
+
+            for sock in write_ready:
+                conn = connections.get(sock)
+                if conn is not None:
+                    flush(conn)
+
+            for sock in deadlines.expired(time.monotonic()):
+                close(sock)
 
     except KeyboardInterrupt:        
-        for sock in input_socket:
+        for sock in input_socket + output_socket:
             sock.close()
 
+def bench(requests=20000, connections=4):
+    """Print requests/sec for building each response per request against the cached responses,
+    in process and through a running server, at a few compression levels."""
+    statuses = [200, 404, 500] * (requests // 3)
+    for level in (1, 6, 9):
+        start = time.perf_counter()
+        for status in statuses:
+            body = zlib.compress(get_payload(status), level)
+            header = f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Encoding: deflate\r\nContent-Length: {len(body)}\r\n\r\n"
+            header.encode('utf-8') + body
+        per_request = len(statuses) / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for status in statuses:
+            get_response(status, level, 0, True)
+        cached = len(statuses) / (time.perf_counter() - start)
+        print(f"level {level}: per request {per_request:10.0f} req/s, cached {cached:10.0f} req/s")
+
+    # end to end: clients sending one request at a time over their own
+    # connection, with the server's request logging silenced meanwhile
+    probe = socket.socket()
+    probe.bind(('localhost', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    threading.Thread(target=serve, args=(port,), daemon=True).start()
+    time.sleep(0.2)
+    request = b"GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    expected = len(get_response(200))
+    count = requests // connections
+
+    def run_client():
+        sock = socket.create_connection(('localhost', port))
+        for _ in range(count):
+            sock.sendall(request)
+            received = 0
+            while received < expected:
+                received += len(sock.recv(4096))
+        sock.close()
+
+    clients = [threading.Thread(target=run_client) for _ in range(connections)]
+    with contextlib.redirect_stdout(NullWriter()):
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+    print(f"server: {count * connections / elapsed:.0f} req/s over {connections} connections")
+
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
     def write(self, txt):
@@ -113,6 +362,137 @@ class TestHttpServer(unittest.TestCase):
         content = get_content(500)
         assert_in('500 Internal Server Error', zlib.decompress(content).decode('utf-8'))
 
+    def test_get_response_compresses_once(self):
+        print('Testing get_response ...')
+        payload = json.dumps({"status": 404, "message": "404 Not found " * 20}).encode('utf-8')
+        with patch.dict(globals(), get_payload=lambda status: payload):
+            # bypass the cache, the patched payload must not end up in it
+            response = get_response.__wrapped__(404, 9, 0)
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.1 404 Not Found\r\n'))
+        self.assertIn(b'Content-Encoding: deflate', head)
+        self.assertIn(f'Content-Length: {len(body)}'.encode(), head)
+        # a single deflate layer holding the JSON payload
+        self.assertEqual(zlib.decompress(body), payload)
+
+        self.assertIs(get_response(404, 9, 0), get_response(404, 9, 0))
+
+    def test_get_response_skips_tiny_bodies(self):
+        print('Testing get_response without compression ...')
+        # under the threshold, and with none the deflated body would be bigger
+        for response in (get_response(200), get_response(200, COMPRESSION_LEVEL, 0)):
+            head, body = response.split(b'\r\n\r\n', 1)
+            self.assertNotIn(b'Content-Encoding', head)
+            self.assertEqual(json.loads(body), {"status": 200, "message": "Hello world!"})
+        head, body = get_response(200, COMPRESSION_LEVEL, 0, True).split(b'\r\n\r\n', 1)
+        self.assertIn(b'Content-Encoding: deflate', head)
+        self.assertIn(f'Content-Length: {len(body)}'.encode(), head)
+        self.assertEqual(json.loads(zlib.decompress(body)), {"status": 200, "message": "Hello world!"})
+
+    def test_router(self):
+        print('Testing build_router ...')
+        router = build_router(9, 0)
+        self.assertEqual(router.match('GET', '/hello.html'), (get_response(200, 9, 0), {}))
+        self.assertIsNone(router.match('GET', '/nonexistent.html'))
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_sends_cached_response(self, mock_socket, mock_select):
+        print('Testing serve with cached responses ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_client_socket.recv.side_effect = [
+            b"GET /hello.html HTTP/1.1\r\nHost: localhost\r\n\r\n",
+            b"GET /nonexistent.html HTTP/1.1\r\nHost: localhost\r\n\r\n",
+        ]
+        mock_select.side_effect = [
+            ([mock_server_socket], [], []),
+            ([mock_client_socket], [], []),
+            ([mock_client_socket], [], []),
+            KeyboardInterrupt,
+        ]
+
+        mock_client_socket.send.side_effect = len
+
+        serve(level=9, min_compress_size=0)
+
+        self.assertEqual([bytes(args[0]) for args, _ in mock_client_socket.send.call_args_list],
+                         [get_response(200, 9, 0), get_response(404, 9, 0)])
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_partial_reads_and_writes(self, mock_socket, mock_select):
+        print('Testing serve with a split request and a slow reader ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_client_socket.recv.side_effect = [b"GET /index.html HTTP/1.1\r\nHo", b"st: localhost\r\n\r\n"]
+        # the client takes at most 10 bytes per send
+        sent = []
+        mock_client_socket.send.side_effect = lambda data: sent.append(bytes(data[:10])) or len(sent[-1])
+        def select_side_effect(inputs, outputs, errors, timeout):
+            if mock_select.call_count == 1:
+                return [mock_server_socket], [], []
+            if mock_select.call_count <= 3:
+                return [mock_client_socket], [], []
+            if mock_client_socket in outputs:
+                self.assertNotIn(mock_client_socket, inputs)
+                return [], [mock_client_socket], []
+            raise KeyboardInterrupt
+        mock_select.side_effect = select_side_effect
+
+        serve()
+
+        self.assertEqual(b''.join(sent), get_response(200))
+        self.assertGreater(len(sent), 1)
+
+    @patch('socket.socket')
+    def test_serve_closes_idle_clients(self, mock_socket):
+        print('Testing serve with idle and slow clients ...')
+        mock_server_socket = MagicMock()
+        idle, slow = MagicMock(), MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [(idle, ('127.0.0.1', 1)), (slow, ('127.0.0.1', 2))]
+        idle.recv.return_value = b"GET /index.html HTTP/1.1\r\n\r\n"
+        idle.send.side_effect = len
+        slow.recv.return_value = b"GET /index.html HTTP/1.1\r\nHo"
+        steps = [
+            # both connect, the idle client gets its response, the slow one
+            # only ever sends part of a request head
+            (0, [mock_server_socket]),
+            (0, [mock_server_socket]),
+            (1, [idle, slow]),
+            (HEADER_TIMEOUT, []),
+            (1 + KEEP_ALIVE_TIMEOUT, []),
+        ]
+
+        timeouts = run_select_loop(serve, steps)
+
+        slow.close.assert_called_once()
+        idle.close.assert_called_once()
+        self.assertEqual(timeouts[4], KEEP_ALIVE_TIMEOUT + 1 - HEADER_TIMEOUT)
+        self.assertIsNone(timeouts[5])
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_rejects_over_max_connections(self, mock_socket, mock_select):
+        print('Testing serve with too many clients ...')
+        mock_server_socket = MagicMock()
+        first, second = MagicMock(), MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [(first, ('127.0.0.1', 1)), (second, ('127.0.0.1', 2))]
+        mock_select.side_effect = [([mock_server_socket], [], []), ([mock_server_socket], [], []), KeyboardInterrupt]
+
+        with patch.dict(globals(), MAX_CONNECTIONS=1):
+            serve()
+
+        second.send.assert_called_once_with(BUSY)
+        second.close.assert_called_once()
+        self.assertTrue(BUSY.startswith(b'HTTP/1.1 503 Service Unavailable\r\n'))
+
     @patch('socket.socket')
     def test_create_server(self, mock_socket):
         print('Testing create_server ...')
@@ -209,8 +589,13 @@ class TestHttpServer(unittest.TestCase):
         assert_true(mock_server_socket.close.called, 'close')
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2 and sys.argv[1] == 'run':
-        serve()
+    if len(sys.argv) >= 2 and sys.argv[1] == 'run':
+        # python skeleton.py run [level] [min compress size] [always-deflate]
+        args = [arg for arg in sys.argv[2:] if arg != 'always-deflate']
+        serve(8080, *(int(arg) for arg in args[:2]), always_deflate='always-deflate' in sys.argv[2:])
+    elif len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        bench()
+        sys.exit()
 
     # run unit test to test locally
     # or for domjudge
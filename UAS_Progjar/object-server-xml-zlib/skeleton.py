@@ -1,5 +1,7 @@
+import os
 import socket
 import select
+import time
 import sys
 import xml.etree.ElementTree as ET
 import logging
@@ -9,10 +11,21 @@ from unittest.mock import patch, MagicMock
 from io import StringIO
 import zlib
 
+# the deadline heap and the connection limit are shared with the other
+# servers, they live in common/ at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.connections import MAX_CONNECTIONS, Deadlines, run_select_loop
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# seconds without a complete compressed XML message before a client is dropped
+IDLE_TIMEOUT = 60
+# bytes a message may take, compressed or inflated, before its sender is
+# closed; a message can arrive over several reads
+MAX_REQUEST_SIZE = 16 * 1024
+
 class Message:
     def __init__(self, username, text, timestamp):
         # Initialize the message attributes
@@ -50,6 +63,25 @@ class Message:
 
         return compressed_message
 
+def split_message(data):
+    """Split the first compressed message off data, return (message, rest).
+
+    Returns None while the message is incomplete.  Raises ValueError for a
+    message past MAX_REQUEST_SIZE and zlib.error for data that is not zlib
+    at all.
+    """
+    if len(data) > MAX_REQUEST_SIZE:
+        raise ValueError(f"Message longer than {MAX_REQUEST_SIZE} bytes")
+    stream = zlib.decompressobj()
+    stream.decompress(data, MAX_REQUEST_SIZE)
+    if stream.unconsumed_tail:
+        raise ValueError(f"Message inflates past {MAX_REQUEST_SIZE} bytes")
+    if not stream.eof:
+        return None
+    # zlib stops at the end of the stream, what follows is the next message
+    rest = stream.unused_data
+    return data[:len(data) - len(rest)], rest
+
 def main():
     # Set up the server socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -59,36 +91,66 @@ def main():
     server_socket.setblocking(False)
 
     sockets_list = [server_socket]
+    deadlines = Deadlines()
+    # socket -> the start of a message that has not fully arrived
+    buffers = {}
+
+    def disconnect(sock):
+        # a socket can be both readable and in error in one round
+        if sock in sockets_list:
+            sockets_list.remove(sock)
+            buffers.pop(sock, None)
+            deadlines.discard(sock)
+            sock.close()
 
     logger.info("Server is listening on port 12345")
 
     while True:
-        read_sockets, _, exception_sockets = select.select(sockets_list, [], sockets_list)
+        read_sockets, _, exception_sockets = select.select(sockets_list, [], sockets_list, deadlines.timeout(time.monotonic()))
 
         for notified_socket in read_sockets:
             if notified_socket == server_socket:
                 client_socket, client_address = server_socket.accept()
+                if len(sockets_list) > MAX_CONNECTIONS:
+                    logger.info(f"Rejected connection from {client_address}, {MAX_CONNECTIONS} clients connected")
+                    client_socket.close()
+                    continue
                 client_socket.setblocking(False)
                 
                 sockets_list.append(client_socket)
                 logger.info(f"Accepted new connection from {client_address}")
+                deadlines.set(client_socket, time.monotonic() + IDLE_TIMEOUT)
             else:
                 try:
                     data = notified_socket.recv(1024)
                     if data:
-                        message = Message.deserialize(data)
-                        logger.info("Received message:")
-                        logger.info(f"Username: {message.username}")
-                        logger.info(f"Text: {message.text}")
-                        logger.info(f"Timestamp: {message.timestamp}")
+                        data = buffers.pop(notified_socket, b'') + data
+                        # a read can end one message and carry the next ones,
+                        # whole or in part
+                        while data:
+                            split = split_message(data)
+                            if split is None:
+                                buffers[notified_socket] = data
+                                break
+                            serialized, data = split
+                            message = Message.deserialize(serialized)
+                            logger.info("Received message:")
+                            logger.info(f"Username: {message.username}")
+                            logger.info(f"Text: {message.text}")
+                            logger.info(f"Timestamp: {message.timestamp}")
+                            deadlines.set(notified_socket, time.monotonic() + IDLE_TIMEOUT)
+                    else:
+                        disconnect(notified_socket)
                 except Exception as e:
                     logger.info(f"Exception: {e}")
-                    sockets_list.remove(notified_socket)
-                    notified_socket.close()
+                    disconnect(notified_socket)
 
         for notified_socket in exception_sockets:
-            sockets_list.remove(notified_socket)
-            notified_socket.close()
+            disconnect(notified_socket)
+
+        for notified_socket in deadlines.expired(time.monotonic()):
+            logger.info(f"Closing connection idle for {IDLE_TIMEOUT} seconds")
+            disconnect(notified_socket)
 
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
@@ -145,6 +207,86 @@ class TestChatServer(unittest.TestCase):
             assert_true_any("Username: Alice", log_output)
             assert_true_any("Text: Hello, World!", log_output) 
 
+    @patch('socket.socket')
+    def test_connection_limits(self, mock_socket_class):
+        mock_server_socket = MagicMock()
+        first, second = MagicMock(), MagicMock()
+        mock_socket_class.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [(first, ('127.0.0.1', 1)), (second, ('127.0.0.1', 2))]
+        first.recv.return_value = Message("Alice", "Hello, World!", datetime.now()).serialize()
+        # the second client is one too many; the first sends a message at
+        # 30 and then goes quiet
+        steps = [(0, [mock_server_socket]), (0, [mock_server_socket]), (30, [first]), (30 + IDLE_TIMEOUT, [])]
+
+        with self.assertLogs(logger, level='INFO') as log:
+            with patch.dict(globals(), MAX_CONNECTIONS=1):
+                timeouts = run_select_loop(main, steps)
+
+        self.assertEqual(timeouts, [None, IDLE_TIMEOUT, IDLE_TIMEOUT, IDLE_TIMEOUT, None])
+        second.close.assert_called_once()
+        second.setblocking.assert_not_called()
+        first.close.assert_called_once()
+        assert_true_any("Rejected connection", log.output)
+        assert_true_any("Closing connection idle", log.output)
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_message_across_reads(self, mock_socket_class, mock_select):
+        mock_server_socket = MagicMock()
+        split, flood, garbage = MagicMock(), MagicMock(), MagicMock()
+        mock_socket_class.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [(split, ('127.0.0.1', 1)), (flood, ('127.0.0.1', 2)),
+                                                 (garbage, ('127.0.0.1', 3))]
+        serialized_message = Message("Alice", "Hello, World!", datetime.now()).serialize()
+        split.recv.side_effect = [serialized_message[:10], serialized_message[10:]]
+        # small on the wire, but it would inflate past the limit
+        flood.recv.side_effect = [zlib.compress(b'<' * (MAX_REQUEST_SIZE + 1))]
+        garbage.recv.return_value = b'not a message'
+        mock_select.side_effect = [([mock_server_socket], [], [])] * 3 + [
+            ([split, garbage], [], []),
+            ([split], [], []),
+            ([flood], [], []),
+            KeyboardInterrupt(),
+        ]
+
+        with self.assertLogs(logger, level='INFO') as log:
+            with self.assertRaises(KeyboardInterrupt):
+                main()
+
+        assert_true_any("Username: Alice", log.output)
+        self.assertEqual(sum("Received message:" in line for line in log.output), 1)
+        split.close.assert_not_called()
+        self.assertEqual(garbage.recv.call_count, 1)
+        garbage.close.assert_called_once()
+        flood.close.assert_called_once()
+        self.assertEqual(mock_select.call_args[0][0], [mock_server_socket, split])
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_messages_in_one_read(self, mock_socket_class, mock_select):
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket_class.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 1))
+        first = Message("Alice", "one", datetime.now()).serialize()
+        second = Message("Bob", "two", datetime.now()).serialize()
+        # two whole messages and the start of a third in one read
+        mock_client_socket.recv.side_effect = [first + second + first[:10], first[10:]]
+        mock_select.side_effect = [
+            ([mock_server_socket], [], []),
+            ([mock_client_socket], [], []),
+            ([mock_client_socket], [], []),
+            KeyboardInterrupt(),
+        ]
+
+        with self.assertLogs(logger, level='INFO') as log:
+            with self.assertRaises(KeyboardInterrupt):
+                main()
+
+        self.assertEqual(sum("Received message:" in line for line in log.output), 3)
+        assert_true_any("Username: Bob", log.output)
+        mock_client_socket.close.assert_not_called()
+
 if __name__ == '__main__':
     if len(sys.argv) == 2 and sys.argv[1] == 'run':
         main()
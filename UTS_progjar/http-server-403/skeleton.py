@@ -1,10 +1,19 @@
+import collections
+import os
 import socket
 import sys
+import time
 import unittest
 import select
 from io import StringIO
 from unittest.mock import patch, MagicMock
 
+# the router and the connection limits are shared with the other servers,
+# they live in common/ at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.connections import MAX_CONNECTIONS, Deadlines, run_select_loop, turn_away
+from common.router import Router
+
 
 def get_content(status):
     if status == 200:
@@ -13,6 +22,8 @@ def get_content(status):
         content = "404 Not found"
     elif status == 403:
         content = "403 Forbidden"
+    elif status == 503:
+        content = "503 Service Unavailable"
 
     index_html = f'''
     <!DOCTYPE html>
@@ -30,6 +41,139 @@ def get_content(status):
     return index_html
 
 
+# path -> status, anything else is a 404
+ROUTES = {
+    '/': 200,
+    '/index.html': 200,
+    '/hello.html': 403,
+}
+REASONS = {200: 'OK', 403: 'Forbidden', 404: 'Not Found', 503: 'Service Unavailable'}
+
+
+def build_response(status):
+    content = get_content(status).encode()
+    header = f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: text/html\r\nContent-Length: {len(content)}\r\n\r\n"
+    return header.encode() + content
+
+
+def compile_routes(routes=ROUTES):
+    """Serialize every response once, return ({path: response bytes}, 404 response bytes).
+
+    Paths with the same status share one bytes object.
+    """
+    by_status = {status: build_response(status) for status in set(routes.values()) | {404}}
+    return {path: by_status[status] for path, status in routes.items()}, by_status[404]
+
+
+RESPONSES, NOT_FOUND = compile_routes()
+# sent to clients turned away because the server is full
+BUSY = build_response(503)
+
+
+def build_router(responses=RESPONSES):
+    """Register every compiled response for any method, serve() looks them up by method and path."""
+    router = Router()
+    for path, response in responses.items():
+        router.add('*', path, response)
+    return router
+
+
+ROUTER = build_router()
+
+
+# request heads longer than this close the connection
+MAX_HEADER_SIZE = 8192
+RECV_SIZE = 4096
+# seconds a client has to send a whole request head, from its first byte
+# (or from connecting), however slowly it trickles in
+HEADER_TIMEOUT = 10
+# seconds an idle keep-alive connection, or a client that stopped reading
+# its responses, is kept open
+KEEP_ALIVE_TIMEOUT = 15
+
+
+class Connection:
+    """Per-client state of the select loop.
+
+    Received bytes are kept until a whole request head (up to the blank
+    line) is in, and responses are queued until the socket has taken all
+    of them, so neither a request split over several packets nor a client
+    that reads slowly holds up the other clients.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = b''
+        # body bytes of the last request still to be read and ignored
+        self.skip = 0
+        # memoryviews of the responses, the first one possibly partly sent
+        self.outgoing = collections.deque()
+        # when the request being received started, None between requests
+        self.head_started = time.monotonic()
+
+    def feed(self, data):
+        """Add received bytes, return the request heads completed by them."""
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        self.received += data
+        heads = []
+        while not self.skip:
+            end = self.received.find(b'\r\n\r\n')
+            if end < 0:
+                break
+            head = self.received[:end].decode('latin-1')
+            heads.append(head)
+            self.head_started = None
+            body = content_length(head)
+            rest = self.received[end + 4:]
+            self.received = rest[body:]
+            self.skip = max(0, body - len(rest))
+        return heads
+
+    def deadline(self, now):
+        """When to close the connection unless it makes progress before then."""
+        if self.outgoing:
+            # waiting for the client to read, every send moves this on
+            return now + KEEP_ALIVE_TIMEOUT
+        if self.received or self.skip or self.head_started is not None:
+            if self.head_started is None:
+                self.head_started = now
+            return self.head_started + HEADER_TIMEOUT
+        return now + KEEP_ALIVE_TIMEOUT
+
+    def overflowed(self):
+        return len(self.received) > MAX_HEADER_SIZE
+
+    def queue(self, response):
+        self.outgoing.append(memoryview(response))
+
+    def flush(self):
+        """Send as much as the socket takes without blocking, return True once nothing is left."""
+        while self.outgoing:
+            try:
+                sent = self.sock.send(self.outgoing[0])
+            except (BlockingIOError, InterruptedError):
+                return False
+            if sent < len(self.outgoing[0]):
+                self.outgoing[0] = self.outgoing[0][sent:]
+                return False
+            self.outgoing.popleft()
+        return True
+
+
+def content_length(head):
+    for line in head.split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            try:
+                return max(0, int(value))
+            except ValueError:
+                return 0
+    return 0
+
+
 def create_server():
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -46,35 +190,142 @@ def get_header(data):
 def serve():
     server_socket = create_server()
     inputs = [server_socket]
+    # clients with queued output wait for write readiness and are not read
+    # from until it is all sent
+    outputs = []
+    connections = {}
+    deadlines = Deadlines()
+
+    def close(sock):
+        sock.close()
+        connections.pop(sock, None)
+        deadlines.discard(sock)
+        for sockets in (inputs, outputs):
+            if sock in sockets:
+                sockets.remove(sock)
+
+    def flush(conn):
+        try:
+            done = conn.flush()
+        except OSError:
+            close(conn.sock)
+            return
+        if done and conn.sock in outputs:
+            outputs.remove(conn.sock)
+            inputs.append(conn.sock)
+        elif not done and conn.sock in inputs:
+            inputs.remove(conn.sock)
+            outputs.append(conn.sock)
+        deadlines.set(conn.sock, conn.deadline(time.monotonic()))
+
     try:
         while True:
-            readable, _, _ = select.select(inputs, [], [])
+            readable, writable, _ = select.select(inputs, outputs, [], deadlines.timeout(time.monotonic()))
             for sock in readable:
                 if sock == server_socket:
                     client_socket, client_address = server_socket.accept()
+                    if len(connections) >= MAX_CONNECTIONS:
+                        turn_away(client_socket, BUSY)
+                        continue
+                    client_socket.setblocking(False)
                     inputs.append(client_socket)
+                    conn = connections[client_socket] = Connection(client_socket)
+                    deadlines.set(client_socket, conn.deadline(time.monotonic()))
+                    continue
+                conn = connections.get(sock)
+                if conn is None:
+                    continue
+                try:
+                    data = sock.recv(RECV_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    data = b''
+                if not data:
+                    close(sock)
+                    continue
+                try:
+                    for head in conn.feed(data):
+                        requested_resource = get_header(head).partition('?')[0]
+                        match = ROUTER.match(head.split(' ', 1)[0], requested_resource)
+                        conn.queue(match[0] if match else NOT_FOUND)
+                except IndexError:
+                    # no target in the request line
+                    close(sock)
+                    continue
+                if conn.overflowed():
+                    close(sock)
+                elif conn.outgoing:
+                    flush(conn)
                 else:
-                    data = sock.recv(1024).decode()
-                    if data:
-                        requested_resource = get_header(data)
-                        if requested_resource == '/':
-                            status = 200
-                        elif requested_resource == '/index.html':
-                            status = 200
-                        elif requested_resource == '/hello.html':
-                            status = 403
-                        else:
-                            status = 404
-                        content = get_content(status)
-                        response = f"HTTP/1.1 {status}\r\nContent-Length: {len(content)}\r\n\r\n{content}"
-                        sock.send(response.encode())
-                    else:
-                        sock.close()
-                        inputs.remove(sock)
+                    deadlines.set(sock, conn.deadline(time.monotonic()))
+            for sock in writable:
+                conn = connections.get(sock)
+                if conn is not None:
+                    flush(conn)
+            for sock in deadlines.expired(time.monotonic()):
+                close(sock)
     except KeyboardInterrupt:
         server_socket.close()
 
 
+def bench(requests=200000):
+    """Compare building each response per request with looking it up in the compiled table."""
+    paths = ['/', '/index.html', '/hello.html', '/missing.html'] * (requests // 4)
+
+    def build_per_request(path):
+        # what serve() did before the table: status chain, f-string, encode
+        if path == '/' or path == '/index.html':
+            status = 200
+        elif path == '/hello.html':
+            status = 403
+        else:
+            status = 404
+        content = get_content(status)
+        return f"HTTP/1.1 {status}\r\nContent-Length: {len(content)}\r\n\r\n{content}".encode()
+
+    def lookup(path):
+        return RESPONSES.get(path, NOT_FOUND)
+
+    def route(path):
+        match = ROUTER.match('GET', path)
+        return match[0] if match else NOT_FOUND
+
+    results = {}
+    for name, respond in (('per request', build_per_request), ('table', lookup), ('router', route)):
+        start = time.perf_counter()
+        for path in paths:
+            respond(path)
+        elapsed = time.perf_counter() - start
+        results[name] = len(paths) / elapsed
+        print(f"{name:12s} {results[name]:12.0f} responses/s {elapsed / len(paths) * 1e9:8.0f} ns/response")
+    print(f"table is {results['table'] / results['per request']:.1f}x faster")
+
+    # dispatch cost as the route count grows: a chain of comparisons against
+    # the router, for a path near the end of the chain
+    for count in (10, 100, 1000):
+        patterns = [f'/api/v1/items{i}/<id>' for i in range(count)]
+        router = Router()
+        for pattern in patterns:
+            router.add('GET', pattern, pattern)
+        prefixes = [pattern[:-len('<id>')] for pattern in patterns]
+        path = prefixes[-1] + '42'
+
+        def chain(path):
+            for prefix in prefixes:
+                if path.startswith(prefix) and '/' not in path[len(prefix):]:
+                    return prefix
+            return None
+
+        timings = []
+        for respond in (chain, lambda path: router.match('GET', path)):
+            start = time.perf_counter()
+            for _ in range(requests // 100):
+                respond(path)
+            timings.append((time.perf_counter() - start) / (requests // 100) * 1e9)
+        print(f"{count:5d} routes: if/elif chain {timings[0]:9.0f} ns, router {timings[1]:6.0f} ns")
+
+
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
     def write(self, txt):
@@ -121,6 +372,155 @@ class TestHttpServer(unittest.TestCase):
         print(f"listen called with: {instance.listen.call_args}")
         print()
 
+    def test_compiled_routes(self):
+        print('Testing compile_routes ...')
+        for path, status, text in (('/', 200, 'Hello world!'), ('/index.html', 200, 'Hello world!'),
+                                   ('/hello.html', 403, '403 Forbidden')):
+            response = RESPONSES[path]
+            head, body = response.split(b'\r\n\r\n', 1)
+            self.assertTrue(head.startswith(f'HTTP/1.1 {status} '.encode()))
+            self.assertIn(f'Content-Length: {len(body)}'.encode(), head)
+            self.assertIn(text.encode(), body)
+        self.assertTrue(NOT_FOUND.startswith(b'HTTP/1.1 404 Not Found\r\n'))
+        self.assertIn(b'404 Not found', NOT_FOUND)
+        # responses with the same status are serialized once
+        self.assertIs(RESPONSES['/'], RESPONSES['/index.html'])
+        print()
+
+    def test_router(self):
+        print('Testing build_router ...')
+        # every path answers any method with its compiled response
+        for method in ('GET', 'HEAD', 'POST'):
+            self.assertIs(ROUTER.match(method, '/hello.html')[0], RESPONSES['/hello.html'])
+        self.assertIsNone(ROUTER.match('GET', '/missing.html'))
+        print()
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_sends_compiled_response(self, mock_socket, mock_select):
+        print('Testing serve with the route table ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_client_socket.recv.side_effect = [
+            b"GET /hello.html HTTP/1.1\r\nHost: localhost\r\n\r\n",
+            b"GET /nonexistent.html HTTP/1.1\r\nHost: localhost\r\n\r\n",
+        ]
+        mock_select.side_effect = [
+            ([mock_server_socket], [], []),
+            ([mock_client_socket], [], []),
+            ([mock_client_socket], [], []),
+            KeyboardInterrupt,
+        ]
+
+        mock_client_socket.send.side_effect = len
+
+        serve()
+
+        self.assertEqual([bytes(args[0]) for args, _ in mock_client_socket.send.call_args_list],
+                         [RESPONSES['/hello.html'], NOT_FOUND])
+        print()
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_partial_reads_and_writes(self, mock_socket, mock_select):
+        print('Testing serve with split requests and a slow reader ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        # the first request arrives in two pieces, the second is pipelined
+        # behind a body that has to be skipped
+        mock_client_socket.recv.side_effect = [
+            b"GET /hello.html HTTP/1.1\r\nHost: loc",
+            b"alhost\r\n\r\nPOST /index.html HTTP/1.1\r\nContent-Length: 4\r\n\r\nbody",
+        ]
+        # the client takes at most 100 bytes per send
+        sent = []
+        def send(data):
+            sent.append(bytes(data[:100]))
+            return len(sent[-1])
+        mock_client_socket.send.side_effect = send
+        selected = []
+        def select_side_effect(inputs, outputs, errors, timeout):
+            selected.append((list(inputs), list(outputs)))
+            if len(selected) == 1:
+                return [mock_server_socket], [], []
+            if len(selected) <= 3:
+                return [mock_client_socket], [], []
+            if mock_client_socket in outputs:
+                return [], [mock_client_socket], []
+            raise KeyboardInterrupt
+        mock_select.side_effect = select_side_effect
+
+        serve()
+
+        self.assertEqual(b''.join(sent), RESPONSES['/hello.html'] + RESPONSES['/index.html'])
+        self.assertGreater(len(sent), 2)
+        # while output is queued the client waits for write readiness only
+        self.assertEqual(selected[3], ([mock_server_socket], [mock_client_socket]))
+        self.assertEqual(selected[-1], ([mock_server_socket, mock_client_socket], []))
+        mock_client_socket.setblocking.assert_called_once_with(False)
+        print()
+
+    def test_connection_deadline(self):
+        print('Testing Connection.deadline ...')
+        with patch('time.monotonic', return_value=100):
+            conn = Connection(MagicMock())
+        # the first request head is due HEADER_TIMEOUT after connecting
+        self.assertEqual(conn.deadline(105), 100 + HEADER_TIMEOUT)
+        # trickling bytes in does not move it
+        conn.feed(b"GET / HTTP/1.1\r\n")
+        self.assertEqual(conn.deadline(107), 100 + HEADER_TIMEOUT)
+        conn.feed(b"\r\n")
+        self.assertEqual(conn.deadline(108), 108 + KEEP_ALIVE_TIMEOUT)
+        conn.queue(NOT_FOUND)
+        self.assertEqual(conn.deadline(109), 109 + KEEP_ALIVE_TIMEOUT)
+        conn.outgoing.clear()
+        conn.feed(b"GET /index")
+        self.assertEqual(conn.deadline(120), 120 + HEADER_TIMEOUT)
+        print()
+
+    @patch('socket.socket')
+    def test_serve_closes_slow_clients(self, mock_socket):
+        print('Testing serve with a client trickling its request in ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_client_socket.recv.side_effect = [b"GET / HTTP/1.1\r\n", b"Host: localhost\r\n"]
+        steps = [(0, [mock_server_socket]), (3, [mock_client_socket]), (6, [mock_client_socket]),
+                 (HEADER_TIMEOUT, [])]
+
+        timeouts = run_select_loop(serve, steps)
+
+        # the head stays due HEADER_TIMEOUT after connecting while it trickles in
+        self.assertEqual(timeouts, [None, HEADER_TIMEOUT, HEADER_TIMEOUT - 3, HEADER_TIMEOUT - 6, None])
+        mock_client_socket.close.assert_called_once()
+        mock_client_socket.send.assert_not_called()
+        print()
+
+    @patch('select.select')
+    @patch('socket.socket')
+    def test_serve_rejects_over_max_connections(self, mock_socket, mock_select):
+        print('Testing serve with too many clients ...')
+        mock_server_socket = MagicMock()
+        first, second = MagicMock(), MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.side_effect = [(first, ('127.0.0.1', 1)), (second, ('127.0.0.1', 2))]
+        mock_select.side_effect = [([mock_server_socket], [], []), ([mock_server_socket], [], []), KeyboardInterrupt]
+
+        with patch.dict(globals(), MAX_CONNECTIONS=1):
+            serve()
+
+        second.send.assert_called_once_with(BUSY)
+        second.close.assert_called_once()
+        first.close.assert_not_called()
+        self.assertEqual(mock_select.call_args[0][0], [mock_server_socket, first])
+        self.assertTrue(BUSY.startswith(b'HTTP/1.1 503 Service Unavailable\r\n'))
+        print()
+
     def test_get_header(self):
         print('Testing get_header ...')
         data = "GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
@@ -208,6 +608,9 @@ if __name__ == '__main__':
     # Ong
     if len(sys.argv) == 2 and sys.argv[1] == 'run':
         serve()
+    elif len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        bench()
+        sys.exit()
 
     # run unit test to test locally
     # or for domjudge
@@ -1,78 +1,1889 @@
+import contextlib
+import email.utils
+import functools
+import gzip
+import html
+import io
+import json
 import os
+import queue
+import signal
 import socket
+import stat
+import sys
+import tempfile
 import threading
 import select
+import time
+import unittest
+import uuid
+import zlib
+from collections import OrderedDict
+from unittest import mock
+from urllib.parse import parse_qs, quote, unquote, urlencode
 
-config = {}
-with open('httpserver.conf', 'r') as f:
-    for line in f:
-        name, value = line.strip().split('=')
-        config[name] = value
+# the router and turn_away() are shared with the other servers, they live
+# in common/ at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.connections import turn_away
+from common.router import Router
 
-HOST = '' 
-PORT = int(config.get('PORT'))
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CONFIG_FILE = 'httpserver.conf'
+
+def parse_listeners(host, port, listen):
+    """Return the (host, port) addresses to listen on.
+
+    listen is a comma separated list of port, host:port or [ipv6]:port;
+    without it the server listens on host:port only.
+    """
+    if not listen.strip():
+        return ((host, port),)
+    addresses = []
+    for item in listen.split(','):
+        item = item.strip()
+        address, sep, number = item.rpartition(':')
+        if not sep:
+            address = host
+        addresses.append((address.strip('[]'), int(number)))
+    return tuple(addresses)
+
+class Config:
+    """Settings read from httpserver.conf.
+
+    Each line is NAME=value; blank lines and lines starting with # are
+    skipped, unknown names and lines without = are reported and skipped.
+    A reload builds a complete new Config and replaces the global config in
+    one assignment, so code never sees half of an update.
+    """
+
+    SETTINGS = {
+        # addresses to listen on, see parse_listeners()
+        'HOST': (str, ''),
+        'PORT': (int, 8000),
+        'LISTEN': (str, ''),
+        # directory the request paths are looked up in
+        'DOCUMENT_ROOT': (str, '.'),
+        # Worker pool: connections are handed to a fixed number of threads
+        # through a bounded queue; once the queue is full new connections
+        # get a 503
+        'WORKERS': (int, 16),
+        'QUEUE_SIZE': (int, 64),
+        'STATS_INTERVAL': (float, 60),
+        # Persistent connections: how long an idle connection is kept open
+        # and how many requests it may carry before the server closes it
+        'KEEP_ALIVE_TIMEOUT': (float, 5),
+        'MAX_KEEP_ALIVE_REQUESTS': (int, 100),
+        # Requests: the request line and headers together, and bodies, are
+        # limited, and a request must arrive in full within REQUEST_TIMEOUT
+        # seconds of its first byte
+        'MAX_HEADER_SIZE': (int, 16 * 1024),
+        'MAX_BODY_SIZE': (int, 1024 * 1024),
+        'REQUEST_TIMEOUT': (float, 10),
+        # File cache: total bytes of file contents kept in memory, and the
+        # largest file that is cached rather than sent with sendfile()
+        'CACHE_SIZE': (int, 16 * 1024 * 1024),
+        'MAX_CACHED_FILE': (int, 256 * 1024),
+        # Compression: cached files of at least MIN_COMPRESS_SIZE bytes are
+        # sent compressed when that saves at least a tenth of their size
+        'COMPRESS_LEVEL': (int, 6),
+        'MIN_COMPRESS_SIZE': (int, 256),
+        # how many scanned directories are kept for listings
+        'LISTING_CACHE_SIZE': (int, 64),
+    }
+
+    def __init__(self, values=None):
+        values = values or {}
+        for name, (kind, default) in self.SETTINGS.items():
+            try:
+                value = kind(values.get(name, default))
+            except ValueError:
+                raise ValueError(f"{name}={values[name]} is not a valid {kind.__name__}")
+            if kind is not str and value < 0:
+                raise ValueError(f"{name} must not be negative")
+            setattr(self, name, value)
+        if self.WORKERS < 1 or self.QUEUE_SIZE < 1:
+            raise ValueError("WORKERS and QUEUE_SIZE must be at least 1")
+        try:
+            self.LISTENERS = parse_listeners(self.HOST, self.PORT, self.LISTEN)
+        except ValueError:
+            raise ValueError(f"LISTEN={self.LISTEN} is not a list of [host:]port")
+
+    @classmethod
+    def read(cls, path=CONFIG_FILE):
+        values = {}
+        with open(path, 'r') as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                name, sep, value = line.partition('=')
+                name = name.strip()
+                if not sep or name not in cls.SETTINGS:
+                    print(f"{path}:{number}: ignoring {line!r}")
+                    continue
+                values[name] = value.strip()
+        return cls(values)
+
+config = Config.read()
 
 index_file = 'index.html'
 not_found_file = '404.html'
 dataset_dir = 'dataset'
 
-# Read HTML content
-def read_file(file_path):
+RECV_SIZE = 4096
+# read size when a file has to be copied through user space
+FILE_CHUNK_SIZE = 64 * 1024
+# more ranges than this in one request are ignored and the whole file is sent
+MAX_RANGES = 16
+COMPRESS_RATIO = 0.9
+# directory listing pages of more than LISTING_STREAM_THRESHOLD entries are
+# streamed in chunks of LISTING_BATCH entries instead of being built in memory
+LISTING_STREAM_THRESHOLD = 512
+LISTING_BATCH = 256
+
+class ParseError(Exception):
+    """A request the parser rejects, status is the response to send before closing."""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+class Request:
+    __slots__ = ('method', 'path', 'version', 'headers', 'head', 'body')
+
+    def __init__(self, method, path, version, headers, head):
+        self.method = method
+        self.path = path
+        self.version = version
+        # lower-cased names, repeated headers joined with ", "
+        self.headers = headers
+        self.head = head
+        self.body = b''
+
+TOKEN = frozenset(b"!#$%&'*+-.^_`|~0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+class RequestParser:
+    """Incremental HTTP/1.x request parser.
+
+    Bytes are fed in as they arrive and next_request() returns each complete
+    request, pipelined or not, or None until more bytes are needed.  The
+    search for the end of the head resumes where the previous call stopped,
+    so a slowly arriving request is never rescanned from the start.  Bodies
+    are read by Content-Length or chunked transfer coding.  Malformed or
+    oversized input raises ParseError; the connection cannot be used after
+    that.
+    """
+
+    def __init__(self, max_header_size=None, max_body_size=None):
+        self.max_header_size = max_header_size or config.MAX_HEADER_SIZE
+        self.max_body_size = max_body_size or config.MAX_BODY_SIZE
+        self.buffer = bytearray()
+        # bytes of buffer consumed by the request being parsed
+        self.pos = 0
+        self.reset()
+
+    def reset(self):
+        self.state = 'head'
+        # where the search for the end of the head resumes
+        self.scanned = self.pos
+        self.request = None
+        self.remaining = 0
+        self.body = []
+        self.body_size = 0
+        self.trailer_size = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        while True:
+            if self.state == 'head':
+                # empty lines before a request line are skipped
+                while self.buffer.startswith(b'\r\n', self.pos):
+                    self.pos += 2
+                self.scanned = max(self.scanned, self.pos)
+                end = self.buffer.find(b'\r\n\r\n', self.scanned)
+                if end == -1:
+                    if len(self.buffer) - self.pos > self.max_header_size:
+                        raise ParseError("431 Request Header Fields Too Large")
+                    # the next search starts where this one stopped, less
+                    # the part of a terminator that may already be here
+                    self.scanned = max(self.pos, len(self.buffer) - 3)
+                    return None
+                if end - self.pos > self.max_header_size:
+                    raise ParseError("431 Request Header Fields Too Large")
+                self.parse_head(bytes(self.buffer[self.pos:end]))
+                self.pos = end + 4
+            elif self.state == 'body':
+                if not self.read_data():
+                    return None
+                self.state = 'done'
+            elif self.state == 'chunk size':
+                line = self.read_line(1024, "400 Bad Request")
+                if line is None:
+                    return None
+                size = line.split(b';', 1)[0].strip()
+                if not size or any(c not in b'0123456789abcdefABCDEF' for c in size):
+                    raise ParseError("400 Bad Request")
+                self.remaining = int(size, 16)
+                self.state = 'chunk data' if self.remaining else 'trailers'
+            elif self.state == 'chunk data':
+                if not self.read_data():
+                    return None
+                line = self.read_line(2, "400 Bad Request")
+                if line is None:
+                    return None
+                if line:
+                    raise ParseError("400 Bad Request")
+                self.state = 'chunk size'
+            elif self.state == 'trailers':
+                # the trailer section as a whole is held to the head's limit
+                line = self.read_line(self.max_header_size - self.trailer_size, "431 Request Header Fields Too Large")
+                if line is None:
+                    return None
+                self.trailer_size += len(line) + 2
+                if self.trailer_size > self.max_header_size:
+                    raise ParseError("431 Request Header Fields Too Large")
+                if not line:
+                    self.state = 'done'
+            else:
+                request = self.request
+                request.body = b''.join(self.body)
+                # drop the consumed bytes once per request, not per read
+                del self.buffer[:self.pos]
+                self.pos = 0
+                self.reset()
+                return request
+
+    def read_line(self, limit, status):
+        """Return the next line without its line ending, None if it is incomplete.
+
+        A line longer than limit bytes raises ParseError(status).
+        """
+        end = self.buffer.find(b'\n', self.pos, self.pos + limit + 2)
+        if end == -1:
+            if len(self.buffer) - self.pos > limit + 1:
+                raise ParseError(status)
+            return None
+        line = bytes(self.buffer[self.pos:end])
+        self.pos = end + 1
+        return line[:-1] if line.endswith(b'\r') else line
+
+    def read_data(self):
+        """Move up to self.remaining body bytes out of the buffer, return True once all are in."""
+        available = min(self.remaining, len(self.buffer) - self.pos)
+        if available:
+            self.body_size += available
+            if self.body_size > self.max_body_size:
+                raise ParseError("413 Content Too Large")
+            self.body.append(bytes(self.buffer[self.pos:self.pos + available]))
+            self.pos += available
+            self.remaining -= available
+        return not self.remaining
+
+    def parse_head(self, head):
+        lines = head.split(b'\r\n')
+        parts = lines[0].split(b' ')
+        if len(parts) != 3 or not parts[0] or not parts[1] or not set(parts[0]) <= TOKEN:
+            raise ParseError("400 Bad Request")
+        method, path, version = (part.decode('latin-1') for part in parts)
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            if not version.startswith('HTTP/'):
+                raise ParseError("400 Bad Request")
+            raise ParseError("505 HTTP Version Not Supported")
+
+        headers = {}
+        lengths = set()
+        for line in lines[1:]:
+            name, sep, value = line.partition(b':')
+            # a name must be a token; this also rejects obsolete line folding
+            if not sep or not name or not set(name) <= TOKEN:
+                raise ParseError("400 Bad Request")
+            name = name.decode('latin-1').lower()
+            value = value.strip().decode('latin-1')
+            if name == 'content-length':
+                lengths.add(value)
+            headers[name] = headers[name] + ', ' + value if name in headers else value
+        self.request = Request(method, path, version, headers, head.decode('latin-1'))
+
+        if 'transfer-encoding' in headers:
+            # with both, a front end and this server could disagree on where the body ends
+            if lengths:
+                raise ParseError("400 Bad Request")
+            if headers['transfer-encoding'].lower() != 'chunked':
+                raise ParseError("501 Not Implemented")
+            self.state = 'chunk size'
+        elif lengths:
+            length = lengths.pop()
+            if lengths or not length.isdigit():
+                raise ParseError("400 Bad Request")
+            if int(length) > self.max_body_size:
+                raise ParseError("413 Content Too Large")
+            self.remaining = int(length)
+            self.state = 'body'
+        else:
+            self.state = 'done'
+
+def wants_keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+def response_head(status, content_type, length, extra_headers=""):
+    """The status line and headers of a response, up to the Connection header."""
+    return f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {length}\r\n{extra_headers}".encode()
+
+def build_header(status, content_type, length, keep_alive, served=0, extra_headers=""):
+    return response_head(status, content_type, length, extra_headers) + connection_header(keep_alive, served)
+
+def connection_header(keep_alive, served=0):
+    """The Connection header lines and the blank line that ends the head."""
+    if keep_alive:
+        remaining = config.MAX_KEEP_ALIVE_REQUESTS - served
+        return f"Connection: keep-alive\r\nKeep-Alive: timeout={config.KEEP_ALIVE_TIMEOUT:g}, max={remaining}\r\n\r\n".encode()
+    return b"Connection: close\r\n\r\n"
+
+def build_response(status, content_type, body, keep_alive, served=0, extra_headers=""):
+    if isinstance(body, str):
+        body = body.encode()
+    return build_header(status, content_type, len(body), keep_alive, served, extra_headers) + body
+
+def open_regular_file(file_path):
+    """Open file_path for reading if it is a regular file, return (file, stat) or None."""
     try:
-        with open(file_path, 'r') as f:
-            return f.read()
-    except FileNotFoundError:
-        return None
-
-index_content = read_file(index_file)
-not_found_content = read_file(not_found_file)
-
-def handle_client(client_socket):
-    request = client_socket.recv(1024).decode()
-    print(f"Request:\n{request}")
-
-    if request:
-        lines = request.split('\n')
-        if lines:
-            request_line = lines[0]
-            parts = request_line.split()
-            if len(parts) >= 2:
-                method, path = parts[0], parts[1]
-                if method == 'GET':
-                    if path == '/':
-                        response = f"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n{index_content}"
-                    elif os.path.isfile('.' + path):
-                        file_path = '.' + path
-                        with open(file_path, 'rb') as f:
-                            file_content = f.read()
-                        response = f"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n\r\n".encode() + file_content
-                    elif os.path.isdir('.' + path):
-                        dir_path = '.' + path
-                        dir_listing = '\n'.join(os.listdir(dir_path))
-                        response = f"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n{dir_listing}"
-                    else:
-                        response = f"HTTP/1.1 404 Not Found\r\nContent-Type: text/html\r\n\r\n{not_found_content}"
-                    
-                    client_socket.sendall(response.encode() if isinstance(response, str) else response)
-    
-    client_socket.close()
+        f = open(file_path, 'rb')
+    except OSError:
+        return None
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        f.close()
+        return None
+    return f, st
+
+def send_file(client_socket, f, offset, count):
+    """Send count bytes of f starting at offset, return how many were sent.
+
+    Uses sendfile() so the data goes from the page cache to the socket
+    without passing through Python; where that is unavailable the file is
+    copied in FILE_CHUNK_SIZE pieces, so memory use does not grow with the
+    file size either way.
+    """
+    if hasattr(os, 'sendfile'):
+        return client_socket.sendfile(f, offset, count)
+    f.seek(offset)
+    sent = 0
+    while sent < count:
+        chunk = f.read(min(FILE_CHUNK_SIZE, count - sent))
+        if not chunk:
+            break
+        client_socket.sendall(chunk)
+        sent += len(chunk)
+    return sent
+
+def file_validators(st):
+    """Return the strong ETag of a file and its ETag/Last-Modified header lines."""
+    etag = f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"'
+    last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+    return etag, f"ETag: {etag}\r\nLast-Modified: {last_modified}\r\n"
+
+def not_modified(headers, etag, mtime):
+    """Whether the conditional headers of a GET say the client's copy is current."""
+    if 'if-none-match' in headers:
+        tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+        # GET uses the weak comparison, W/"x" matches "x"
+        return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+    since = headers.get('if-modified-since')
+    if since:
+        try:
+            since = email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+def parse_ranges(value, size):
+    """Parse a Range header against a file of size bytes.
+
+    Returns a sorted list of inclusive (first, last) byte positions with
+    overlapping ranges merged, an empty list when no range is satisfiable,
+    or None when the header is malformed and should be ignored.
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for part in spec.split(','):
+        first, dash, last = part.strip().partition('-')
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # suffix range: the last N bytes
+            if int(last) and size:
+                ranges.append((max(0, size - int(last)), size - 1))
+            continue
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def if_range_matches(headers, etag, mtime):
+    """Whether a Range request applies, i.e. any If-Range names the current file."""
+    if_range = headers.get('if-range')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # If-Range needs the strong comparison
+        return if_range == etag
+    try:
+        return email.utils.parsedate_to_datetime(if_range).timestamp() == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+def range_response(file_path, content_type, value, keep_alive, served):
+    """Return a 206 or 416 response for a Range request, or None to send the whole file.
+
+    The selected parts are sent from the file with sendfile() offsets;
+    several ranges go out as one multipart/byteranges body.
+    """
+    opened = open_regular_file(file_path)
+    if opened is None:
+        return None
+    f, st = opened
+    size = st.st_size
+    ranges = parse_ranges(value, size)
+    if ranges is None:
+        f.close()
+        return None
+    if not ranges:
+        f.close()
+        return build_response("416 Range Not Satisfiable", "text/plain", b"", keep_alive, served,
+                              f"Content-Range: bytes */{size}\r\n"), None
+
+    validators = file_validators(st)[1] + "Accept-Ranges: bytes\r\n"
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        extra = validators + f"Content-Range: bytes {start}-{end}/{size}\r\n"
+        head = build_header("206 Partial Content", content_type, end - start + 1, keep_alive, served, extra)
+        return head, (f, [(start, end - start + 1)])
+
+    boundary = uuid.uuid4().hex
+    pieces = []
+    length = 0
+    for start, end in ranges:
+        part_head = (f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+        pieces += [part_head, (start, end - start + 1), b"\r\n"]
+        length += len(part_head) + end - start + 1 + 2
+    pieces.append(f"--{boundary}--\r\n".encode())
+    length += len(pieces[-1])
+    head = build_header("206 Partial Content", f"multipart/byteranges; boundary={boundary}", length,
+                        keep_alive, served, validators)
+    return head, (f, pieces)
+
+ENCODERS = {
+    'gzip': lambda data: gzip.compress(data, config.COMPRESS_LEVEL, mtime=0),
+    'deflate': lambda data: zlib.compress(data, config.COMPRESS_LEVEL),
+}
+if zstandard is not None:
+    # zstd levels run from 1 to MAX_COMPRESSION_LEVEL rather than gzip's 0 to 9
+    ENCODERS['zstd'] = lambda data: zstandard.ZstdCompressor(
+        level=max(1, min(config.COMPRESS_LEVEL, zstandard.MAX_COMPRESSION_LEVEL))).compress(data)
+# preferred first when the client accepts several equally
+ENCODINGS = tuple(name for name in ('zstd', 'gzip', 'deflate') if name in ENCODERS)
+
+@functools.lru_cache(maxsize=256)
+def accepted_encodings(accept_encoding):
+    """Parse an Accept-Encoding header into {coding: q}."""
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name] = weight
+    return weights
+
+def choose_encoding(headers, available=ENCODINGS):
+    """Return the best of the available content codings the client accepts, None for identity."""
+    accept_encoding = headers.get('accept-encoding')
+    if not accept_encoding:
+        return None
+    weights = accepted_encodings(accept_encoding)
+    best, best_weight = None, 0.0
+    for name in available:
+        weight = weights.get(name, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = name, weight
+    return best
+
+def variant_etag(etag, encoding):
+    return f'{etag[:-1]}-{encoding}"'
+
+class CachedFile:
+    __slots__ = ('head', 'body', 'mtime', 'size', 'etag', 'validators', 'variants')
+
+    def __init__(self, head, body, st, etag=None, validators=""):
+        # response head up to, not including, the Connection header
+        self.head = head
+        self.body = body
+        self.mtime = st.st_mtime_ns
+        self.size = st.st_size
+        self.etag = etag
+        self.validators = validators
+        # content coding -> compressed CachedFile, or None where compressing does not pay
+        self.variants = {}
+
+    def cost(self):
+        return len(self.body) + sum(len(variant.body) for variant in self.variants.values() if variant)
+
+class FileCache:
+    """LRU of small files and their response heads, limited to capacity bytes.
+
+    Entries are checked against a fresh os.stat on every lookup, so a file
+    that is edited or replaced is read again on its next request.  The
+    compressed variants of a file are kept on its entry and count against
+    the same budget.
+    """
+
+    def __init__(self, capacity, max_file):
+        self.capacity = capacity
+        self.max_file = max_file
+        self.entries = OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compressions = 0
+
+    def lookup(self, key, st):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if entry is not None:
+                self.discard(key)
+        return None
+
+    def store(self, key, entry):
+        if len(entry.body) > self.capacity:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.discard(key)
+            self.entries[key] = entry
+            self.used += entry.cost()
+            self.evict()
+
+    def add_variant(self, key, entry, encoding, variant):
+        with self.lock:
+            if encoding in entry.variants:
+                return
+            entry.variants[encoding] = variant
+            if variant is not None:
+                self.compressions += 1
+            # an entry dropped or replaced meanwhile is no longer counted
+            if self.entries.get(key) is entry and variant is not None:
+                self.used += len(variant.body)
+                self.evict()
+
+    def resize(self, capacity, max_file):
+        with self.lock:
+            self.capacity = capacity
+            self.max_file = max_file
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+    def evict(self):
+        while self.used > self.capacity:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, key):
+        self.used -= self.entries.pop(key).cost()
+
+    def report(self):
+        with self.lock:
+            return (f"File cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+                    f"{self.compressions} compressed, {len(self.entries)} files, {self.used} bytes")
+
+file_cache = FileCache(config.CACHE_SIZE, config.MAX_CACHED_FILE)
+
+def under_root(real_path):
+    """Whether a path with symlinks already resolved is DOCUMENT_ROOT or inside it."""
+    root = os.path.realpath(config.DOCUMENT_ROOT)
+    return real_path == root or real_path.startswith(os.path.join(root, ''))
+
+def resolve_path(path):
+    """Map a decoded request path to a file system path, None if it leads outside DOCUMENT_ROOT.
+
+    .. segments and symlinks are resolved before the check, so neither
+    can be used to reach files elsewhere.
+    """
+    real_path = os.path.realpath(os.path.join(config.DOCUMENT_ROOT, path.lstrip('/')))
+    return real_path if under_root(real_path) else None
+
+def open_sibling(file_path, st):
+    """Open the precompressed file_path.gz if it is at least as new as the file."""
+    # the .gz may be a symlink of its own
+    if not under_root(os.path.realpath(file_path + '.gz')):
+        return None
+    opened = open_regular_file(file_path + '.gz')
+    if opened is not None and opened[1].st_mtime_ns < st.st_mtime_ns:
+        opened[0].close()
+        return None
+    return opened
+
+def load_file(key, validated):
+    """Read a small file into a CachedFile and cache it, None if it is gone."""
+    file_path, status, content_type = key
+    opened = open_regular_file(file_path)
+    if opened is None:
+        return None
+    f, st = opened
+    with f:
+        body = f.read(st.st_size)
+    etag, validators, extra = None, "", ""
+    if validated:
+        etag, validators = file_validators(st)
+        extra = validators + "Accept-Ranges: bytes\r\nVary: Accept-Encoding\r\n"
+    entry = CachedFile(response_head(status, content_type, len(body), extra), body, st, etag, validators)
+    # a file written to while it is read is not cached
+    if len(body) == st.st_size:
+        file_cache.store(key, entry)
+    return entry
+
+def compressed_variant(key, entry, encoding):
+    """Return entry compressed with encoding as a CachedFile, None when identity is the better choice.
+
+    A gzip variant comes from a precompressed .gz sibling when there is one.
+    Either way it is made once per file version and kept on the entry.
+    """
+    if encoding in entry.variants:
+        return entry.variants[encoding]
+    file_path, status, content_type = key
+    body = None
+    if encoding == 'gzip':
+        opened = open_sibling(file_path, os.stat(file_path))
+        if opened is not None:
+            f, gz_st = opened
+            with f:
+                body = f.read(gz_st.st_size)
+    if body is None and len(entry.body) >= config.MIN_COMPRESS_SIZE:
+        body = ENCODERS[encoding](entry.body)
+        if len(body) > len(entry.body) * COMPRESS_RATIO:
+            body = None
+    variant = None
+    if body is not None:
+        etag = variant_etag(entry.etag, encoding)
+        validators = entry.validators.replace(entry.etag, etag, 1)
+        extra = validators + f"Content-Encoding: {encoding}\r\nVary: Accept-Encoding\r\n"
+        head = response_head(status, content_type, len(body), extra)
+        variant = CachedFile(head, body, os.stat(file_path), etag, validators)
+    file_cache.add_variant(key, entry, encoding, variant)
+    return variant
+
+def not_modified_response(validators, keep_alive, served):
+    return b"HTTP/1.1 304 Not Modified\r\n" + validators.encode() + connection_header(keep_alive, served)
+
+def file_response(file_path, status, content_type, keep_alive, served, headers=None):
+    """Return a response for a regular file as get_response() does, or None if there is no such file.
+
+    With the request headers given the response carries ETag and
+    Last-Modified, a 304 is returned when the client's copy is current,
+    Range requests are honoured and the body is compressed as the client
+    accepts.
+    """
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+
+    key = (file_path, status, content_type)
+    entry = None
+    if st.st_size <= file_cache.max_file:
+        entry = file_cache.lookup(key, st) or load_file(key, headers is not None)
+        if entry is None:
+            return None
+    if headers is None:
+        if entry is not None:
+            return entry.head + connection_header(keep_alive, served) + entry.body, None
+        opened = open_regular_file(file_path)
+        if opened is None:
+            return None
+        f, st = opened
+        return build_header(status, content_type, st.st_size, keep_alive, served), (f, [(0, st.st_size)])
+
+    if entry is not None:
+        etag, validators = entry.etag, entry.validators
+    else:
+        etag, validators = file_validators(st)
+
+    if 'range' in headers:
+        # ranges always refer to the uncompressed file
+        if not_modified(headers, etag, st.st_mtime):
+            return not_modified_response(validators, keep_alive, served), None
+        if if_range_matches(headers, etag, st.st_mtime):
+            response = range_response(file_path, content_type, headers['range'], keep_alive, served)
+            if response is not None:
+                return response
+    elif entry is not None:
+        encoding = choose_encoding(headers)
+        if encoding is not None:
+            entry = compressed_variant(key, entry, encoding) or entry
+    elif choose_encoding(headers, ('gzip',)):
+        # too big to cache, but a precompressed copy can be sent as it is
+        opened = open_sibling(file_path, st)
+        if opened is not None:
+            f, gz_st = opened
+            validators = validators.replace(etag, variant_etag(etag, 'gzip'), 1)
+            if not_modified(headers, variant_etag(etag, 'gzip'), st.st_mtime):
+                f.close()
+                return not_modified_response(validators, keep_alive, served), None
+            extra = validators + "Content-Encoding: gzip\r\nVary: Accept-Encoding\r\n"
+            return build_header(status, content_type, gz_st.st_size, keep_alive, served, extra), (f, [(0, gz_st.st_size)])
+
+    if entry is not None:
+        if not_modified(headers, entry.etag, st.st_mtime):
+            return not_modified_response(entry.validators, keep_alive, served), None
+        return entry.head + connection_header(keep_alive, served) + entry.body, None
+
+    if not_modified(headers, etag, st.st_mtime):
+        return not_modified_response(validators, keep_alive, served), None
+    opened = open_regular_file(file_path)
+    if opened is None:
+        return None
+    f, st = opened
+    extra = file_validators(st)[1] + "Accept-Ranges: bytes\r\nVary: Accept-Encoding\r\n"
+    return build_header(status, content_type, st.st_size, keep_alive, served, extra), (f, [(0, st.st_size)])
+
+class DirectoryListing:
+    __slots__ = ('mtime', 'entries', 'orders')
+
+    def __init__(self, mtime, entries):
+        self.mtime = mtime
+        # (name, is_dir, size, mtime) in directory order
+        self.entries = entries
+        # (sort key, descending) -> sorted entries, made when first asked for
+        self.orders = {}
+
+    def sorted(self, key, descending):
+        order = self.orders.get((key, descending))
+        if order is None:
+            index = LISTING_SORT_KEYS[key]
+            order = sorted(self.entries, key=lambda entry: (entry[index], entry[0]), reverse=descending)
+            self.orders[(key, descending)] = order
+        return order
+
+LISTING_SORT_KEYS = {'name': 0, 'size': 2, 'mtime': 3}
+
+class DirectoryCache:
+    """LRU of scanned directories, each rescanned once the directory's mtime changes.
+
+    Adding, removing or renaming an entry changes the directory's mtime;
+    the sizes and times of entries are as of the last scan.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def resize(self, capacity):
+        with self.lock:
+            self.capacity = capacity
+            while len(self.listings) > capacity:
+                self.listings.popitem(last=False)
+
+    def get(self, dir_path, st):
+        with self.lock:
+            listing = self.listings.get(dir_path)
+            if listing is not None and listing.mtime == st.st_mtime_ns:
+                self.listings.move_to_end(dir_path)
+                return listing
+        listing = DirectoryListing(st.st_mtime_ns, scan_directory(dir_path))
+        with self.lock:
+            self.listings[dir_path] = listing
+            self.listings.move_to_end(dir_path)
+            while len(self.listings) > self.capacity:
+                self.listings.popitem(last=False)
+        return listing
+
+def scan_directory(dir_path):
+    entries = []
+    with os.scandir(dir_path) as it:
+        for entry in it:
+            try:
+                st = entry.stat()
+                is_dir = entry.is_dir()
+            except OSError:
+                # removed while scanning, or a dangling symlink
+                continue
+            entries.append((entry.name, is_dir, 0 if is_dir else st.st_size, int(st.st_mtime)))
+    return entries
+
+directory_cache = DirectoryCache(config.LISTING_CACHE_SIZE)
+
+def encode_listing(fmt, url_path, page, total, offset, limit, links=()):
+    """Yield a listing page as encoded chunks of up to LISTING_BATCH entries.
+
+    links are (label, query) pairs for the previous/next page links of the
+    html format.
+    """
+    if fmt == 'json':
+        yield f'{{"path": {json.dumps(url_path)}, "total": {total}, "offset": {offset}, "limit": {json.dumps(limit)}, "entries": ['.encode()
+        separator = ''
+        for start in range(0, len(page), LISTING_BATCH):
+            items = []
+            for name, is_dir, size, mtime in page[start:start + LISTING_BATCH]:
+                items.append(json.dumps({'name': name, 'type': 'directory' if is_dir else 'file',
+                                         'size': size, 'mtime': mtime}))
+            yield (separator + ', '.join(items)).encode()
+            separator = ', '
+        yield b']}'
+    elif fmt == 'html':
+        title = html.escape(url_path)
+        yield (f'<!DOCTYPE html>\n<html lang="en">\n<head><meta charset="UTF-8"><title>Index of {title}</title></head>\n'
+               f'<body>\n<h1>Index of {title}</h1>\n<table>\n<tr><th>Name</th><th>Size</th><th>Modified</th></tr>\n').encode()
+        base = url_path.rstrip('/') + '/'
+        for start in range(0, len(page), LISTING_BATCH):
+            rows = []
+            for name, is_dir, size, mtime in page[start:start + LISTING_BATCH]:
+                label = name + '/' if is_dir else name
+                modified = time.strftime('%Y-%m-%d %H:%M', time.gmtime(mtime))
+                rows.append(f'<tr><td><a href="{quote(base + label)}">{html.escape(label)}</a></td>'
+                            f'<td>{"-" if is_dir else size}</td><td>{modified}</td></tr>\n')
+            yield ''.join(rows).encode()
+        anchors = ' '.join(f'<a href="?{html.escape(query)}">{label}</a>' for label, query in links)
+        yield f'</table>\n<p>{anchors}</p>\n</body>\n</html>\n'.encode()
+    else:
+        separator = ''
+        for start in range(0, len(page), LISTING_BATCH):
+            yield (separator + '\n'.join(entry[0] for entry in page[start:start + LISTING_BATCH])).encode()
+            separator = '\n'
+
+def chunked(chunks):
+    """Frame chunks for Transfer-Encoding: chunked."""
+    for chunk in chunks:
+        if chunk:
+            yield b'%x\r\n' % len(chunk) + chunk + b'\r\n'
+    yield b'0\r\n\r\n'
+
+LISTING_TYPES = {'text': 'text/plain', 'json': 'application/json', 'html': 'text/html; charset=utf-8'}
+
+def listing_response(dir_path, url_path, query, version, headers, keep_alive, served):
+    """Return a directory listing page as get_response() does.
+
+    The query selects the page (offset, limit), the order (sort=name, size
+    or mtime, order=asc or desc) and the format (format=text, json or html;
+    json is also chosen by Accept: application/json).
+    """
+    try:
+        st = os.stat(dir_path)
+        listing = directory_cache.get(dir_path, st)
+    except OSError:
+        return None
+    params = parse_qs(query)
+    fmt = params.get('format', ['json' if 'application/json' in headers.get('accept', '') else 'text'])[0]
+    sort = params.get('sort', ['name'])[0]
+    try:
+        offset = int(params.get('offset', ['0'])[0])
+        limit = int(params['limit'][0]) if 'limit' in params else None
+    except ValueError:
+        offset = limit = -1
+    if fmt not in LISTING_TYPES or sort not in LISTING_SORT_KEYS or offset < 0 or (limit is not None and limit < 0):
+        return build_response("400 Bad Request", "text/plain", "Bad Request", keep_alive, served), None
+
+    entries = listing.sorted(sort, params.get('order', ['asc'])[0] == 'desc')
+    page = entries[offset:offset + limit if limit is not None else None]
+    links = []
+    if limit:
+        if offset > 0:
+            links.append(('previous', urlencode({**params, 'offset': max(0, offset - limit)}, doseq=True)))
+        if offset + limit < len(entries):
+            links.append(('next', urlencode({**params, 'offset': offset + limit}, doseq=True)))
+    chunks = encode_listing(fmt, url_path, page, len(entries), offset, limit, links)
+    content_type = LISTING_TYPES[fmt]
+    # HTTP/1.0 has no chunked encoding, it gets the page in one piece
+    if len(page) <= LISTING_STREAM_THRESHOLD or version != 'HTTP/1.1':
+        return build_response("200 OK", content_type, b''.join(chunks), keep_alive, served), None
+    head = (f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nTransfer-Encoding: chunked\r\n".encode()
+            + connection_header(keep_alive, served))
+    return head, (None, [chunked(chunks)])
+
+router = Router()
+
+@router.route('GET', '/')
+def index_page(path, query, version, headers, keep_alive, served):
+    return file_response(os.path.join(config.DOCUMENT_ROOT, index_file), "200 OK", "text/html",
+                         keep_alive, served, headers)
+
+@router.route('GET', '/<rest:path>')
+def document(path, query, version, headers, keep_alive, served, rest):
+    """A file under the document root, or a listing if it is a directory."""
+    file_path = resolve_path(path)
+    if file_path is None:
+        return None
+    response = None
+    # resolving drops a trailing slash, which only a directory may have
+    if not path.endswith('/'):
+        response = file_response(file_path, "200 OK", "application/octet-stream", keep_alive, served, headers)
+    if response is None and os.path.isdir(file_path):
+        response = listing_response(file_path, path, query, version, headers, keep_alive, served)
+    return response
+
+def get_response(method, path, version, headers, keep_alive, served):
+    """Return the response head (or whole response) and the rest of the body, if any.
+
+    The rest is an open file (or None) and a list of pieces to send in
+    order: bytes, (offset, count) to send from the file, or an iterable of
+    bytes.  Routes return None for a missing resource, which gets the 404
+    page.  HEAD is answered by the GET route; leaving out the body is up
+    to the caller.
+    """
+    path, _, query = path.partition('?')
+    path = unquote(path)
+    if '\0' in path:
+        return build_response("400 Bad Request", "text/plain", "Bad Request", False), None
+    # a path that decodes to somewhere outside the document root is missing
+    # whatever route it would match
+    inside = resolve_path(path) is not None
+    match = router.match(method, path) if inside else None
+    allowed = router.allowed(path) if match is None and inside else None
+    if allowed:
+        return build_response("405 Method Not Allowed", "text/plain", "Method Not Allowed", False, 0,
+                              f"Allow: {', '.join(sorted(allowed))}\r\n"), None
+    if match is not None:
+        handler, params = match
+        response = handler(path, query, version, headers, keep_alive, served, **params)
+        if response is not None:
+            return response
+    response = file_response(os.path.join(config.DOCUMENT_ROOT, not_found_file), "404 Not Found", "text/html",
+                             keep_alive, served)
+    if response is not None:
+        return response
+    return build_response("404 Not Found", "text/plain", "404 Not Found", keep_alive, served), None
+
+def send_pieces(client_socket, f, pieces):
+    """Send the rest of a body as returned by get_response(), return False if it came out short."""
+    with f or contextlib.nullcontext():
+        for piece in pieces:
+            if isinstance(piece, bytes):
+                client_socket.sendall(piece)
+                continue
+            if not isinstance(piece, tuple):
+                for chunk in piece:
+                    client_socket.sendall(chunk)
+                continue
+            offset, count = piece
+            # a file truncated while it is sent leaves the body short of its
+            # Content-Length, the connection cannot be reused
+            if send_file(client_socket, f, offset, count) < count:
+                return False
+    return True
+
+def handle_client(client_socket, pool=None):
+    client_socket.settimeout(config.KEEP_ALIVE_TIMEOUT)
+    # the head, file data and multipart boundaries are separate writes, Nagle
+    # would hold back the small ones until the previous write is acknowledged
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    parser = RequestParser()
+    served = 0
+    # when the request being read must be complete, None between requests
+    deadline = None
+    try:
+        while served < config.MAX_KEEP_ALIVE_REQUESTS:
+            try:
+                request = parser.next_request()
+            except ParseError as e:
+                client_socket.sendall(build_response(e.status, "text/plain", e.status, False))
+                break
+            if request is None:
+                # the timeout alone applies to each recv(), a client trickling
+                # in a byte at a time would hold the worker for good
+                timeout = config.KEEP_ALIVE_TIMEOUT
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.monotonic())
+                try:
+                    if timeout <= 0:
+                        raise socket.timeout
+                    client_socket.settimeout(timeout)
+                    data = client_socket.recv(RECV_SIZE)
+                except socket.timeout:
+                    # an idle connection is just closed
+                    if deadline is not None:
+                        client_socket.sendall(build_response("408 Request Timeout", "text/plain",
+                                                             "408 Request Timeout", False))
+                    break
+                if not data:
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + config.REQUEST_TIMEOUT
+                parser.feed(data)
+                continue
+            deadline = None
+            client_socket.settimeout(config.KEEP_ALIVE_TIMEOUT)
+            print(f"Request:\n{request.head}")
+            method, path, version, headers = request.method, request.path, request.version, request.headers
+
+            served += 1
+            keep_alive = wants_keep_alive(version, headers) and served < config.MAX_KEEP_ALIVE_REQUESTS
+            # an idle keep-alive connection would hold its worker while others queue
+            if pool is not None and pool.backlog():
+                keep_alive = False
+            response, body_file = get_response(method, path, version, headers, keep_alive, served)
+            if method == 'HEAD':
+                # the GET response's head, Content-Length and all, without its body
+                response = response[:response.index(b'\r\n\r\n') + 4]
+                if body_file is not None and body_file[0] is not None:
+                    body_file[0].close()
+                body_file = None
+            client_socket.sendall(response)
+            if body_file is not None and not send_pieces(client_socket, *body_file):
+                break
+            if not keep_alive or method not in ('GET', 'HEAD'):
+                break
+    except (ConnectionError, socket.timeout):
+        pass
+    finally:
+        client_socket.close()
+
+class WorkerPool:
+    def __init__(self, workers, queue_size):
+        self.connections = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        # queue wait of the connections taken since the last report
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.rejected = 0
+        self.workers = 0
+        # workers to stop once they finish their current connection
+        self.retiring = 0
+        self.resize(workers, queue_size)
+
+    def resize(self, workers, queue_size):
+        with self.connections.mutex:
+            self.connections.maxsize = queue_size
+        with self.lock:
+            added = workers - self.workers
+            self.workers = workers
+            if added < 0:
+                self.retiring -= added
+            else:
+                # cancel pending retirements first
+                cancelled = min(added, self.retiring)
+                self.retiring -= cancelled
+                added -= cancelled
+        for _ in range(max(0, added)):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, client_socket):
+        """Queue a connection for the workers, return False when the queue is full."""
+        try:
+            self.connections.put_nowait((client_socket, time.monotonic()))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+
+    def backlog(self):
+        return self.connections.qsize()
+
+    def work(self):
+        while True:
+            client_socket, queued = self.connections.get()
+            wait = time.monotonic() - queued
+            with self.lock:
+                self.waited += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                handle_client(client_socket, self)
+            except Exception as e:
+                print(f"Worker error: {e}")
+                client_socket.close()
+            with self.lock:
+                if self.retiring:
+                    self.retiring -= 1
+                    return
+
+    def report(self):
+        """Return a summary of the queue wait since the last report and reset it, None when idle."""
+        with self.lock:
+            if not self.waited and not self.rejected:
+                return None
+            average = self.total_wait / self.waited if self.waited else 0.0
+            summary = (f"Pool: {self.waited} served, queue wait avg {average * 1000:.1f} ms "
+                       f"max {self.max_wait * 1000:.1f} ms, {self.rejected} rejected, {self.backlog()} queued")
+            self.waited = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+            self.rejected = 0
+        return summary
+
+def reject_busy(client_socket):
+    turn_away(client_socket, build_response("503 Service Unavailable", "text/plain", "Service Unavailable", False,
+                                            extra_headers="Retry-After: 1\r\n"))
+
+def open_listeners(addresses, listeners):
+    """Return {address: listening socket} for addresses, reusing those in listeners.
+
+    If any new address cannot be bound the sockets opened here are closed
+    and the error is raised, so the caller can keep its current listeners.
+    """
+    opened = {}
+    try:
+        for address in addresses:
+            if address in listeners or address in opened:
+                continue
+            family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+            server_socket = socket.socket(family, socket.SOCK_STREAM)
+            opened[address] = server_socket
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind(address)
+            server_socket.listen(config.QUEUE_SIZE)
+    except OSError:
+        for server_socket in opened.values():
+            server_socket.close()
+        raise
+    return {address: opened.get(address) or listeners[address] for address in addresses}
+
+def reload_config(pool, listeners):
+    """Reread the config file and apply it, return the listeners to use from now on.
+
+    Connections already accepted carry on; listeners that are no longer
+    configured are closed.  A config that cannot be read, or names an
+    address that cannot be bound, leaves everything as it was.
+    """
+    global config
+    try:
+        new = Config.read()
+        new_listeners = open_listeners(new.LISTENERS, listeners)
+    except (OSError, ValueError) as e:
+        print(f"Config reload failed, keeping the current config: {e}")
+        return listeners
+
+    old, config = config, new
+    for address, server_socket in listeners.items():
+        if address not in new_listeners:
+            server_socket.close()
+    pool.resize(new.WORKERS, new.QUEUE_SIZE)
+    if (new.DOCUMENT_ROOT, new.COMPRESS_LEVEL, new.MIN_COMPRESS_SIZE) != (old.DOCUMENT_ROOT, old.COMPRESS_LEVEL, old.MIN_COMPRESS_SIZE):
+        file_cache.clear()
+    file_cache.resize(new.CACHE_SIZE, new.MAX_CACHED_FILE)
+    directory_cache.resize(new.LISTING_CACHE_SIZE)
+    print(f"Config reloaded, listening on {format_addresses(new_listeners)} with {new.WORKERS} workers")
+    return new_listeners
+
+def format_addresses(listeners):
+    return ', '.join(f"{host or '*'}:{port}" for host, port in listeners)
 
 def main():
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen(5)
-    print(f"Serving HTTP on port {PORT}...")
+    listeners = open_listeners(config.LISTENERS, {})
+    print(f"Serving HTTP on {format_addresses(listeners)} with {config.WORKERS} workers...")
+
+    pool = WorkerPool(config.WORKERS, config.QUEUE_SIZE)
+    # SIGHUP reloads the config; the handler does nothing itself, the signal
+    # number written to the wakeup socket wakes select() and is handled here
+    wakeup, wakeup_write = socket.socketpair()
+    wakeup.setblocking(False)
+    wakeup_write.setblocking(False)
+    signal.set_wakeup_fd(wakeup_write.fileno())
+    signal.signal(signal.SIGHUP, lambda signum, frame: None)
 
-    inputs = [server_socket]
+    next_report = time.monotonic() + config.STATS_INTERVAL
     while True:
-        readable, writable, exceptional = select.select(inputs, [], inputs)
+        inputs = list(listeners.values()) + [wakeup]
+        readable, writable, exceptional = select.select(inputs, [], inputs, config.STATS_INTERVAL)
         for s in readable:
-            if s is server_socket:
-                client_socket, addr = server_socket.accept()
-                print(f"Connection from {addr}")
-                client_thread = threading.Thread(target=handle_client, args=(client_socket,))
-                client_thread.start()
+            if s is wakeup:
+                if signal.SIGHUP in wakeup.recv(64):
+                    listeners = reload_config(pool, listeners)
+                continue
+            if s.fileno() == -1:
+                # closed by a reload earlier in this loop
+                continue
+            try:
+                client_socket, addr = s.accept()
+            except BlockingIOError:
+                continue
+            print(f"Connection from {addr}")
+            if not pool.submit(client_socket):
+                print(f"Pool saturated, rejecting {addr}")
+                reject_busy(client_socket)
+        if time.monotonic() >= next_report:
+            summary = pool.report()
+            if summary:
+                print(summary)
+                print(file_cache.report())
+            next_report = time.monotonic() + config.STATS_INTERVAL
+
+def bench_parser(requests=20000):
+    """Print how fast RequestParser gets through pipelined requests fed in various read sizes."""
+    get = (b"GET /dataset/checkprime.py?x=1 HTTP/1.1\r\nHost: localhost:8000\r\n"
+           b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:127.0) Gecko/20100101 Firefox/127.0\r\n"
+           b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+           b"Accept-Language: en-US,en;q=0.5\r\nAccept-Encoding: gzip, deflate, br, zstd\r\n"
+           b"Connection: keep-alive\r\nCookie: session=" + b"a" * 200 + b"\r\n"
+           b"If-None-Match: \"11e06d-17dd0c6d3aa11000-16\"\r\n\r\n")
+    post = (b"POST /upload HTTP/1.1\r\nHost: localhost:8000\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"100\r\n" + b"x" * 256 + b"\r\n80\r\n" + b"y" * 128 + b"\r\n0\r\n\r\n")
+    for name, request in (('GET', get), ('chunked POST', post)):
+        stream = request * requests
+        for read_size in (65536, 1460, 64):
+            parser = RequestParser()
+            parsed = 0
+            start = time.perf_counter()
+            for offset in range(0, len(stream), read_size):
+                parser.feed(stream[offset:offset + read_size])
+                while parser.next_request() is not None:
+                    parsed += 1
+            elapsed = time.perf_counter() - start
+            assert parsed == requests
+            print(f"{name:12s} {len(request):4d} B requests, {read_size:5d} B reads: "
+                  f"{parsed / elapsed:9.0f} req/s {len(stream) / elapsed / 1e6:7.1f} MB/s")
+
+class TestRequestParser(unittest.TestCase):
+    GET = b"GET /a?b=c HTTP/1.1\r\nHost: localhost\r\nX-Two: 1\r\nx-two: 2\r\n\r\n"
+    CHUNKED = (b"POST /up HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+               b"5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nExpires: never\r\nX-Sum: 1\r\n\r\n")
+
+    def parse(self, data, read_size=None, **limits):
+        """Feed data in reads of read_size bytes and return every request parsed."""
+        parser = RequestParser(**limits)
+        read_size = read_size or len(data)
+        requests = []
+        for offset in range(0, len(data), read_size):
+            parser.feed(data[offset:offset + read_size])
+            request = parser.next_request()
+            while request is not None:
+                requests.append(request)
+                request = parser.next_request()
+        return requests
+
+    def assert_rejected(self, data, status, **limits):
+        with self.assertRaises(ParseError) as caught:
+            self.parse(data, **limits)
+        self.assertEqual(caught.exception.status, status)
+
+    def test_request(self):
+        request, = self.parse(self.GET)
+        self.assertEqual((request.method, request.path, request.version), ('GET', '/a?b=c', 'HTTP/1.1'))
+        self.assertEqual(request.headers, {'host': 'localhost', 'x-two': '1, 2'})
+        self.assertEqual(request.body, b'')
+
+    def test_split_reads(self):
+        for read_size in (1, 2, 3, 7):
+            request, = self.parse(self.GET, read_size)
+            self.assertEqual(request.headers['host'], 'localhost')
+            request, = self.parse(self.CHUNKED, read_size)
+            self.assertEqual(request.body, b'hello world')
+
+    def test_pipelining(self):
+        post = b"POST /p HTTP/1.0\r\nContent-Length: 3\r\n\r\nabc"
+        for read_size in (None, 1, 5):
+            requests = self.parse(self.GET + post + self.CHUNKED + self.GET, read_size)
+            self.assertEqual([r.method for r in requests], ['GET', 'POST', 'POST', 'GET'])
+            self.assertEqual([r.body for r in requests], [b'', b'abc', b'hello world', b''])
+
+    def test_leading_empty_lines(self):
+        for read_size in (None, 1):
+            request, = self.parse(b"\r\n\r\n" + self.GET, read_size)
+            self.assertEqual(request.path, '/a?b=c')
+            self.assertEqual(len(self.parse(self.GET + b"\r\n" + self.GET, read_size)), 2)
+
+    def test_chunked(self):
+        request, = self.parse(self.CHUNKED)
+        self.assertEqual(request.body, b'hello world')
+        request, = self.parse(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nA\r\n0123456789\r\n0\r\n\r\n")
+        self.assertEqual(request.body, b'0123456789')
+
+    def test_limits(self):
+        self.assert_rejected(self.GET, "431 Request Header Fields Too Large", max_header_size=32)
+        self.assert_rejected(self.GET[:-4], "431 Request Header Fields Too Large", max_header_size=32)
+        self.assert_rejected(b"POST / HTTP/1.1\r\nContent-Length: 17\r\n\r\n", "413 Content Too Large",
+                             max_body_size=16)
+        self.assert_rejected(self.CHUNKED, "413 Content Too Large", max_body_size=8)
+        self.assertEqual(len(self.parse(self.CHUNKED, max_header_size=64, max_body_size=11)), 1)
+        # each trailer line fits but together they do not
+        trailers = b"".join(b"X-T%d: %s\r\n" % (i, b"t" * 40) for i in range(4))
+        self.assert_rejected(self.CHUNKED.replace(b"Expires: never\r\n", trailers),
+                             "431 Request Header Fields Too Large", max_header_size=64)
+        self.assert_rejected(b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n", "501 Not Implemented")
+        self.assert_rejected(b"GET / HTTP/2.0\r\n\r\n", "505 HTTP Version Not Supported")
+
+    def test_malformed(self):
+        for data in (
+            b"GET /\r\n\r\n",
+            b"GET  / HTTP/1.1\r\n\r\n",
+            b"G(T / HTTP/1.1\r\n\r\n",
+            b"GET / FTP/1.1\r\n\r\n",
+            b"GET / HTTP/1.1\r\nNo colon\r\n\r\n",
+            b"GET / HTTP/1.1\r\nHost: a\r\n folded\r\n\r\n",
+            b"POST / HTTP/1.1\r\nContent-Length: 1\r\nContent-Length: 2\r\n\r\n",
+            b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n",
+            b"POST / HTTP/1.1\r\nContent-Length: 1\r\nTransfer-Encoding: chunked\r\n\r\n",
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n",
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n1\r\nab\r\n",
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n" + b"1" * 2000,
+        ):
+            with self.subTest(data=data):
+                self.assert_rejected(data, "400 Bad Request")
+
+class RecordingSocket:
+    """Stands in for a client socket and keeps what is sent to it."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def sendall(self, data):
+        self.data += data
+
+    def sendfile(self, f, offset, count):
+        f.seek(offset)
+        data = f.read(count)
+        self.data += data
+        return len(data)
+
+class ServerTestCase(unittest.TestCase):
+    """Serves a temporary DOCUMENT_ROOT with empty caches and the SETTINGS of the test class."""
+
+    SETTINGS = {}
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        # files next to the document root must not be reachable
+        self.outside = tmp.name
+        self.root = os.path.join(tmp.name, 'root')
+        os.mkdir(self.root)
+        settings = Config({'DOCUMENT_ROOT': self.root, **self.SETTINGS})
+        patcher = mock.patch.dict(globals(), config=settings,
+                                  file_cache=FileCache(settings.CACHE_SIZE, settings.MAX_CACHED_FILE),
+                                  directory_cache=DirectoryCache(settings.LISTING_CACHE_SIZE))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # requests are logged to stdout
+        quiet = contextlib.redirect_stdout(io.StringIO())
+        quiet.__enter__()
+        self.addCleanup(quiet.__exit__, None, None, None)
+
+    def write(self, name, data):
+        """Write a file under the document root, return its path."""
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def fetch(self, path, headers=None, method='GET', version='HTTP/1.1'):
+        """Return the status, headers and body get_response() gives for a request."""
+        response, rest = get_response(method, path, version, headers or {}, False, 0)
+        client = RecordingSocket()
+        client.sendall(response)
+        if rest is not None:
+            send_pieces(client, *rest)
+        (status, headers, body), _ = self.read_response(bytes(client.data))
+        return status, headers, body
+
+    @staticmethod
+    def read_response(data, method='GET'):
+        """Split the first response off data, return (status, headers, body) and the rest."""
+        head, _, data = data.partition(b'\r\n\r\n')
+        status, *lines = head.decode('latin-1').split('\r\n')
+        headers = {}
+        for line in lines:
+            name, _, value = line.partition(': ')
+            headers[name.lower()] = value
+        length = int(headers['content-length']) if 'content-length' in headers and method != 'HEAD' else 0
+        if headers.get('transfer-encoding') == 'chunked':
+            length = len(data)
+        return (status.partition(' ')[2], headers, data[:length]), data[length:]
+
+class TestConnections(ServerTestCase):
+    SETTINGS = {'KEEP_ALIVE_TIMEOUT': 0.3, 'REQUEST_TIMEOUT': 0.2, 'MAX_KEEP_ALIVE_REQUESTS': 3}
+
+    def setUp(self):
+        super().setUp()
+        self.write('a.txt', b'hello')
+
+    @staticmethod
+    def tcp_pair():
+        """A connected pair of TCP sockets; socket.socketpair() ones have no TCP_NODELAY to set."""
+        with socket.create_server(('127.0.0.1', 0)) as listener:
+            client = socket.create_connection(listener.getsockname())
+            server, _ = listener.accept()
+        return server, client
+
+    def serve(self, data, pool=None):
+        """Run handle_client() on a connection the client sent data on, return all it sent back."""
+        server, client = self.tcp_pair()
+        with client:
+            client.sendall(data)
+            handle_client(server, pool)
+            received = b''
+            while True:
+                chunk = client.recv(RECV_SIZE)
+                if not chunk:
+                    return received
+                received += chunk
+
+    def responses(self, data, methods):
+        responses = []
+        for method in methods:
+            response, data = self.read_response(data, method)
+            responses.append(response)
+        self.assertEqual(data, b'')
+        return responses
+
+    def test_keep_alive_and_pipelining(self):
+        # three requests in one write, the second one HEAD
+        data = self.serve(b"GET /a.txt HTTP/1.1\r\nHost: x\r\n\r\n"
+                          b"HEAD /a.txt HTTP/1.1\r\nHost: x\r\n\r\n"
+                          b"GET /a.txt HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        first, head, last = self.responses(data, ['GET', 'HEAD', 'GET'])
+        self.assertEqual((first[0], first[2]), ('200 OK', b'hello'))
+        self.assertEqual(first[1]['connection'], 'keep-alive')
+        self.assertEqual(first[1]['keep-alive'], 'timeout=0.3, max=2')
+        self.assertEqual((head[0], head[1]['content-length'], head[2]), ('200 OK', '5', b''))
+        self.assertEqual(head[1]['keep-alive'], 'timeout=0.3, max=1')
+        self.assertEqual((last[1]['connection'], last[2]), ('close', b'hello'))
+
+    def test_connection_limits(self):
+        request = b"GET /a.txt HTTP/1.1\r\nHost: x\r\n\r\n"
+        # MAX_KEEP_ALIVE_REQUESTS, then the connection is closed
+        responses = self.responses(self.serve(request * 4), ['GET'] * 3)
+        self.assertEqual([r[1]['connection'] for r in responses], ['keep-alive', 'keep-alive', 'close'])
+        # HTTP/1.0 closes unless asked not to
+        response, = self.responses(self.serve(b"GET /a.txt HTTP/1.0\r\n\r\n" + request), ['GET'])
+        self.assertEqual(response[1]['connection'], 'close')
+        # connections waiting for a worker
+        pool = mock.Mock()
+        pool.backlog.return_value = 1
+        response, = self.responses(self.serve(request * 2, pool), ['GET'])
+        self.assertEqual(response[1]['connection'], 'close')
+
+    def test_timeouts(self):
+        # an idle connection is closed without a response
+        self.assertEqual(self.serve(b''), b'')
+        # one that started a request gets a 408
+        response, = self.responses(self.serve(b"GET /a.txt HTTP/1.1\r\nHo"), ['GET'])
+        self.assertEqual(response[0], '408 Request Timeout')
+
+    def test_bad_request(self):
+        response, = self.responses(self.serve(b"GET /\r\n\r\nGET /a.txt HTTP/1.1\r\n\r\n"), ['GET'])
+        self.assertEqual((response[0], response[1]['connection']), ('400 Bad Request', 'close'))
+
+class TestSendFile(ServerTestCase):
+    SETTINGS = {'MAX_CACHED_FILE': 16}
+    DATA = bytes(range(256)) * 4
+
+    def test_uncached_file(self):
+        self.write('big.bin', self.DATA)
+        status, headers, body = self.fetch('/big.bin')
+        self.assertEqual((status, headers['content-length'], body), ('200 OK', str(len(self.DATA)), self.DATA))
+        self.assertEqual(len(file_cache.entries), 0)
+
+    def test_send_file(self):
+        path = self.write('big.bin', self.DATA)
+        server, client = socket.socketpair()
+        with server, client, open(path, 'rb') as f:
+            self.assertEqual(send_file(server, f, 100, 300), 300)
+            received = b''
+            while len(received) < 300:
+                received += client.recv(RECV_SIZE)
+        self.assertEqual(received, self.DATA[100:400])
+
+    def test_copy_without_sendfile(self):
+        path = self.write('big.bin', self.DATA)
+        client = mock.Mock()
+        with mock.patch.dict(os.__dict__), mock.patch.dict(globals(), FILE_CHUNK_SIZE=64), open(path, 'rb') as f:
+            del os.sendfile
+            self.assertEqual(send_file(client, f, 10, 200), 200)
+        chunks = [call.args[0] for call in client.sendall.call_args_list]
+        self.assertEqual([len(chunk) for chunk in chunks], [64, 64, 64, 8])
+        self.assertEqual(b''.join(chunks), self.DATA[10:210])
+
+    def test_truncated_file(self):
+        path = self.write('big.bin', self.DATA)
+        # the file is shorter than the response said
+        self.assertFalse(send_pieces(RecordingSocket(), open(path, 'rb'), [b'head', (0, len(self.DATA) + 1)]))
+
+class TestFileCache(ServerTestCase):
+    @staticmethod
+    def entry(body, mtime=1):
+        st = mock.Mock(st_mtime_ns=mtime, st_size=len(body))
+        return CachedFile(b'', body, st), st
+
+    def test_lru(self):
+        cache = FileCache(10, 10)
+        a, a_st = self.entry(b'aaaa')
+        cache.store('a', a)
+        cache.store('b', self.entry(b'bbbb')[0])
+        # a lookup makes a the most recently used, so b goes first
+        self.assertIs(cache.lookup('a', a_st), a)
+        cache.store('c', self.entry(b'cccc')[0])
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual((cache.used, cache.evictions), (8, 1))
+        # compressed variants count against the same budget and go with their file
+        cache.add_variant('a', a, 'gzip', self.entry(b'zzz')[0])
+        self.assertEqual((list(cache.entries), cache.used), (['c'], 4))
+        cache.resize(3, 10)
+        self.assertEqual((list(cache.entries), cache.used), ([], 0))
+        # an entry that could never fit is not stored
+        cache.store('d', self.entry(b'dddd')[0])
+        self.assertEqual((list(cache.entries), cache.used), ([], 0))
+
+    def test_stat_invalidation(self):
+        cache = FileCache(10, 10)
+        a, a_st = self.entry(b'aaaa')
+        cache.store('a', a)
+        self.assertIsNone(cache.lookup('a', self.entry(b'aaaa', 2)[1]))
+        self.assertEqual((list(cache.entries), cache.used), ([], 0))
+        cache.store('a', a)
+        self.assertIsNone(cache.lookup('a', self.entry(b'aaaaa')[1]))
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_edited_file(self):
+        path = self.write('a.txt', b'first')
+        self.assertEqual(self.fetch('/a.txt')[2], b'first')
+        self.assertEqual(self.fetch('/a.txt')[2], b'first')
+        self.assertEqual((file_cache.hits, file_cache.misses), (1, 1))
+        # same size, newer mtime
+        self.write('a.txt', b'again')
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        self.assertEqual(self.fetch('/a.txt')[2], b'again')
+        self.write('a.txt', b'a longer body')
+        self.assertEqual(self.fetch('/a.txt')[2], b'a longer body')
+        self.assertEqual(len(file_cache.entries), 1)
+
+class TestConditionalGet(ServerTestCase):
+    def test_not_modified(self):
+        etag = '"1-2-3"'
+        self.assertTrue(not_modified({'if-none-match': etag}, etag, 0))
+        self.assertTrue(not_modified({'if-none-match': '"x", W/"1-2-3"'}, etag, 0))
+        self.assertTrue(not_modified({'if-none-match': '*'}, etag, 0))
+        self.assertFalse(not_modified({'if-none-match': '"x"'}, etag, 0))
+        modified = email.utils.formatdate(1000, usegmt=True)
+        self.assertTrue(not_modified({'if-modified-since': modified}, etag, 1000.5))
+        self.assertFalse(not_modified({'if-modified-since': modified}, etag, 1001))
+        self.assertFalse(not_modified({'if-modified-since': 'yesterday'}, etag, 0))
+        # If-None-Match wins over If-Modified-Since
+        self.assertFalse(not_modified({'if-none-match': '"x"', 'if-modified-since': modified}, etag, 0))
+
+    def test_304(self):
+        self.write('a.txt', b'hello')
+        # cached and sent from memory, then too big to cache and sent from the file
+        for max_file in (1024, 0):
+            file_cache.max_file = max_file
+            status, headers, body = self.fetch('/a.txt')
+            self.assertEqual((status, body), ('200 OK', b'hello'))
+            etag, last_modified = headers['etag'], headers['last-modified']
+            for conditional in ({'if-none-match': etag}, {'if-modified-since': last_modified},
+                                {'if-none-match': etag, 'range': 'bytes=0-1'}):
+                with self.subTest(max_file=max_file, headers=conditional):
+                    status, headers, body = self.fetch('/a.txt', conditional)
+                    self.assertEqual((status, body), ('304 Not Modified', b''))
+                    self.assertEqual(headers['etag'], etag)
+            status, _, body = self.fetch('/a.txt', {'if-none-match': '"other"'})
+            self.assertEqual((status, body), ('200 OK', b'hello'))
+
+class TestRanges(ServerTestCase):
+    def test_parse_ranges(self):
+        for value, ranges in (
+            ('bytes=0-4', [(0, 4)]),
+            ('bytes=8-', [(8, 9)]),
+            ('bytes=-3', [(7, 9)]),
+            ('bytes=5-100', [(5, 9)]),
+            ('bytes=6-7, 0-1', [(0, 1), (6, 7)]),
+            # overlapping and adjacent ranges are merged
+            ('bytes=0-2,1-4,5-5', [(0, 5)]),
+            ('bytes=10-', []),
+            ('bytes=-0', []),
+            ('items=0-1', None),
+            ('bytes=4-2', None),
+            ('bytes=a-1', None),
+            ('bytes=-', None),
+            ('bytes=' + ','.join(['0-0'] * (MAX_RANGES + 1)), None),
+        ):
+            with self.subTest(value=value):
+                self.assertEqual(parse_ranges(value, 10), ranges)
+
+    def test_single_range(self):
+        self.write('a.txt', b'0123456789')
+        status, headers, body = self.fetch('/a.txt', {'range': 'bytes=2-5'})
+        self.assertEqual((status, body), ('206 Partial Content', b'2345'))
+        self.assertEqual(headers['content-range'], 'bytes 2-5/10')
+        self.assertEqual(headers['content-length'], '4')
+
+    def test_unsatisfiable(self):
+        self.write('a.txt', b'0123456789')
+        status, headers, body = self.fetch('/a.txt', {'range': 'bytes=10-20'})
+        self.assertEqual((status, headers['content-range'], body), ('416 Range Not Satisfiable', 'bytes */10', b''))
+        # a malformed header, or an If-Range for another version, gets the whole file
+        for headers in ({'range': 'bytes=x'}, {'range': 'bytes=0-1', 'if-range': '"old"'}):
+            self.assertEqual(self.fetch('/a.txt', headers)[::2], ('200 OK', b'0123456789'))
+
+    def test_multipart(self):
+        self.write('a.txt', b'0123456789')
+        status, headers, body = self.fetch('/a.txt', {'range': 'bytes=7-8,0-1'})
+        self.assertEqual(status, '206 Partial Content')
+        content_type, _, boundary = headers['content-type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        self.assertEqual(int(headers['content-length']), len(body))
+        self.assertEqual(body, (f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+                                f"Content-Range: bytes 0-1/10\r\n\r\n01\r\n"
+                                f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+                                f"Content-Range: bytes 7-8/10\r\n\r\n78\r\n"
+                                f"--{boundary}--\r\n").encode())
+
+class TestContentCoding(ServerTestCase):
+    TEXT = b'All work and no play makes Jack a dull boy.\n' * 32
+
+    def test_choose_encoding(self):
+        available = ('gzip', 'deflate')
+        for accept, encoding in (
+            ('gzip, deflate', 'gzip'),
+            ('gzip;q=0.5, deflate', 'deflate'),
+            ('GZIP;q=0.5, deflate;q=0.4', 'gzip'),
+            ('gzip;q=0', None),
+            ('*', 'gzip'),
+            ('*;q=0.1, gzip;q=0', 'deflate'),
+            ('br, zstd', None),
+            # identity cannot be refused, it is sent when nothing else is acceptable
+            ('identity;q=0', None),
+            ('identity;q=0, deflate', 'deflate'),
+            ('gzip;q=bad, deflate;q=0.1', 'deflate'),
+        ):
+            with self.subTest(accept=accept):
+                self.assertEqual(choose_encoding({'accept-encoding': accept}, available), encoding)
+        self.assertIsNone(choose_encoding({}, available))
+
+    def test_zstd_only_when_available(self):
+        self.assertEqual('zstd' in ENCODINGS, zstandard is not None)
+        encoding = choose_encoding({'accept-encoding': 'zstd, gzip;q=0.9'})
+        self.assertEqual(encoding, 'zstd' if zstandard is not None else 'gzip')
+
+    def test_compressed_variant(self):
+        self.write('a.txt', self.TEXT)
+        status, headers, body = self.fetch('/a.txt', {'accept-encoding': 'gzip'})
+        self.assertEqual((status, headers['content-encoding']), ('200 OK', 'gzip'))
+        self.assertEqual(gzip.decompress(body), self.TEXT)
+        plain = self.fetch('/a.txt')[1]['etag']
+        self.assertEqual(headers['etag'], variant_etag(plain, 'gzip'))
+        # made once and kept with the file
+        self.assertEqual(self.fetch('/a.txt', {'accept-encoding': 'gzip'})[2], body)
+        self.assertEqual(file_cache.compressions, 1)
+        status, headers, body = self.fetch('/a.txt', {'accept-encoding': 'deflate'})
+        self.assertEqual(zlib.decompress(body), self.TEXT)
+
+    def test_identity_is_smaller(self):
+        self.write('tiny.txt', b'x' * (config.MIN_COMPRESS_SIZE - 1))
+        self.write('random.bin', os.urandom(4096))
+        for path in ('/tiny.txt', '/random.bin'):
+            with self.subTest(path=path):
+                headers = self.fetch(path, {'accept-encoding': 'gzip'})[1]
+                self.assertNotIn('content-encoding', headers)
+                self.assertEqual(headers['vary'], 'Accept-Encoding')
+
+    def test_precompressed_sibling(self):
+        self.write('a.txt', self.TEXT)
+        self.write('a.txt.gz', b'precompressed')
+        st = os.stat(os.path.join(self.root, 'a.txt'))
+        os.utime(os.path.join(self.root, 'a.txt.gz'), ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        self.assertEqual(self.fetch('/a.txt', {'accept-encoding': 'gzip'})[2], b'precompressed')
+
+class TestListing(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write('sub/b.txt', b'12345')
+        self.write('sub/a<b>&c.txt', b'1')
+        os.mkdir(os.path.join(self.root, 'sub', 'dir'))
+        with open(os.path.join(self.outside, 'secret.txt'), 'wb') as f:
+            f.write(b'secret')
+
+    def test_formats(self):
+        status, headers, body = self.fetch('/sub/')
+        self.assertEqual((status, headers['content-type']), ('200 OK', 'text/plain'))
+        self.assertEqual(body, b'a<b>&c.txt\nb.txt\ndir')
+        listing = json.loads(self.fetch('/sub/', {'accept': 'application/json'})[2])
+        self.assertEqual((listing['path'], listing['total']), ('/sub/', 3))
+        self.assertEqual(listing['entries'][1], {'name': 'b.txt', 'type': 'file', 'size': 5,
+                                                 'mtime': listing['entries'][1]['mtime']})
+        self.assertEqual(listing['entries'][2]['type'], 'directory')
+
+    def test_html_escaping(self):
+        os.mkdir(os.path.join(self.root, '<i>'))
+        body = self.fetch('/%3Ci%3E/?format=html')[2].decode()
+        self.assertIn('<title>Index of /&lt;i&gt;/</title>', body)
+        self.assertNotIn('<i>', body)
+        body = self.fetch('/sub/?format=html')[2].decode()
+        self.assertIn('<a href="/sub/a%3Cb%3E%26c.txt">a&lt;b&gt;&amp;c.txt</a>', body)
+        self.assertIn('<a href="/sub/dir/">dir/</a>', body)
+
+    def test_pages(self):
+        body = self.fetch('/sub/?sort=size&order=desc&limit=1&offset=1&format=html')[2].decode()
+        self.assertIn('>a&lt;b&gt;&amp;c.txt</a>', body)
+        self.assertNotIn('>b.txt</a>', body)
+        self.assertIn('<a href="?sort=size&amp;order=desc&amp;limit=1&amp;offset=0&amp;format=html">previous</a>', body)
+        self.assertIn('offset=2&amp;format=html">next</a>', body)
+        for query in ('sort=owner', 'offset=-1', 'limit=x', 'format=xml'):
+            with self.subTest(query=query):
+                self.assertEqual(self.fetch('/sub/?' + query)[0], '400 Bad Request')
+
+    def test_streamed(self):
+        with mock.patch.dict(globals(), LISTING_STREAM_THRESHOLD=1, LISTING_BATCH=1):
+            status, headers, body = self.fetch('/sub/')
+            self.assertEqual(headers['transfer-encoding'], 'chunked')
+            self.assertEqual(body, b'a\r\na<b>&c.txt\r\n6\r\n\nb.txt\r\n4\r\n\ndir\r\n0\r\n\r\n')
+            # HTTP/1.0 has no chunked coding
+            status, headers, body = self.fetch('/sub/', version='HTTP/1.0')
+            self.assertEqual(body, b'a<b>&c.txt\nb.txt\ndir')
+
+    def test_bad_paths(self):
+        self.assertEqual(self.fetch('/sub%00/')[0], '400 Bad Request')
+        os.symlink(self.outside, os.path.join(self.root, 'link'))
+        for path in ('/../secret.txt', '/%2e%2e/secret.txt', '/sub/../../secret.txt', '/..%2F', '/link/secret.txt', '/link/'):
+            with self.subTest(path=path):
+                status, _, body = self.fetch(path)
+                self.assertEqual(status, '404 Not Found')
+                self.assertNotIn(b'secret', body)
+
+class TestConfig(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        # reload_config() reads CONFIG_FILE from the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.outside)
+        self.listeners = open_listeners([('127.0.0.1', 0)], {})
+        self.addCleanup(self.listeners[('127.0.0.1', 0)].close)
+        self.pool = mock.Mock()
+
+    def write_config(self, text):
+        with open(CONFIG_FILE, 'w') as f:
+            f.write(text)
+
+    def test_values(self):
+        for values in ({'PORT': 'x'}, {'WORKERS': '0'}, {'QUEUE_SIZE': '0'}, {'CACHE_SIZE': '-1'},
+                       {'KEEP_ALIVE_TIMEOUT': 'soon'}, {'LISTEN': 'localhost:http'}):
+            with self.subTest(values=values):
+                self.assertRaises(ValueError, Config, values)
+        self.assertEqual(Config({'HOST': 'h', 'LISTEN': '80, 127.0.0.1:81, [::1]:82'}).LISTENERS,
+                         (('h', 80), ('127.0.0.1', 81), ('::1', 82)))
+
+    def test_read(self):
+        self.write_config("# comment\n\nPORT = 8080\nUNKNOWN=1\nWORKERS\nKEEP_ALIVE_TIMEOUT=2.5\n")
+        read = Config.read()
+        self.assertEqual((read.PORT, read.WORKERS, read.KEEP_ALIVE_TIMEOUT), (8080, 16, 2.5))
+
+    def test_bad_reload_keeps_config(self):
+        old = config
+        with socket.create_server(('127.0.0.1', 0)) as taken:
+            for text in ('WORKERS=0\n', 'PORT=http\n', f'LISTEN=127.0.0.1:{taken.getsockname()[1]}\n', None):
+                with self.subTest(text=text):
+                    if text is None:
+                        os.remove(CONFIG_FILE)
+                    else:
+                        self.write_config(text)
+                    self.assertIs(reload_config(self.pool, self.listeners), self.listeners)
+                    self.assertIs(config, old)
+        self.pool.resize.assert_not_called()
+        self.assertNotEqual(self.listeners[('127.0.0.1', 0)].fileno(), -1)
+
+    def test_reload(self):
+        self.write('a.txt', b'hello')
+        self.fetch('/a.txt')
+        self.write_config(f"LISTEN=127.0.0.1:0\nWORKERS=2\nCACHE_SIZE=100\nDOCUMENT_ROOT={self.root}\n")
+        self.assertEqual(reload_config(self.pool, self.listeners), self.listeners)
+        self.assertEqual((config.WORKERS, file_cache.capacity), (2, 100))
+        self.pool.resize.assert_called_once_with(2, 64)
+        self.assertEqual(len(file_cache.entries), 1)
+        # another address replaces the listener, another root empties the cache
+        self.write_config(f"LISTEN=127.0.0.2:0\nDOCUMENT_ROOT={self.outside}\n")
+        listeners = reload_config(self.pool, self.listeners)
+        for server_socket in listeners.values():
+            self.addCleanup(server_socket.close)
+        self.assertEqual(list(listeners), [('127.0.0.2', 0)])
+        self.assertEqual(self.listeners[('127.0.0.1', 0)].fileno(), -1)
+        self.assertEqual(len(file_cache.entries), 0)
+
+class TestWorkerPool(unittest.TestCase):
+    def test_full_queue(self):
+        started, release = threading.Event(), threading.Event()
+        handled = queue.Queue()
+
+        def handle(client_socket, pool):
+            started.set()
+            release.wait(5)
+            handled.put(client_socket)
+
+        with mock.patch.dict(globals(), handle_client=handle):
+            pool = WorkerPool(1, 1)
+            first, second = mock.Mock(), mock.Mock()
+            self.assertTrue(pool.submit(first))
+            self.assertTrue(started.wait(5))
+            # the worker is busy, one connection fits in the queue
+            self.assertTrue(pool.submit(second))
+            self.assertEqual(pool.backlog(), 1)
+            self.assertFalse(pool.submit(mock.Mock()))
+            release.set()
+            self.assertEqual([handled.get(timeout=5) for _ in range(2)], [first, second])
+        self.assertIn("1 rejected", pool.report())
+
+    def test_reject_busy(self):
+        server, client = socket.socketpair()
+        with client:
+            reject_busy(server)
+            self.assertEqual(server.fileno(), -1)
+            response = client.recv(RECV_SIZE)
+        self.assertTrue(response.startswith(b"HTTP/1.1 503 Service Unavailable\r\n"))
+        self.assertIn(b"Retry-After: 1\r\n", response)
+        self.assertIn(b"Connection: close\r\n", response)
 
 if __name__ == "__main__":
     # Ong
-    main()
+    if sys.argv[1:2] == ['bench-parser']:
+        bench_parser()
+    elif sys.argv[1:2] == ['test']:
+        unittest.main(argv=sys.argv[:1])
+    else:
+        main()
@@ -0,0 +1 @@
+"""Helpers shared by the servers in this repository."""
@@ -0,0 +1,152 @@
+"""Deadlines and connection limits shared by the select() servers.
+
+Run this file to test it.
+"""
+import heapq
+import itertools
+import select
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+# select() cannot watch descriptors past FD_SETSIZE (usually 1024), so the
+# servers turn clients away beyond this many
+MAX_CONNECTIONS = 512
+
+
+class Deadlines:
+    """Heap of per-connection deadlines checked by the select loop.
+
+    Moving a socket's deadline pushes a new entry and leaves the old one in
+    the heap; stale entries are skipped when they come up and dropped in
+    bulk once they outnumber the live ones.
+    """
+
+    def __init__(self):
+        self.heap = []
+        # socket -> its current deadline
+        self.current = {}
+        # tie breaker, sockets do not compare
+        self.counter = itertools.count()
+
+    def set(self, sock, deadline):
+        self.current[sock] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), sock))
+        if len(self.heap) > 2 * len(self.current) + 64:
+            self.heap = [entry for entry in self.heap if self.current.get(entry[2]) == entry[0]]
+            heapq.heapify(self.heap)
+
+    def discard(self, sock):
+        self.current.pop(sock, None)
+
+    def timeout(self, now):
+        """Seconds from now until the next deadline, None if there is none."""
+        while self.heap and self.current.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - now)
+
+    def expired(self, now):
+        """Forget and return the sockets whose deadline has passed."""
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, sock = heapq.heappop(self.heap)
+            if self.current.get(sock) == deadline:
+                del self.current[sock]
+                expired.append(sock)
+        return expired
+
+
+
+def turn_away(sock, message):
+    """Send a last message if the socket takes it right away, then close it."""
+    sock.setblocking(False)
+    try:
+        sock.send(message)
+    except OSError:
+        pass
+    sock.close()
+
+
+def run_select_loop(loop, steps):
+    """Run a server's select loop against a scripted select() and clock, for tests.
+
+    steps holds one (time, readable sockets) pair per select() call: the
+    clock reads time from the moment that call returns.  Once they run out
+    select() raises KeyboardInterrupt, which ends the loop.  Returns the
+    timeout given to each select() call.
+    """
+    steps = list(steps)
+    clock = [0]
+    timeouts = []
+
+    def scripted_select(inputs, outputs, errors, timeout=None):
+        timeouts.append(timeout)
+        if not steps:
+            raise KeyboardInterrupt
+        clock[0], ready = steps.pop(0)
+        return ready, [], []
+
+    with patch('select.select', side_effect=scripted_select), \
+            patch('time.monotonic', side_effect=lambda: clock[0]):
+        try:
+            loop()
+        except KeyboardInterrupt:
+            pass
+    return timeouts
+
+
+class TestDeadlines(unittest.TestCase):
+    def test_deadlines(self):
+        deadlines = Deadlines()
+        self.assertIsNone(deadlines.timeout(0))
+        deadlines.set('a', 5)
+        deadlines.set('b', 3)
+        # moving a deadline earlier or later replaces the old one
+        deadlines.set('a', 1)
+        self.assertEqual(deadlines.timeout(0), 1)
+        self.assertEqual(deadlines.timeout(2), 0)
+        self.assertEqual(deadlines.expired(2), ['a'])
+        self.assertEqual(deadlines.expired(2), [])
+        deadlines.set('b', 8)
+        self.assertEqual(deadlines.timeout(2), 6)
+        deadlines.discard('b')
+        deadlines.discard('missing')
+        self.assertIsNone(deadlines.timeout(2))
+        self.assertEqual(deadlines.expired(10), [])
+
+    def test_stale_entries_are_dropped(self):
+        deadlines = Deadlines()
+        for deadline in range(1000):
+            deadlines.set('a', deadline)
+        self.assertLess(len(deadlines.heap), 100)
+        self.assertEqual(deadlines.expired(998), [])
+        self.assertEqual(deadlines.expired(999), ['a'])
+
+    def test_turn_away(self):
+        sock = MagicMock()
+        turn_away(sock, b'bye')
+        sock.setblocking.assert_called_once_with(False)
+        sock.send.assert_called_once_with(b'bye')
+        sock.close.assert_called_once()
+        # a client that cannot take the message is closed all the same
+        sock = MagicMock()
+        sock.send.side_effect = BlockingIOError
+        turn_away(sock, b'bye')
+        sock.close.assert_called_once()
+
+    def test_run_select_loop(self):
+        seen = []
+
+        def loop():
+            while True:
+                ready, _, _ = select.select([], [], [], 5)
+                seen.append((time.monotonic(), ready))
+
+        self.assertEqual(run_select_loop(loop, [(1, ['a']), (7, [])]), [5, 5, 5])
+        self.assertEqual(seen, [(1, ['a']), (7, [])])
+
+
+if __name__ == '__main__':
+    unittest.main()
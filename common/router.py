@@ -0,0 +1,193 @@
+"""Trie-based request router shared by the socket HTTP servers.
+
+Run this file to test it.
+"""
+import unittest
+
+
+class RouteNode:
+    __slots__ = ('children', 'param', 'rest', 'handlers')
+
+    def __init__(self):
+        # static segment -> RouteNode
+        self.children = {}
+        # (name, RouteNode) for a <name> segment
+        self.param = None
+        # (name, RouteNode) for a final <name:path> segment
+        self.rest = None
+        # method -> handler for routes ending at this node
+        self.handlers = {}
+
+
+class Router:
+    """Maps a method and path to a handler and the parameters taken from the path.
+
+    Patterns are matched segment by segment: a segment written as <name>
+    matches any one segment, and a final <name:path> matches the rest of the
+    path including slashes.  Static segments are tried before parameters.
+    Routes are kept in a trie of path segments, so finding one walks one
+    node per segment of the path however many routes there are; routes
+    without parameters are found with a single dict lookup.  A handler can
+    be anything, and a route registered for method '*' matches any method.
+    """
+
+    def __init__(self):
+        self.root = RouteNode()
+        # (method, path) -> handler for patterns without parameters
+        self.static = {}
+
+    def add(self, method, pattern, handler):
+        node = self.root
+        segments = pattern.split('/')[1:]
+        if not any(segment.startswith('<') for segment in segments):
+            self.static[(method, pattern)] = handler
+        for index, segment in enumerate(segments):
+            if segment.startswith('<') and segment.endswith('>'):
+                name, _, kind = segment[1:-1].partition(':')
+                if kind == 'path':
+                    if index != len(segments) - 1:
+                        raise ValueError(f"<{name}:path> must be the last segment of {pattern}")
+                    if node.rest is None:
+                        node.rest = (name, RouteNode())
+                    elif node.rest[0] != name:
+                        raise ValueError(f"<{name}:path> in {pattern} conflicts with <{node.rest[0]}:path>")
+                    node.rest[1].handlers[method] = handler
+                    return
+                if node.param is None:
+                    node.param = (name, RouteNode())
+                elif node.param[0] != name:
+                    raise ValueError(f"<{name}> in {pattern} conflicts with <{node.param[0]}>")
+                node = node.param[1]
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+        node.handlers[method] = handler
+
+    def route(self, method, pattern):
+        """Decorator form of add()."""
+        def register(handler):
+            self.add(method, pattern, handler)
+            return handler
+        return register
+
+    def match(self, method, path):
+        """Return (handler, params) for a request path without its query, None if no route matches.
+
+        A HEAD request without a HEAD route of its own gets the GET route;
+        leaving out the body is up to the server.
+        """
+        found = self.lookup(method, path)
+        if found is None and method == 'HEAD':
+            found = self.lookup('GET', path)
+        return found
+
+    def lookup(self, method, path):
+        """match() for exactly this method, or a '*' route."""
+        if not path.startswith('/'):
+            return None
+        handler = self.static.get((method, path))
+        if handler is None:
+            handler = self.static.get(('*', path))
+        if handler is not None:
+            return handler, {}
+        params = {}
+        handlers = self.find(path, params)
+        if handlers is None:
+            return None
+        handler = handlers.get(method, handlers.get('*'))
+        if handler is None:
+            return None
+        return handler, params
+
+    def allowed(self, path):
+        """Return the methods that have a route for path, for a 405's Allow header.
+
+        An empty set means the path has no route at all, a 404.
+        """
+        if not path.startswith('/'):
+            return set()
+        # only asked for when match() fails, so a scan of the static routes will do
+        methods = {method for method, pattern in self.static if pattern == path}
+        methods |= set(self.find(path, {}) or ())
+        if 'GET' in methods:
+            methods.add('HEAD')
+        return methods
+
+    def find(self, path, params):
+        """Return the handlers of the route for path and fill in params, None if there is none."""
+        segments = path.split('/')[1:]
+        last = len(segments)
+        # depth first with static children tried before <name> before
+        # <name:path>; entries are (node, index of its segment, parameters)
+        stack = [(self.root, 0, ())]
+        while stack:
+            node, index, bound = stack.pop()
+            if index == last:
+                if node.handlers:
+                    params.update(bound)
+                    return node.handlers
+                continue
+            segment = segments[index]
+            if node.rest is not None:
+                name, child = node.rest
+                stack.append((child, last, bound + ((name, '/'.join(segments[index:])),)))
+            if node.param is not None and segment:
+                name, child = node.param
+                stack.append((child, index + 1, bound + ((name, segment),)))
+            child = node.children.get(segment)
+            if child is not None:
+                stack.append((child, index + 1, bound))
+        return None
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = Router()
+        self.router.add('GET', '/', 'index')
+        self.router.add('GET', '/users/<id>', 'user')
+        self.router.add('POST', '/users/<id>', 'update user')
+        self.router.add('GET', '/users/me', 'me')
+        self.router.add('GET', '/users/<id>/posts/<post>', 'post')
+        self.router.add('*', '/static/<file:path>', 'static')
+
+    def test_match(self):
+        self.assertEqual(self.router.match('GET', '/'), ('index', {}))
+        self.assertEqual(self.router.match('GET', '/users/7'), ('user', {'id': '7'}))
+        self.assertEqual(self.router.match('POST', '/users/7'), ('update user', {'id': '7'}))
+        self.assertEqual(self.router.match('GET', '/users/7/posts/3'), ('post', {'id': '7', 'post': '3'}))
+        self.assertEqual(self.router.match('DELETE', '/static/css/site.css'), ('static', {'file': 'css/site.css'}))
+
+    def test_static_wins_over_params(self):
+        self.assertEqual(self.router.match('GET', '/users/me'), ('me', {}))
+        # a static segment that leads nowhere falls back to the parameter
+        self.router.add('GET', '/users/me/settings', 'settings')
+        self.assertEqual(self.router.match('GET', '/users/me/posts/1'), ('post', {'id': 'me', 'post': '1'}))
+
+    def test_no_route(self):
+        for path in ('/users/', '/missing', '/users/7/posts', '*', ''):
+            self.assertIsNone(self.router.match('GET', path))
+            self.assertEqual(self.router.allowed(path), set())
+
+    def test_method_not_allowed(self):
+        self.assertIsNone(self.router.match('DELETE', '/users/7'))
+        self.assertEqual(self.router.allowed('/users/7'), {'GET', 'HEAD', 'POST'})
+        self.assertIsNone(self.router.match('POST', '/'))
+        self.assertEqual(self.router.allowed('/'), {'GET', 'HEAD'})
+
+    def test_head_from_get(self):
+        self.assertEqual(self.router.match('HEAD', '/users/7'), ('user', {'id': '7'}))
+        self.assertEqual(self.router.match('HEAD', '/'), ('index', {}))
+        self.router.add('HEAD', '/users/<id>', 'user head')
+        self.assertEqual(self.router.match('HEAD', '/users/7'), ('user head', {'id': '7'}))
+        self.assertIsNone(self.router.match('HEAD', '/missing'))
+
+    def test_conflicting_params(self):
+        with self.assertRaises(ValueError):
+            self.router.add('GET', '/users/<name>', 'conflict')
+        with self.assertRaises(ValueError):
+            self.router.add('GET', '/static/<path:path>', 'conflict')
+        with self.assertRaises(ValueError):
+            self.router.add('GET', '/files/<rest:path>/more', 'not last')
+
+
+if __name__ == '__main__':
+    unittest.main()
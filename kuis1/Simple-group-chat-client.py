@@ -1,14 +1,63 @@
 # client.py
 
+import asyncio
+import codecs
 import socket
 import unittest
+import struct
 import sys
 import select
 from io import StringIO
 from unittest.mock import patch, MagicMock
 
-class ChatClient:
-    def __init__(self, nickname, host='127.0.0.1', port=65432):
+# 4-byte big-endian length prefix, same as the server's framed mode
+FRAME_HEADER = struct.Struct('!I')
+
+class MessageCodec:
+    """Message encoding shared by ChatClient and AsyncChatClient.
+
+    Needs self.framed, self.pending (a bytearray) and self.text (an
+    incremental UTF-8 decoder, see text_decoder) on the instance.
+    """
+
+    @staticmethod
+    def text_decoder():
+        """Decoder for unframed reads, which can end in the middle of a character."""
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def encode(self, payload):
+        if self.framed:
+            return FRAME_HEADER.pack(len(payload)) + payload
+        return payload
+
+    def split(self, data):
+        """Return the text of every message completed by data, one per item."""
+        if not self.framed:
+            # a character split across reads is held back until its last byte arrives
+            text = self.text.decode(data)
+            return [text] if text else []
+
+        self.pending += data
+        messages = []
+        offset = 0
+        while len(self.pending) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.pending, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(self.pending):
+                break
+            messages.append(self.pending[offset + FRAME_HEADER.size:end].decode() + '\n')
+            offset = end
+        # drop everything decoded in one go instead of once per frame
+        del self.pending[:offset]
+        return messages
+
+    def decode(self, data):
+        """Return the text of every message completed by data."""
+        return ''.join(self.split(data))
+
+
+class ChatClient(MessageCodec):
+    def __init__(self, nickname, host='127.0.0.1', port=65432, framed=False):
         # define host and port
         self.host = host
         self.port = port
@@ -19,6 +68,12 @@ class ChatClient:
         # do not forget to encode nickname
         self.nickname = nickname.encode()
 
+        # with framed=True every message carries a length prefix
+        self.framed = framed
+        # received bytes that do not form a complete frame yet
+        self.pending = bytearray()
+        self.text = self.text_decoder()
+
     def connect(self):
         # connect to server
         self.client_socket.connect((self.host, self.port))
@@ -27,7 +82,7 @@ class ChatClient:
         self.client_socket.setblocking(False)
 
         # send nickname
-        self.client_socket.send(self.nickname)
+        self.client_socket.send(self.encode(self.nickname))
 
     def main_loop(self):
         while True:
@@ -48,18 +103,151 @@ class ChatClient:
                 message = self.client_socket.recv(1024)
 
                 # write message to stdout
-                sys.stdout.write(message.decode())
+                sys.stdout.write(self.decode(message))
             else:
                 # read message from readline
                 message = sys.stdin.readline()
 
+                # the frame already marks where a message ends
+                if self.framed:
+                    message = message.rstrip('\n')
+
                 # send message
-                self.client_socket.send(message.encode())
+                self.client_socket.send(self.encode(message.encode()))
 
                 # flush the stdout
                 sys.stdout.flush()
 
 
+class AsyncChatClient(MessageCodec):
+    """asyncio version of ChatClient built on StreamReader/StreamWriter.
+
+    The connection is opened once and read in chunks of up to READ_SIZE
+    bytes; every message completed by one chunk goes out in a single write
+    to output. Lines typed on stdin are also read in chunks and all
+    complete lines are sent with one write. With output=None the client is
+    headless and only counts what it receives, which lets run_bots() drive
+    thousands of clients from one process.
+    """
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, nickname, host='127.0.0.1', port=65432, framed=False, output=sys.stdout):
+        self.host = host
+        self.port = port
+        self.nickname = nickname.encode()
+        self.framed = framed
+        self.pending = bytearray()
+        self.text = self.text_decoder()
+        self.output = output
+
+        self.reader = None
+        self.writer = None
+        self.sent = 0
+        self.received = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(self.encode(self.nickname))
+        await self.writer.drain()
+
+    async def send(self, *messages):
+        """Send every message in messages with a single write."""
+        self.writer.write(b''.join(self.encode(message.encode()) for message in messages))
+        self.sent += len(messages)
+        await self.writer.drain()
+
+    async def receive_loop(self):
+        """Read until the server closes the connection."""
+        while True:
+            data = await self.reader.read(self.READ_SIZE)
+            if not data:
+                return
+            messages = self.split(data)
+            self.received += len(messages)
+            if self.output is not None and messages:
+                self.output.write(''.join(messages))
+                self.output.flush()
+
+    async def stdin_loop(self, stdin=None):
+        """Send what is typed on stdin until it is closed."""
+        reader = asyncio.StreamReader()
+        loop = asyncio.get_running_loop()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stdin or sys.stdin)
+
+        partial = b''
+        while True:
+            chunk = await reader.read(self.READ_SIZE)
+            if not chunk:
+                return
+            *lines, partial = (partial + chunk).split(b'\n')
+            if lines:
+                # the frame already marks where a message ends
+                suffix = '' if self.framed else '\n'
+                await self.send(*(line.decode() + suffix for line in lines))
+
+    async def main_loop(self):
+        await self.connect()
+        tasks = [asyncio.ensure_future(self.receive_loop()), asyncio.ensure_future(self.stdin_loop())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.close()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+
+async def run_bots(count, messages=10, interval=0.1, host='127.0.0.1', port=65432,
+                   framed=False, connect_limit=256, settle=1.0):
+    """Connect count headless clients that each send messages messages.
+
+    Every bot waits interval seconds between messages, the bots start
+    staggered over one interval. Returns the totals once the last
+    broadcasts had settle seconds to arrive.
+    """
+    loop = asyncio.get_running_loop()
+    bots = [AsyncChatClient(f'bot{i}', host, port, framed, output=None) for i in range(count)]
+
+    # do not flood the server's accept queue with every connect at once
+    connecting = asyncio.Semaphore(connect_limit)
+
+    async def connect(bot):
+        async with connecting:
+            await bot.connect()
+
+    await asyncio.gather(*(connect(bot) for bot in bots))
+    receivers = [asyncio.ensure_future(bot.receive_loop()) for bot in bots]
+
+    async def chat(index, bot):
+        await asyncio.sleep(interval * index / count)
+        for n in range(messages):
+            await bot.send(f'message {n} from bot{index}' + ('' if framed else '\n'))
+            await asyncio.sleep(interval)
+
+    start = loop.time()
+    await asyncio.gather(*(chat(index, bot) for index, bot in enumerate(bots)))
+    await asyncio.sleep(settle)
+    elapsed = loop.time() - start
+
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*(bot.close() for bot in bots))
+    return {
+        'bots': count,
+        'sent': sum(bot.sent for bot in bots),
+        'received': sum(bot.received for bot in bots),
+        'seconds': round(elapsed, 3),
+    }
+
+
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
     def write(self, txt):
@@ -148,14 +336,122 @@ class TestChatClient(unittest.TestCase):
         self.mock_socket_instance.send.assert_called_with(b'Hi there!')
         print(f"send called with: {self.mock_socket_instance.send.call_args}")
 
+    def test_split_character_across_reads(self):
+        print('Testing characters split across reads ...')
+        data = 'héllo ✓\n'.encode()
+        # every split point, the one inside the three byte check mark included
+        for cut in range(1, len(data)):
+            text = self.chat_client.decode(data[:cut]) + self.chat_client.decode(data[cut:])
+            self.assertEqual(text, 'héllo ✓\n')
+        self.assertEqual(self.chat_client.decode(b'bad \xff\n'), 'bad \ufffd\n')
+        print()
+
+    @patch('select.select')
+    def test_loop_iteration_receive_framed_messages(self, mock_select):
+        print('Testing receive framed messages ...')
+        self.chat_client.framed = True
+
+        # two messages and the first half of a third one arrive in one recv
+        data = b''.join(FRAME_HEADER.pack(len(m)) + m for m in (b'alice: hi', b'bob: hey', b'carol: yo'))
+        self.mock_socket_instance.recv.return_value = data[:-3]
+        mock_select.return_value = ([self.chat_client.client_socket], [], [])
+
+        with patch('sys.stdout', new_callable=MagicMock) as mock_stdout:
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_called_once_with('alice: hi\nbob: hey\n')
+
+            self.mock_socket_instance.recv.return_value = data[-3:]
+            self.chat_client.loop_iteration()
+            mock_stdout.write.assert_called_with('carol: yo\n')
+        print()
+
+    @patch('select.select')
+    @patch('sys.stdin', new=MagicMock())
+    def test_loop_iteration_send_framed_message(self, mock_select):
+        print('Testing send framed message ...')
+        self.chat_client.framed = True
+        sys.stdin.readline.return_value = "Hi there!"
+        mock_select.return_value = ([sys.stdin], [], [])
+
+        self.chat_client.loop_iteration()
+
+        self.mock_socket_instance.send.assert_called_with(b'\x00\x00\x00\tHi there!')
+        print()
+
+
+class TestAsyncChatClient(unittest.IsolatedAsyncioTestCase):
+
+    async def start_server(self, handler):
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        self.addAsyncCleanup(self.stop_server, server)
+        return server.sockets[0].getsockname()[1]
+
+    async def stop_server(self, server):
+        server.close()
+        await server.wait_closed()
+
+    async def test_burst_is_written_once(self):
+        print('Testing async receive burst ...')
+        nicknames = []
+
+        async def handler(reader, writer):
+            nicknames.append(await reader.readexactly(FRAME_HEADER.size + len(b'alice')))
+            burst = [b'bob: one', b'bob: two', b'carol: three']
+            writer.write(b''.join(FRAME_HEADER.pack(len(m)) + m for m in burst))
+            await writer.drain()
+            writer.close()
+
+        port = await self.start_server(handler)
+        output = MagicMock()
+        client = AsyncChatClient('alice', port=port, framed=True, output=output)
+        await client.connect()
+        await client.receive_loop()
+        await client.close()
+
+        self.assertEqual(nicknames, [b'\x00\x00\x00\x05alice'])
+        output.write.assert_called_once_with('bob: one\nbob: two\ncarol: three\n')
+        self.assertEqual(client.received, 3)
+        print()
+
+    async def test_headless_bots(self):
+        print('Testing headless bots ...')
+
+        async def echo(reader, writer):
+            # skip the nickname frame, then every bot hears its own messages back
+            (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+            await reader.readexactly(length)
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                writer.write(data)
+            writer.close()
+
+        port = await self.start_server(echo)
+        totals = await run_bots(50, messages=3, interval=0.01, port=port, framed=True, settle=0.2)
+
+        self.assertEqual(totals['sent'], 150)
+        self.assertEqual(totals['received'], 150)
+        print()
+
 
 if __name__ == "__main__":
-    # uncomment this to test communication between client and server on your local computer
-    # nickname = input("Choose your nickname: ")
-    # client = ChatClient(nickname)
-    # client.connect()
-    # client.main_loop()
-
-    # uncomment this before submitting to dumjudge
-    runner = unittest.TextTestRunner(stream=NullWriter())
-    unittest.main(testRunner=runner, exit=False)
+    # python Simple-group-chat-client.py async [framed]          -> asyncio client on stdin/stdout
+    # python Simple-group-chat-client.py bots N [messages] [framed] -> N headless bots, prints totals
+    framed = sys.argv[-1] == 'framed'
+    if len(sys.argv) >= 2 and sys.argv[1] == 'async':
+        nickname = input("Choose your nickname: ")
+        asyncio.run(AsyncChatClient(nickname, framed=framed).main_loop())
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'bots':
+        messages = int(sys.argv[3]) if len(sys.argv) >= 4 and sys.argv[3] != 'framed' else 10
+        print(asyncio.run(run_bots(int(sys.argv[2]), messages, framed=framed)))
+    else:
+        # uncomment this to test communication between client and server on your local computer
+        # nickname = input("Choose your nickname: ")
+        # client = ChatClient(nickname)
+        # client.connect()
+        # client.main_loop()
+
+        # uncomment this before submitting to dumjudge
+        runner = unittest.TextTestRunner(stream=NullWriter())
+        unittest.main(testRunner=runner, exit=False)
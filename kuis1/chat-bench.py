@@ -0,0 +1,369 @@
+"""Benchmarks for the group chat server in simple-groupd-chat-server.py.
+
+    python chat-bench.py latency --server select --connections 10,50,100,200
+
+starts start_server() (--server select) or ChatServer (--server epoll) on
+localhost once per connection count, connects that many real clients and
+has them take turns broadcasting with at most --window messages in flight.
+Broadcast throughput and the p50/p99/p999 time from send until a client
+receives the message are printed as JSON, so runs can be compared to catch
+regressions in the select loop and broadcast().
+
+    python chat-bench.py shards --workers 1,2,4 --clients 200 --room-size 10
+
+starts the sharded server (start_shards) once per worker count, connects
+the clients from a few generator processes, lets every client send its
+messages to its room as fast as the server takes them and reports how many
+messages per second were delivered to the other room members.
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
+import selectors
+import signal
+import socket
+import sys
+import time
+
+
+def load_chat_server():
+    # the server file name is not a valid module name, load it by path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simple-groupd-chat-server.py')
+    spec = importlib.util.spec_from_file_location('chat_server', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+chat = load_chat_server()
+
+
+class BenchClient:
+    """One framed chat connection driven by a generator process."""
+
+    def __init__(self, index, port, room):
+        self.sock = socket.create_connection((chat.HOST, port))
+        self.sock.settimeout(10)
+        self.decoder = chat.FrameDecoder()
+        self.outgoing = memoryview(b'')
+        self.received = 0
+
+        # the join notice confirms the server has registered the client
+        self.sock.sendall(chat.encode_frame(b'bench%d' % index) + chat.encode_frame(b'/join ' + room))
+        while not self.read_frames():
+            pass
+        self.received = 0
+        self.sock.setblocking(False)
+
+    def read_frames(self):
+        """Receive once and count the frames, return the number counted."""
+        if not self.decoder.recv_from(self.sock):
+            raise ConnectionError('server closed the connection')
+        count = 0
+        for _ in self.decoder.frames():
+            count += 1
+        self.received += count
+        return count
+
+
+def room_members(index, clients, room_size):
+    first = index // room_size * room_size
+    return min(first + room_size, clients) - first
+
+
+def run_clients(indexes, port, options, barrier, results):
+    """Body of one generator process, reports (received, expected, last receive time)."""
+    room_size = options['room_size']
+    bench = [BenchClient(i, port, b'room%d' % (i // room_size)) for i in indexes]
+    expected = sum(options['messages'] * (room_members(i, options['clients'], room_size) - 1) for i in indexes)
+
+    selector = selectors.DefaultSelector()
+    payload = chat.encode_frame(b'x' * options['size']) * options['messages']
+    for client in bench:
+        client.outgoing = memoryview(payload)
+        selector.register(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+    barrier.wait()
+    received = 0
+    last_receive = time.monotonic()
+    while received < expected and time.monotonic() - last_receive < options['idle_timeout']:
+        for key, mask in selector.select(0.1):
+            client = key.data
+            if mask & selectors.EVENT_WRITE:
+                try:
+                    sent = client.sock.send(client.outgoing)
+                except BlockingIOError:
+                    sent = 0
+                client.outgoing = client.outgoing[sent:]
+                if not client.outgoing:
+                    selector.modify(client.sock, selectors.EVENT_READ, client)
+            if mask & selectors.EVENT_READ:
+                try:
+                    count = client.read_frames()
+                except BlockingIOError:
+                    continue
+                received += count
+                last_receive = time.monotonic()
+
+    for client in bench:
+        client.sock.close()
+    results.put((received, expected, last_receive))
+
+
+# payload of a latency probe, the server may merge several into one message;
+# warm-up probes have negative sequence numbers
+PROBE = re.compile(rb'(-?\d+):(\d+);')
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((chat.HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server_process(kind, port):
+    """Fork a quiet chat server of the given kind, return its pid once it listens."""
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        try:
+            if kind == 'select':
+                # start_server() takes its address from the module globals
+                chat.PORT = port
+                chat.start_server()
+            else:
+                chat.ChatServer(port=port).serve_forever()
+        finally:
+            os._exit(0)
+
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection((chat.HOST, port)).close()
+            return pid
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                os.kill(pid, signal.SIGTERM)
+                raise
+            time.sleep(0.01)
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+class LatencyClient:
+    """One unframed chat connection that extracts probes from what it receives."""
+
+    def __init__(self, index, port):
+        self.sock = socket.create_connection((chat.HOST, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(b'bench%d' % index)
+        self.sock.setblocking(False)
+        # bytes after the last complete probe
+        self.partial = b''
+
+    def probes(self):
+        """Return the (sequence, send time) of every probe received so far."""
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return []
+        if not data:
+            raise ConnectionError('server closed the connection')
+        data = self.partial + data
+        found = [(int(seq), int(sent)) for seq, sent in PROBE.findall(data)]
+        self.partial = data[data.rfind(b';') + 1:]
+        return found
+
+
+def measure_latency(kind, connections, options):
+    port = free_port()
+    pid = start_server_process(kind, port)
+    clients = []
+    try:
+        clients = [LatencyClient(i, port) for i in range(connections)]
+        selector = selectors.DefaultSelector()
+        for client in clients:
+            selector.register(client.sock, selectors.EVENT_READ, client)
+
+        # every receiver has to see seq before it counts as delivered
+        outstanding = {}
+        latencies = []
+        deadline = time.monotonic() + options['timeout']
+
+        def pump(wait):
+            for key, _ in selector.select(wait):
+                now = time.monotonic_ns()
+                for seq, sent in key.data.probes():
+                    if seq not in outstanding:
+                        continue
+                    if seq >= 0:
+                        latencies.append(now - sent)
+                    outstanding[seq] -= 1
+                    if not outstanding[seq]:
+                        del outstanding[seq]
+
+        def send(seq, sender):
+            outstanding[seq] = connections - 1
+            sender.sock.sendall(b'%d:%d;' % (seq, time.monotonic_ns()))
+
+        # the chat protocol has no acknowledgement, so resend a warm-up probe
+        # until every client is registered and receives it
+        warmup = 0
+        while True:
+            warmup -= 1
+            outstanding.clear()
+            send(warmup, clients[0])
+            settle = time.monotonic() + 0.5
+            while outstanding and time.monotonic() < settle:
+                pump(0.05)
+            if not outstanding:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{connections} clients did not all register in time')
+
+        start = time.monotonic()
+        seq = 0
+        while (seq < options['messages'] or outstanding) and time.monotonic() < deadline:
+            while seq < options['messages'] and len(outstanding) < options['window']:
+                send(seq, clients[seq % connections])
+                seq += 1
+            pump(0.1)
+        elapsed = time.monotonic() - start
+    finally:
+        for client in clients:
+            client.sock.close()
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    latencies.sort()
+    completed = seq - len(outstanding)
+    return {
+        'server': kind,
+        'connections': connections,
+        'messages': completed,
+        'deliveries': len(latencies),
+        'lost': seq * (connections - 1) - len(latencies),
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(completed / elapsed) if elapsed > 0 else None,
+        'deliveries_per_sec': round(len(latencies) / elapsed) if elapsed > 0 else None,
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) / 1e6, 3) if latencies else None
+            for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999), ('max', 1.0))
+        },
+    }
+
+
+def start_quiet_shards(workers, **options):
+    """start_shards() with the workers' per-message logging sent to /dev/null."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        return chat.start_shards(workers, **options)
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def measure_shards(workers, options):
+    pids, port = start_quiet_shards(workers, port=0, framed=True, slow_consumer='shed',
+                                    high_water_mark=options['high_water_mark'])
+    try:
+        procs = min(options['procs'], options['clients'])
+        barrier = multiprocessing.Barrier(procs + 1)
+        results = multiprocessing.Queue()
+        generators = [
+            multiprocessing.Process(target=run_clients,
+                                    args=(range(p, options['clients'], procs), port, options, barrier, results))
+            for p in range(procs)
+        ]
+        for generator in generators:
+            generator.start()
+
+        barrier.wait()
+        start = time.monotonic()
+        reports = [results.get() for _ in generators]
+        for generator in generators:
+            generator.join()
+    finally:
+        chat.stop_shards(pids)
+
+    received = sum(report[0] for report in reports)
+    expected = sum(report[1] for report in reports)
+    elapsed = max(report[2] for report in reports) - start
+    return {
+        'workers': workers,
+        'clients': options['clients'],
+        'room_size': options['room_size'],
+        'sent': options['clients'] * options['messages'],
+        'delivered': received,
+        'lost': expected - received,
+        'seconds': round(elapsed, 3),
+        'delivered_per_sec': round(received / elapsed) if elapsed > 0 else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    modes = parser.add_subparsers(dest='mode', required=True)
+
+    latency = modes.add_parser('latency', help='end-to-end latency and throughput of one server')
+    latency.add_argument('--server', choices=['select', 'epoll'], default='select',
+                         help='start_server() or ChatServer')
+    latency.add_argument('--connections', default='10,50,100,200', help='comma separated connection counts')
+    latency.add_argument('--messages', type=int, default=2000, help='messages sent in total')
+    latency.add_argument('--window', type=int, default=8, help='messages in flight at most')
+    latency.add_argument('--timeout', type=float, default=60.0)
+
+    shards = modes.add_parser('shards', help='delivered messages/sec per worker count')
+    shards.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+    shards.add_argument('--clients', type=int, default=200)
+    shards.add_argument('--room-size', type=int, default=10)
+    shards.add_argument('--messages', type=int, default=200, help='messages sent by every client')
+    shards.add_argument('--size', type=int, default=64, help='payload bytes per message')
+    shards.add_argument('--procs', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='load generator processes')
+    shards.add_argument('--high-water-mark', type=int, default=4 * 1024 * 1024)
+    shards.add_argument('--idle-timeout', type=float, default=3.0)
+    shards.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+    options = vars(args)
+
+    if args.mode == 'latency':
+        counts = [int(count) for count in args.connections.split(',')]
+        chat.raise_fd_limit(2 * max(counts) + 256)
+        results = [measure_latency(args.server, count, options) for count in counts]
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    chat.raise_fd_limit(4 * args.clients + 256)
+    results = []
+    for workers in (int(count) for count in args.workers.split(',')):
+        result = measure_shards(workers, options)
+        results.append(result)
+        if not args.json:
+            print('{workers:3d} workers: {delivered} delivered ({lost} lost) in {seconds}s, '
+                  '{delivered_per_sec} msg/s'.format(**result))
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    # generator processes must not inherit the parent's event loop state
+    multiprocessing.set_start_method('fork')
+    main()
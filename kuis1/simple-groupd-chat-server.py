@@ -1,7 +1,16 @@
+import json
+import mmap
+import os
 import socket
 import unittest
 import select
+import selectors
+import signal
+import struct
 import sys
+import tempfile
+import time
+import traceback
 from io import StringIO
 from unittest.mock import MagicMock, patch
 
@@ -9,6 +18,10 @@ from unittest.mock import MagicMock, patch
 HOST = '127.0.0.1'
 PORT = 65432
 
+# room every client of ChatServer joins after the nickname handshake
+DEFAULT_ROOM = b'lobby'
+MAX_ROOM_NAME = 64
+
 def receive_message(client_socket):
     try:
         # receive message
@@ -23,15 +36,20 @@ def receive_message(client_socket):
     except:
         return False
 
-def broadcast(message, sender_socket, clients):
+def broadcast(message, sender_socket, clients, stats=None):
     # check each socket in list of client sockets
     for client_socket in clients:
         # if socket is not sender socket, then send the message
         # if socket is the sender socket, then we do not send
         if client_socket != sender_socket:
-            client_socket.send(message)
+            if stats is None:
+                client_socket.send(message)
+            else:
+                started = time.perf_counter()
+                sent = client_socket.send(message)
+                stats.record_send(sent, len(message), time.perf_counter() - started)
 
-def start_server():
+def start_server(stats=None, log_messages=True):
     # create socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # set socket option to reuse address
@@ -44,22 +62,49 @@ def start_server():
     sockets_list = [server_socket]
     clients = {}
 
+    # optional instrumentation, see LoopStats
+    stats_socket = None
+    timeout = None
+    if stats is not None:
+        timeout = stats.interval
+        if stats.port is not None:
+            stats_socket = stats.listen(HOST)
+            sockets_list.append(stats_socket)
+
     print(f'Listening for connections on {HOST}:{PORT}...')
 
     while True:
         # use select to serve many clients
-        read_sockets, _, _ = select.select(sockets_list, [], [])
+        if stats is None:
+            read_sockets, _, _ = select.select(sockets_list, [], [])
+        else:
+            stats.tick()
+            started = time.perf_counter()
+            read_sockets, _, _ = select.select(sockets_list, [], [], timeout)
+            stats.record('select', time.perf_counter() - started)
 
         # check for each read-ready socket
         for sock in read_sockets:
+            if sock is stats_socket:
+                stats.serve(stats_socket)
+                continue
+
             # if the ready socket is the server socket, then accept connection
             if sock == server_socket:
+                if stats is not None:
+                    started = time.perf_counter()
+
                 # accept connection
                 client_socket, client_address = server_socket.accept()
 
                 # receive message from client socket
                 # use receive_message function
                 user = receive_message(client_socket)
+
+                if stats is not None:
+                    stats.record('accept', time.perf_counter() - started)
+                    stats.count('connections')
+
                 if user is False:
                     continue
 
@@ -71,11 +116,19 @@ def start_server():
                 clients[client_socket] = user
                 print('Accepted new connection from {}:{}, nickname: {}'.format(*client_address,user.decode('utf-8')))    # nickname == user
             else:
+                if stats is not None:
+                    started = time.perf_counter()
+
                 # receive message from read-ready socket
                 message = receive_message(sock)
 
+                if stats is not None:
+                    stats.record('receive', time.perf_counter() - started)
+
                 # check if message is False
                 if message is False:
+                    if stats is not None:
+                        stats.count('disconnects')
                     print('Closed connection from: {}'.format(clients[sock].decode('utf-8')))
 
                     # remove read ready socket from sockets_list
@@ -85,23 +138,1149 @@ def start_server():
                     del clients[sock]
                     continue
 
+                if stats is not None:
+                    stats.count('messages')
+                    stats.count('bytes_in', len(message))
+                    started = time.perf_counter()
+
                 # get user data from the clients dictionary based on the socket 
                 user = clients[sock]
 
                 # fill in the question mark in the following order: user and message. 
-                # do not forget to decode the string
-                print(f'Received message from {user.decode("utf-8")}: {message.decode("utf-8")}')
+                # decoding is only needed for the log, which can be turned off
+                if log_messages:
+                    print(f'Received message from {user.decode("utf-8")}: {message.decode("utf-8")}')
                                 
                 # Broadcast message with nickname prefixed
                 # full message in the following order: user and message
-                # do not forget to decode the string
-                # in the end of full_message, encode to bytes because we need to send it via socket
-                full_message = f"{user.decode('utf-8')}: {message.decode('utf-8')}".encode('utf-8')
+                # both are bytes already, so join them without a decode/encode round trip
+                full_message = user + b': ' + message
+
+                if stats is not None:
+                    stats.record('format', time.perf_counter() - started)
+                    started = time.perf_counter()
 
                 # first argument = full_message
                 # second argument = the socket ready
                 # third argument = clients dictionary
-                broadcast(full_message, sock, clients)
+                broadcast(full_message, sock, clients, stats)
+
+                if stats is not None:
+                    stats.record('broadcast', time.perf_counter() - started)
+
+
+class LoopStats:
+    """Opt-in timing histograms and counters for the chat server loops.
+
+    Pass an instance as start_server(stats=...) or ChatServer(stats=...);
+    without one the loops take no timestamps at all. Every phase of the
+    loop (PHASES) gets a histogram with power-of-two microsecond buckets,
+    next to counters for bytes in and out, messages, connections,
+    disconnects and slow sends. A send is slow when the kernel took only
+    part of the message or when it took longer than slow_send seconds.
+
+    Every interval seconds the numbers are printed as one JSON line, and
+    with port set a connection to that port receives them as JSON.
+    """
+
+    PHASES = ('select', 'accept', 'receive', 'format', 'broadcast')
+    BUCKETS = 32
+
+    def __init__(self, interval=10.0, port=None, slow_send=0.001, stream=None):
+        self.interval = interval
+        self.port = port
+        self.slow_send = slow_send
+        self.stream = stream
+        self.histograms = {phase: [0] * self.BUCKETS for phase in self.PHASES}
+        self.totals = dict.fromkeys(self.PHASES, 0.0)
+        self.counters = dict.fromkeys(
+            ('bytes_in', 'bytes_out', 'messages', 'connections', 'disconnects', 'slow_sends'), 0)
+        self.next_dump = time.monotonic() + interval
+
+    def record(self, phase, seconds):
+        # bucket i holds durations below 2**i microseconds
+        bucket = min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)
+        self.histograms[phase][bucket] += 1
+        self.totals[phase] += seconds
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def record_send(self, sent, length, seconds):
+        self.counters['bytes_out'] += sent
+        if sent < length or seconds > self.slow_send:
+            self.counters['slow_sends'] += 1
+
+    def snapshot(self):
+        phases = {}
+        for phase, histogram in self.histograms.items():
+            calls = sum(histogram)
+            phases[phase] = {
+                'calls': calls,
+                'mean_us': round(self.totals[phase] / calls * 1e6, 1) if calls else None,
+                'p50_us': self._percentile(histogram, calls, 0.5),
+                'p99_us': self._percentile(histogram, calls, 0.99),
+                # upper bound in microseconds -> calls, empty buckets left out
+                'histogram': {2 ** i: n for i, n in enumerate(histogram) if n},
+            }
+        return {'phases': phases, 'counters': dict(self.counters)}
+
+    def _percentile(self, histogram, calls, fraction):
+        """Upper bound of the bucket holding the given fraction of the calls."""
+        if not calls:
+            return None
+        seen = 0
+        for i, n in enumerate(histogram):
+            seen += n
+            if seen >= fraction * calls:
+                return 2 ** i
+        return 2 ** (self.BUCKETS - 1)
+
+    def tick(self):
+        """Print the snapshot once every interval seconds."""
+        now = time.monotonic()
+        if now >= self.next_dump:
+            self.next_dump = now + self.interval
+            print(json.dumps(self.snapshot()), file=self.stream or sys.stdout, flush=True)
+
+    def listen(self, host):
+        stats_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stats_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        stats_socket.bind((host, self.port))
+        stats_socket.listen()
+        # port 0 asks the kernel for a free port, report the real one
+        self.port = stats_socket.getsockname()[1]
+        return stats_socket
+
+    def serve(self, stats_socket):
+        """Answer one connection to the stats endpoint and close it."""
+        try:
+            connection, _ = stats_socket.accept()
+        except OSError:
+            return
+        with connection:
+            connection.settimeout(1)
+            try:
+                connection.sendall(json.dumps(self.snapshot()).encode('utf-8') + b'\n')
+            except OSError:
+                pass
+
+
+# socket.sendmsg() is missing on Windows
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+def skip_bytes(parts, count):
+    """Return what is left of the buffers in parts after their first count bytes."""
+    rest = []
+    for part in parts:
+        if count >= len(part):
+            count -= len(part)
+        else:
+            rest.append(memoryview(part)[count:] if count else part)
+            count = 0
+    return rest
+
+
+# 4-byte big-endian length prefix used by the framed wire protocol
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 64 * 1024
+
+
+def encode_frame(payload):
+    """Prefix payload with its length so the receiver can find its end."""
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """Incremental decoder for the length-prefixed frames of one connection.
+
+    Bytes are received straight into a preallocated bytearray with
+    recv_into(), so a single large read can carry many frames and a frame
+    may be split across any number of reads. frames() hands out memoryview
+    slices of that buffer; they stay valid until the next recv_from() or
+    feed() call, copy them with bytes() to keep them longer.
+    """
+
+    __slots__ = ('max_frame_size', '_buf', '_view', '_start', '_end')
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, buffer_size=64 * 1024):
+        self.max_frame_size = max_frame_size
+        # a frame of the maximum size must always fit once compacted
+        self._buf = bytearray(max(buffer_size, FRAME_HEADER.size + max_frame_size))
+        self._view = memoryview(self._buf)
+        # undecoded bytes live in _buf[_start:_end]
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def recv_from(self, sock):
+        """Read what the socket has into the buffer, return the byte count."""
+        self._compact()
+        received = sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Append data that was read some other way."""
+        self._compact()
+        if len(data) > len(self._buf) - self._end:
+            raise ValueError('frame decoder buffer overflow')
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        """Yield the payload of every complete frame in the buffer."""
+        header_size = FRAME_HEADER.size
+        while self._end - self._start >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(self._buf, self._start)
+            if length > self.max_frame_size:
+                raise ValueError(f'frame of {length} bytes exceeds {self.max_frame_size}')
+            begin = self._start + header_size
+            if self._end - begin < length:
+                break
+            self._start = begin + length
+            yield self._view[begin:self._start]
+
+    def _compact(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._start and len(self._buf) - self._end < len(self._buf) // 2:
+            # move the partial frame to the front to make room for the next read
+            pending = self._end - self._start
+            self._buf[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+
+class OutboundBuffer:
+    """Byte ring buffer holding data a client has not been able to take yet.
+
+    Storage is allocated on the first write that cannot go straight to the
+    socket and doubles as needed up to limit, the high-water mark. A write
+    that would cross the limit is refused as a whole, so messages are never
+    truncated. When the pending bytes wrap around the end of the ring both
+    segments are handed to the kernel in a single sendmsg() call.
+    """
+
+    __slots__ = ('limit', '_buf', '_head', '_size')
+
+    INITIAL_CAPACITY = 4096
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._buf = None
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return len(self._buf) if self._buf is not None else 0
+
+    def write(self, *parts):
+        """Queue parts behind what is already pending, False if over the limit."""
+        total = sum(len(part) for part in parts)
+        if self._size + total > self.limit:
+            return False
+        self._reserve(self._size + total)
+
+        capacity = len(self._buf)
+        for data in parts:
+            length = len(data)
+            tail = (self._head + self._size) % capacity
+            first = min(length, capacity - tail)
+            self._buf[tail:tail + first] = data[:first]
+            if first < length:
+                self._buf[:length - first] = data[first:]
+            self._size += length
+        return True
+
+    def send_to(self, sock):
+        """Send as much as the socket takes without blocking, return bytes sent."""
+        if not self._size:
+            return 0
+        view = memoryview(self._buf)
+        end = self._head + self._size
+        capacity = len(self._buf)
+        try:
+            if end <= capacity:
+                sent = sock.send(view[self._head:end])
+            elif hasattr(sock, 'sendmsg'):
+                sent = sock.sendmsg([view[self._head:], view[:end - capacity]])
+            else:
+                sent = sock.send(view[self._head:])
+        except (BlockingIOError, InterruptedError):
+            return 0
+        finally:
+            view.release()
+
+        self._size -= sent
+        self._head = (self._head + sent) % capacity if self._size else 0
+        return sent
+
+    def _reserve(self, needed):
+        capacity = self.capacity
+        if needed <= capacity:
+            return
+        new_capacity = max(capacity, self.INITIAL_CAPACITY)
+        while new_capacity < needed:
+            new_capacity *= 2
+        new_buf = bytearray(min(new_capacity, max(self.limit, needed)))
+
+        # linearize the pending bytes at the start of the new storage
+        if self._size:
+            end = self._head + self._size
+            if end <= capacity:
+                new_buf[:self._size] = self._buf[self._head:end]
+            else:
+                first = capacity - self._head
+                new_buf[:first] = self._buf[self._head:]
+                new_buf[first:self._size] = self._buf[:end - capacity]
+        self._buf = new_buf
+        self._head = 0
+
+
+# room name length in front of every message relayed between shards
+BUS_HEADER = struct.Struct('!H')
+
+
+class BusLink:
+    """One end of the Unix stream connection between two shards."""
+
+    __slots__ = ('sock', 'outbox', 'decoder')
+
+    def __init__(self, sock, high_water_mark, max_frame_size):
+        sock.setblocking(False)
+        self.sock = sock
+        self.outbox = OutboundBuffer(high_water_mark)
+        self.decoder = FrameDecoder(max_frame_size, buffer_size=256 * 1024)
+
+
+class ShardBus:
+    """Relay for broadcasts between ChatServer worker processes.
+
+    Created in the parent before forking: a full mesh of AF_UNIX stream
+    socketpairs, one per pair of shards. After fork() each worker keeps
+    the ends that belong to it (attach) and the ChatServer registers them
+    with its selector. Relayed broadcasts are length-prefixed frames that
+    go through the same OutboundBuffer and FrameDecoder as client traffic,
+    so a publish never blocks the event loop. If a peer shard falls more
+    than high_water_mark bytes behind, messages to it are dropped and
+    counted in dropped. A link that fails or carries a malformed frame is
+    closed, the other links carry on.
+    """
+
+    # largest relayed frame: room name, header and a framed maximum size message
+    MAX_MESSAGE = BUS_HEADER.size + MAX_ROOM_NAME + 2 * (FRAME_HEADER.size + MAX_FRAME_SIZE)
+
+    def __init__(self, shards, high_water_mark=16 * 1024 * 1024):
+        self.high_water_mark = high_water_mark
+        # key: (from shard, to shard), value: socket the first uses to reach the second
+        self.ends = {}
+        for i in range(shards):
+            for j in range(i + 1, shards):
+                self.ends[i, j], self.ends[j, i] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.index = None
+        # key: socket, value: BusLink to one peer shard
+        self.links = {}
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def attach(self, index):
+        """Become shard index, called in the worker process after fork()."""
+        self.index = index
+        for (source, _), sock in self.ends.items():
+            if source == index:
+                self.links[sock] = BusLink(sock, self.high_water_mark, self.MAX_MESSAGE)
+            else:
+                sock.close()
+        self.ends = {}
+
+    def register(self, selector):
+        for sock in self.links:
+            selector.register(sock, selectors.EVENT_READ, self)
+
+    def publish(self, room, message, selector):
+        frame = encode_frame(BUS_HEADER.pack(len(room)) + room + message)
+        for link in list(self.links.values()):
+            sent = 0
+            if not link.outbox:
+                try:
+                    sent = link.sock.send(frame)
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError as e:
+                    self.drop(link.sock, selector, e)
+                    continue
+                if sent == len(frame):
+                    self.published += 1
+                    continue
+            was_empty = not link.outbox
+            if link.outbox.write(memoryview(frame)[sent:]):
+                self.published += 1
+                if was_empty:
+                    selector.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+            else:
+                self.dropped += 1
+
+    def handle(self, sock, mask, selector):
+        """Service a ready link, return the (room, message) pairs it carried."""
+        link = self.links[sock]
+        relayed = []
+        try:
+            if mask & selectors.EVENT_WRITE:
+                link.outbox.send_to(sock)
+                if not link.outbox:
+                    selector.modify(sock, selectors.EVENT_READ, self)
+
+            if mask & selectors.EVENT_READ:
+                try:
+                    received = link.decoder.recv_from(sock)
+                except (BlockingIOError, InterruptedError):
+                    return relayed
+                if not received:
+                    # the peer shard exited
+                    self.drop(sock, selector)
+                    return relayed
+                for frame in link.decoder.frames():
+                    (length,) = BUS_HEADER.unpack_from(frame)
+                    start = BUS_HEADER.size
+                    relayed.append((bytes(frame[start:start + length]), frame[start + length:]))
+        except (OSError, ValueError, struct.error) as e:
+            # the frames decoded before the error are still delivered
+            self.drop(sock, selector, e)
+        self.delivered += len(relayed)
+        return relayed
+
+    def drop(self, sock, selector, error=None):
+        """Stop relaying over a link, logging why if it failed."""
+        if error is not None:
+            print(f'Dropping shard bus link: {error}')
+        selector.unregister(sock)
+        del self.links[sock]
+        sock.close()
+
+    def close(self):
+        for sock in list(self.ends.values()) + list(self.links):
+            sock.close()
+
+
+class MessageHistory:
+    """The last capacity messages of one room, oldest first.
+
+    Messages live in a list of slots allocated once; _start and _count
+    mark the occupied part, so appending never grows or shifts anything
+    and the oldest message is simply overwritten once the ring is full.
+    """
+
+    __slots__ = ('_slots', '_start', '_count')
+
+    def __init__(self, capacity):
+        self._slots = [None] * capacity
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, message):
+        capacity = len(self._slots)
+        if self._count < capacity:
+            self._slots[(self._start + self._count) % capacity] = message
+            self._count += 1
+        else:
+            self._slots[self._start] = message
+            self._start = (self._start + 1) % capacity
+
+    def replay(self, max_bytes=None, newline=False):
+        """The newest messages that fit in max_bytes, oldest first, in one buffer for a single write.
+
+        With newline every message that does not end in b'\\n' gets one, so
+        unframed messages do not run together.
+        """
+        capacity = len(self._slots)
+        messages = []
+        size = 0
+        for i in range(self._count - 1, -1, -1):
+            message = self._slots[(self._start + i) % capacity]
+            if newline and not message.endswith(b'\n'):
+                message += b'\n'
+            size += len(message)
+            if max_bytes is not None and size > max_bytes:
+                break
+            messages.append(message)
+        messages.reverse()
+        return b''.join(messages)
+
+
+# every log segment starts with LOG_MAGIC and b'F' (framed) or b'R' (raw)
+LOG_MAGIC = b'CHATLOG1'
+# room name length and message length in front of every log record
+LOG_RECORD = struct.Struct('!HI')
+
+
+class SegmentLog:
+    """Append-only on-disk copy of the chat history in numbered segments.
+
+    Records are appended with one unbuffered write each. A new segment is
+    started on every restart and whenever the current one reaches
+    segment_size bytes, and only the newest max_segments are kept. On
+    restart replay() memory-maps each segment and walks the records in
+    place instead of reading the files into memory; a record cut short by
+    a crash ends the replay of its segment. Messages are stored in wire
+    format, so segments written with the other framed setting are skipped.
+    """
+
+    def __init__(self, directory, framed, segment_size=16 * 1024 * 1024, max_segments=4):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.header = LOG_MAGIC + (b'F' if framed else b'R')
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.segments = sorted(name for name in os.listdir(directory) if name.endswith('.log'))
+        self.file = None
+
+    def replay(self):
+        """Yield (room, message) for every record, oldest first."""
+        for name in self.segments:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size <= len(self.header):
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+                    if segment[:len(self.header)] != self.header:
+                        continue
+                    offset = len(self.header)
+                    while offset + LOG_RECORD.size <= size:
+                        room_length, message_length = LOG_RECORD.unpack_from(segment, offset)
+                        start = offset + LOG_RECORD.size
+                        end = start + room_length + message_length
+                        if end > size:
+                            break
+                        yield segment[start:start + room_length], segment[start + room_length:end]
+                        offset = end
+
+    def append(self, room, message):
+        if self.file is None or self.file.tell() >= self.segment_size:
+            self._roll()
+        self.file.write(LOG_RECORD.pack(len(room), len(message)) + room + message)
+
+    def _roll(self):
+        if self.file is not None:
+            self.file.close()
+        number = int(self.segments[-1].split('.')[0]) + 1 if self.segments else 0
+        name = f'{number:08d}.log'
+        self.file = open(os.path.join(self.directory, name), 'wb', buffering=0)
+        self.file.write(self.header)
+        self.segments.append(name)
+        while len(self.segments) > self.max_segments:
+            os.remove(os.path.join(self.directory, self.segments.pop(0)))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Client:
+    """State kept for one connection registered with the ChatServer selector."""
+
+    __slots__ = ('sock', 'address', 'user', 'prefix', 'outbox', 'decoder', 'closed',
+                 'rooms', 'room', 'bytes_sent', 'peak_queued', 'dropped')
+
+    def __init__(self, sock, address, high_water_mark, framed=False):
+        self.sock = sock
+        self.address = address
+        # nickname, None until the first message (the handshake) arrives
+        self.user = None
+        # b'nick: ', put in front of every message the client sends
+        self.prefix = None
+        self.outbox = OutboundBuffer(high_water_mark)
+        self.decoder = FrameDecoder() if framed else None
+        self.closed = False
+        # reverse index of ChatServer.rooms, and where plain messages go
+        self.rooms = set()
+        self.room = None
+
+        # queue metrics, see ChatServer.queue_stats()
+        self.bytes_sent = 0
+        self.peak_queued = 0
+        self.dropped = 0
+
+    def name(self):
+        if self.user is not None:
+            return self.user.decode('utf-8', 'replace')
+        return '{}:{}'.format(*self.address[:2])
+
+
+class ChatServer:
+    """Group chat server driven by a selectors event loop (epoll on Linux).
+
+    start_server() rebuilds and rescans a Python list with select.select()
+    on every wakeup and cannot watch descriptors above FD_SETSIZE (1024).
+    Here every socket is registered with the selector exactly once, so a
+    wakeup only costs work proportional to the sockets that are ready and
+    the number of connections is bounded by the file descriptor limit only.
+
+    Client sockets are non-blocking. A broadcast sends directly while a
+    peer keeps up and otherwise parks the rest in that peer's
+    OutboundBuffer, which is drained when the socket becomes writable.
+    A peer whose backlog would exceed high_water_mark bytes is a slow
+    consumer: with slow_consumer='disconnect' it is dropped, with 'shed'
+    the message is discarded for that peer only and counted.
+
+    With framed=True every message in both directions, the nickname
+    handshake included, carries a 4-byte length prefix (see encode_frame),
+    so messages survive TCP coalescing and segmentation. Otherwise each
+    recv() is taken as one message like start_server() does.
+
+    Clients talk in named rooms. Everyone starts in DEFAULT_ROOM, '/join
+    <room>' enters a room and makes it the target of plain messages and
+    '/part <room>' leaves it. The room -> members index makes a fan-out
+    cost O(room size), and the client -> rooms reverse index lets a
+    disconnect leave every room without scanning the others.
+
+    With reuse_port=True several processes can listen on the same port
+    (see start_shards); a ShardBus passed as bus then carries every room
+    broadcast to the other processes, which deliver it to their members.
+
+    Every room keeps its last history_size messages in a MessageHistory
+    and a client joining the room gets them replayed in a single write,
+    as many of the newest as fit in half of high_water_mark.
+    With history_log set to a directory the history is also appended to a
+    SegmentLog there and restored from it on the next start.
+
+    Pass a LoopStats as stats to time the phases of the loop.
+
+    Messages are never decoded on the way through: the b'nick: ' prefix of
+    a client is built once at the handshake and sent together with the
+    received payload (and frame header) in one sendmsg() call, without
+    concatenating them. log_messages=False also skips decoding messages
+    for the log.
+    """
+
+    # how many pending connections to accept per wakeup of the listening socket
+    ACCEPT_BATCH = 64
+
+    def __init__(self, host=HOST, port=PORT, backlog=socket.SOMAXCONN,
+                 high_water_mark=256 * 1024, slow_consumer='disconnect', framed=False,
+                 reuse_port=False, bus=None, history_size=50, history_log=None, stats=None,
+                 log_messages=True):
+        if slow_consumer not in ('disconnect', 'shed'):
+            raise ValueError(f'unknown slow consumer policy: {slow_consumer}')
+        self.high_water_mark = high_water_mark
+        self.slow_consumer = slow_consumer
+        self.framed = framed
+        self.log_messages = log_messages
+
+        self.selector = selectors.DefaultSelector()
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(backlog)
+        self.server_socket.setblocking(False)
+
+        # port 0 asks the kernel for a free port, report the real one
+        self.host, self.port = self.server_socket.getsockname()[:2]
+
+        # the listening socket is the only key registered without data
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+        self.bus = bus
+        if bus is not None:
+            bus.register(self.selector)
+
+        self.stats = stats
+        if stats is not None and stats.port is not None:
+            self.selector.register(stats.listen(host), selectors.EVENT_READ, stats)
+
+        # key: client socket, value: Client, only after the nickname handshake
+        self.clients = {}
+        # key: room name, value: set of member Clients, empty rooms are removed
+        self.rooms = {}
+        self.slow_disconnects = 0
+
+        # key: room name, value: MessageHistory, kept when the room empties
+        self.history_size = history_size
+        self.history = {}
+        self.log = None
+        if history_size and history_log is not None:
+            self.log = SegmentLog(history_log, framed)
+            for room, message in self.log.replay():
+                self.remember(room, message, persist=False)
+
+    def serve_forever(self):
+        print(f'Listening for connections on {self.host}:{self.port} ({type(self.selector).__name__})...')
+        # with stats the loop wakes up at least once per dump interval
+        timeout = self.stats.interval if self.stats is not None else None
+        try:
+            while True:
+                self.run_once(timeout)
+        finally:
+            self.close()
+
+    def run_once(self, timeout=None):
+        """Wait for readiness once and handle every ready socket."""
+        stats = self.stats
+        if stats is None:
+            events = self.selector.select(timeout)
+        else:
+            stats.tick()
+            started = time.perf_counter()
+            events = self.selector.select(timeout)
+            stats.record('select', time.perf_counter() - started)
+
+        for key, mask in events:
+            client = key.data
+            if client is None:
+                self.accept()
+                continue
+            if client is self.bus:
+                self.relay(key.fileobj, mask)
+                continue
+            if client is stats:
+                stats.serve(key.fileobj)
+                continue
+            # an earlier event in this batch may have disconnected the client
+            if not client.closed and mask & selectors.EVENT_WRITE:
+                self.flush(client)
+            if not client.closed and mask & selectors.EVENT_READ:
+                self.handle_read(client)
+        return len(events)
+
+    def accept(self):
+        for _ in range(self.ACCEPT_BATCH):
+            if self.stats is not None:
+                started = time.perf_counter()
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client_socket.setblocking(False)
+            # a broadcast is a single write, there is nothing to coalesce
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # the nickname is read once the socket turns readable, so a slow
+            # client cannot stall the loop during the handshake
+            client = Client(client_socket, client_address, self.high_water_mark, self.framed)
+            self.selector.register(client_socket, selectors.EVENT_READ, client)
+            if self.stats is not None:
+                self.stats.record('accept', time.perf_counter() - started)
+                self.stats.count('connections')
+
+    def handle_read(self, client):
+        if client.decoder is not None:
+            self.handle_frames(client)
+            return
+
+        if self.stats is not None:
+            started = time.perf_counter()
+        try:
+            message = client.sock.recv(1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            message = b''
+        if self.stats is not None:
+            self.stats.record('receive', time.perf_counter() - started)
+            self.stats.count('bytes_in', len(message))
+
+        if not message:
+            self.disconnect(client)
+            return
+        self.handle_message(client, message)
+
+    def handle_frames(self, client):
+        if self.stats is not None:
+            started = time.perf_counter()
+        try:
+            received = client.decoder.recv_from(client.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+        if self.stats is not None:
+            self.stats.record('receive', time.perf_counter() - started)
+            self.stats.count('bytes_in', received)
+
+        if not received:
+            self.disconnect(client)
+            return
+
+        try:
+            for message in client.decoder.frames():
+                self.handle_message(client, message)
+                if client.closed:
+                    return
+        except ValueError as e:
+            print(f'Protocol error from {client.name()}: {e}')
+            self.disconnect(client)
+
+    def handle_message(self, client, message):
+        if client.user is None:
+            client.user = bytes(message)
+            client.prefix = client.user + b': '
+            self.clients[client.sock] = client
+            print('Accepted new connection from {}:{}, nickname: {}'.format(*client.address[:2], client.name()))
+            self.join(client, DEFAULT_ROOM)
+            self.replay_history(client, DEFAULT_ROOM)
+            return
+
+        if message[:1] == b'/':
+            self.handle_command(client, bytes(message))
+            return
+
+        if client.room is None:
+            self.notice(client, b'* you are not in a room, use /join <room>')
+            return
+
+        stats = self.stats
+        if stats is not None:
+            stats.count('messages')
+            started = time.perf_counter()
+
+        if self.log_messages:
+            print(f'Received message from {client.name()}: {bytes(message).decode("utf-8", "replace")}')
+        if self.framed:
+            parts = (FRAME_HEADER.pack(len(client.prefix) + len(message)), client.prefix, message)
+        else:
+            parts = (client.prefix, message)
+
+        if stats is not None:
+            stats.record('format', time.perf_counter() - started)
+            started = time.perf_counter()
+        self.broadcast(parts, client, self.rooms[client.room])
+        if stats is not None:
+            stats.record('broadcast', time.perf_counter() - started)
+
+        # history and other shards need the message in one piece
+        if self.history_size or self.bus is not None:
+            full_message = b''.join(parts)
+            self.remember(client.room, full_message)
+            if self.bus is not None:
+                self.bus.publish(client.room, full_message, self.selector)
+
+    def relay(self, sock, mask):
+        """Deliver broadcasts other shards published to the local members."""
+        for room, message in self.bus.handle(sock, mask, self.selector):
+            members = self.rooms.get(room)
+            if members:
+                self.broadcast((message,), None, members)
+            self.remember(room, message)
+
+    def handle_command(self, client, message):
+        command, _, room = message.strip().partition(b' ')
+        command = command.lower()
+        room = room.strip()
+        if command not in (b'/join', b'/part'):
+            self.notice(client, b'* unknown command ' + command)
+        elif not room or len(room) > MAX_ROOM_NAME or b' ' in room:
+            self.notice(client, b'* usage: ' + command + b' <room>')
+        elif command == b'/join':
+            already_joined = room in client.rooms
+            self.join(client, room)
+            self.notice(client, b'* joined ' + room)
+            if not already_joined:
+                self.replay_history(client, room)
+        elif room not in client.rooms:
+            self.notice(client, b'* not in ' + room)
+        else:
+            self.part(client, room)
+            self.notice(client, b'* left ' + room)
+
+    def join(self, client, room):
+        members = self.rooms.get(room)
+        if members is None:
+            members = self.rooms[room] = set()
+        members.add(client)
+        client.rooms.add(room)
+        client.room = room
+
+    def part(self, client, room):
+        members = self.rooms[room]
+        members.discard(client)
+        if not members:
+            del self.rooms[room]
+        client.rooms.discard(room)
+        if client.room == room:
+            # keep talking in any room still joined, if there is one
+            client.room = next(iter(client.rooms), None)
+
+    def remember(self, room, message, persist=True):
+        """Add a broadcast message to the history of room."""
+        if not self.history_size:
+            return
+        history = self.history.get(room)
+        if history is None:
+            history = self.history[room] = MessageHistory(self.history_size)
+        message = bytes(message)
+        history.append(message)
+        if persist and self.log is not None:
+            self.log.append(room, message)
+
+    def replay_history(self, client, room):
+        history = self.history.get(room)
+        if not history:
+            return
+        # the replay must leave room for live messages, or a joining client
+        # would be a slow consumer from the start
+        data = history.replay(self.high_water_mark // 2, newline=not self.framed)
+        if data and not self.send(client, data):
+            self.disconnect(client)
+
+    def notice(self, client, text):
+        """Send a server notice to one client only."""
+        if self.framed:
+            data = encode_frame(text)
+        else:
+            data = text + b'\n'
+        if not self.send(client, data):
+            self.disconnect(client)
+
+    def broadcast(self, parts, sender, members):
+        """Send the message made of parts to every member but sender without ever blocking."""
+        slow = []
+        for peer in members:
+            if peer is not sender and not self.send(peer, *parts):
+                slow.append(peer)
+        for peer in slow:
+            self.slow_disconnects += 1
+            print(f'Disconnecting slow consumer {peer.name()}: {len(peer.outbox)} bytes queued')
+            self.disconnect(peer)
+
+    def send(self, client, *parts):
+        """Send or queue the parts of one message for client, False if it has to be disconnected."""
+        sent = 0
+        if not client.outbox:
+            # fast path: nothing queued, hand the data straight to the kernel
+            if self.stats is not None:
+                started = time.perf_counter()
+            try:
+                if len(parts) == 1:
+                    sent = client.sock.send(parts[0])
+                elif HAVE_SENDMSG:
+                    sent = client.sock.sendmsg(parts)
+                else:
+                    sent = client.sock.send(b''.join(parts))
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                return False
+            length = sum(len(part) for part in parts)
+            client.bytes_sent += sent
+            if self.stats is not None:
+                self.stats.record_send(sent, length, time.perf_counter() - started)
+            if sent == length:
+                return True
+            parts = skip_bytes(parts, sent)
+
+        was_empty = not client.outbox
+        if not client.outbox.write(*parts):
+            # the tail of a partly sent message cannot be shed without
+            # corrupting the stream, so that case always disconnects
+            if self.slow_consumer == 'disconnect' or sent:
+                return False
+            client.dropped += 1
+            return True
+
+        client.peak_queued = max(client.peak_queued, len(client.outbox))
+        if was_empty:
+            self.selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        return True
+
+    def flush(self, client):
+        try:
+            sent = client.outbox.send_to(client.sock)
+        except OSError:
+            self.disconnect(client)
+            return
+        client.bytes_sent += sent
+        if self.stats is not None:
+            self.stats.count('bytes_out', sent)
+        if not client.outbox:
+            self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def queue_stats(self):
+        """Per-client outbound queue metrics keyed by nickname."""
+        return {
+            client.name(): {
+                'queued': len(client.outbox),
+                'peak_queued': client.peak_queued,
+                'capacity': client.outbox.capacity,
+                'bytes_sent': client.bytes_sent,
+                'dropped': client.dropped,
+            }
+            for client in self.clients.values()
+        }
+
+    def disconnect(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        if self.stats is not None:
+            self.stats.count('disconnects')
+        if client.user is not None:
+            print('Closed connection from: {}'.format(client.name()))
+            del self.clients[client.sock]
+        for room in list(client.rooms):
+            self.part(client, room)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        if self.log is not None:
+            self.log.close()
+
+
+def start_shards(workers, host=HOST, port=PORT, **options):
+    """Fork workers ChatServer processes sharing host:port via SO_REUSEPORT.
+
+    The kernel spreads new connections over the workers' listening
+    sockets, and every worker relays its broadcasts to the others over a
+    ShardBus so a room spans all of them. Returns the worker pids and the
+    port, which is picked by the kernel when port is 0.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+        raise OSError('sharded mode needs SO_REUSEPORT and fork()')
+
+    # hold the port for the group while the workers bind to it
+    reservation = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reservation.bind((host, port))
+    port = reservation.getsockname()[1]
+
+    bus = ShardBus(workers)
+    # every worker writes one byte here once it is listening
+    ready_read, ready_write = os.pipe()
+    pids = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                reservation.close()
+                os.close(ready_read)
+                bus.attach(index)
+                if options.get('history_log'):
+                    # every shard logs all it sees, so one shard's log is a full copy
+                    options['history_log'] = os.path.join(options['history_log'], f'shard{index}')
+                server = ChatServer(host, port, reuse_port=True, bus=bus, **options)
+                os.write(ready_write, b'.')
+                os.close(ready_write)
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        pids.append(pid)
+
+    bus.close()
+    reservation.close()
+    os.close(ready_write)
+    try:
+        ready = 0
+        while ready < workers:
+            data = os.read(ready_read, workers)
+            if not data:
+                stop_shards(pids)
+                raise OSError('a chat worker failed to start')
+            ready += len(data)
+    finally:
+        os.close(ready_read)
+    return pids, port
+
+
+def stop_shards(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def serve_sharded(workers=None, host=HOST, port=PORT, **options):
+    workers = workers or os.cpu_count() or 1
+    pids, port = start_shards(workers, host, port, **options)
+    print(f'Started {workers} workers on {host}:{port}')
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        stop_shards(pids)
+
+
+def raise_fd_limit(wanted):
+    """Raise the soft RLIMIT_NOFILE towards wanted, return the new soft limit."""
+    try:
+        import resource
+    except ImportError:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        soft = target
+    return soft
+
+
+def benchmark_wakeup(counts=(10, 100, 500, 1000, 5000, 10000), wakeups=2000):
+    """Measure the cost of one wakeup with N idle connections and one active.
+
+    Connections are simulated with socketpairs whose both ends are watched;
+    one socket always has a byte pending, so each poll returns exactly one
+    ready socket. select.select() is only measured below FD_SETSIZE because
+    it refuses higher descriptors.
+    """
+    limit = raise_fd_limit(max(counts) + 64)
+    results = []
+    for count in counts:
+        if count + 64 > limit:
+            print(f'skipping {count} connections: RLIMIT_NOFILE is {limit}')
+            continue
+
+        pairs = [socket.socketpair() for _ in range((count + 1) // 2)]
+        watched = [sock for pair in pairs for sock in pair][:count]
+        pairs[0][0].send(b'x')
+
+        selector = selectors.DefaultSelector()
+        for sock in watched:
+            selector.register(sock, selectors.EVENT_READ)
+        start = time.perf_counter()
+        for _ in range(wakeups):
+            selector.select(0)
+        selector_us = (time.perf_counter() - start) / wakeups * 1e6
+        selector.close()
+
+        select_us = None
+        if max(sock.fileno() for sock in watched) < 1024:
+            start = time.perf_counter()
+            for _ in range(wakeups):
+                select.select(watched, [], [], 0)
+            select_us = (time.perf_counter() - start) / wakeups * 1e6
+
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+        results.append((count, selector_us, select_us))
+        select_text = f'{select_us:8.2f} us' if select_us is not None else '   n/a (fd >= FD_SETSIZE)'
+        print(f'{count:6d} connections: {type(selector).__name__} {selector_us:8.2f} us, select.select {select_text}')
+    return results
 
 
 # A 'null' stream that discards anything written to it
@@ -239,10 +1418,662 @@ class TestChatServer(unittest.TestCase):
         print()
 
 
+class TestLoopStats(unittest.TestCase):
+
+    def test_histogram_and_percentiles(self):
+        print('Testing loop stats histogram ...')
+        stats = LoopStats()
+        for _ in range(99):
+            stats.record('receive', 0.000003)
+        stats.record('receive', 0.002)
+        receive = stats.snapshot()['phases']['receive']
+        self.assertEqual(receive['calls'], 100)
+        self.assertEqual(receive['p50_us'], 4)
+        self.assertEqual(receive['p99_us'], 4)
+        self.assertEqual(receive['histogram'], {4: 99, 2048: 1})
+        print()
+
+    def test_broadcast_counts_partial_sends(self):
+        print('Testing broadcast stats ...')
+        stats = LoopStats()
+        sender, fast, slow = MagicMock(), MagicMock(), MagicMock()
+        fast.send.return_value = 5
+        slow.send.return_value = 2
+        broadcast(b'hello', sender, {sender: b's', fast: b'f', slow: b'l'}, stats)
+        self.assertEqual(stats.counters['bytes_out'], 7)
+        self.assertEqual(stats.counters['slow_sends'], 1)
+        print()
+
+    @patch('socket.socket')
+    @patch('select.select')
+    def test_start_server_records_phases(self, mock_select, mock_socket):
+        print('Testing start_server stats ...')
+        mock_server_socket = MagicMock()
+        mock_client_socket = MagicMock()
+        mock_socket.return_value = mock_server_socket
+        mock_server_socket.accept.return_value = (mock_client_socket, ('127.0.0.1', 12345))
+        mock_client_socket.recv.side_effect = [b'TestUser', b'hi', b'']
+        mock_client_socket.send.return_value = 0
+        mock_select.side_effect = [
+            ([mock_server_socket], [], []),
+            ([mock_client_socket], [], []),
+            ([mock_client_socket], [], []),
+            KeyboardInterrupt,
+        ]
+
+        stats = LoopStats(stream=NullWriter())
+        with self.assertRaises(KeyboardInterrupt):
+            start_server(stats)
+
+        phases = stats.snapshot()['phases']
+        self.assertEqual(phases['select']['calls'], 3)
+        self.assertEqual(phases['accept']['calls'], 1)
+        self.assertEqual(phases['receive']['calls'], 2)
+        self.assertEqual(phases['broadcast']['calls'], 1)
+        self.assertEqual(stats.counters['messages'], 1)
+        self.assertEqual(stats.counters['bytes_in'], 2)
+        self.assertEqual(stats.counters['disconnects'], 1)
+        print()
+
+    @patch('time.perf_counter')
+    def test_send_records_duration(self, mock_perf_counter):
+        print('Testing ChatServer send stats ...')
+        server = ChatServer(port=0, stats=LoopStats(slow_send=0.001, stream=NullWriter()))
+        try:
+            client = Client(MagicMock(), ('127.0.0.1', 12345), 4096)
+            client.sock.send.return_value = client.sock.sendmsg.return_value = 5
+            # the kernel takes the whole message, but only after 2 ms
+            mock_perf_counter.side_effect = [1.0, 1.002, 2.0, 2.0001]
+            self.assertTrue(server.send(client, b'he', b'llo'))
+            self.assertTrue(server.send(client, b'hello'))
+            self.assertEqual(server.stats.counters['bytes_out'], 10)
+            self.assertEqual(server.stats.counters['slow_sends'], 1)
+        finally:
+            server.close()
+        print()
+
+    def test_stats_endpoint(self):
+        print('Testing stats endpoint ...')
+        server = ChatServer(port=0, stats=LoopStats(port=0, stream=NullWriter()))
+        try:
+            peer = socket.create_connection((server.host, server.stats.port))
+            peer.settimeout(2)
+            server.run_once(timeout=0.05)
+            snapshot = json.loads(peer.makefile('rb').readline())
+            peer.close()
+            self.assertEqual(set(snapshot['phases']), set(LoopStats.PHASES))
+            self.assertEqual(snapshot['phases']['select']['calls'], 1)
+        finally:
+            server.close()
+        print()
+
+
+class TestSelectorChatServer(unittest.TestCase):
+    """Exercise ChatServer over real loopback sockets."""
+
+    def setUp(self):
+        self.server = ChatServer(port=0)
+        self.peers = []
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+        self.server.close()
+
+    def connect(self, nickname):
+        peer = socket.create_connection((self.server.host, self.server.port))
+        peer.settimeout(2)
+        peer.send(nickname)
+        self.peers.append(peer)
+        self.pump()
+        return peer
+
+    def pump(self, rounds=3):
+        for _ in range(rounds):
+            self.server.run_once(timeout=0.05)
+
+    def shrink_send_buffer(self, nickname):
+        for client in self.server.clients.values():
+            if client.user == nickname:
+                client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    def test_handshake_registers_nickname(self):
+        print('Testing selector handshake ...')
+        self.connect(b'alice')
+        self.assertEqual([client.user for client in self.server.clients.values()], [b'alice'])
+        print()
+
+    def test_nickname_that_is_not_utf8(self):
+        print('Testing selector handshake with a bad nickname ...')
+        with patch('builtins.print') as mock_print:
+            mallory = self.connect(b'\xffmallory')
+            bob = self.connect(b'bob')
+            mallory.send(b'hi')
+            self.pump()
+            self.assertEqual(bob.recv(1024), b'\xffmallory: hi')
+            mallory.close()
+            self.peers.remove(mallory)
+            self.pump()
+        mock_print.assert_any_call('Closed connection from: \ufffdmallory')
+        self.assertEqual([client.user for client in self.server.clients.values()], [b'bob'])
+        print()
+
+    def test_message_is_broadcast_to_others(self):
+        print('Testing selector broadcast ...')
+        alice = self.connect(b'alice')
+        bob = self.connect(b'bob')
+
+        alice.send(b'hi bob')
+        self.pump()
+
+        self.assertEqual(bob.recv(1024), b'alice: hi bob')
+        alice.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            alice.recv(1024)
+        print()
+
+    def test_payload_is_relayed_without_decoding(self):
+        print('Testing bytes-only broadcast ...')
+        self.server.log_messages = False
+        alice = self.connect(b'alice')
+        bob = self.connect(b'bob')
+
+        # not valid UTF-8, the server must not try to decode it
+        alice.send(b'\xff\xfe raw')
+        self.pump()
+
+        self.assertEqual(bob.recv(1024), b'alice: \xff\xfe raw')
+        print()
+
+    def test_send_uses_scatter_gather(self):
+        print('Testing sendmsg fast path ...')
+        client = Client(MagicMock(), ('127.0.0.1', 12345), 1024)
+        client.sock.sendmsg.return_value = 3
+
+        with patch.object(self.server, 'selector') as mock_selector:
+            self.assertTrue(self.server.send(client, b'header', b'alice: ', b'hi'))
+            mock_selector.modify.assert_called_once()
+
+        client.sock.sendmsg.assert_called_once_with((b'header', b'alice: ', b'hi'))
+        client.sock.send.assert_not_called()
+        # the unsent rest is queued without joining the parts first
+        self.assertEqual(len(client.outbox), 12)
+        print()
+
+    def test_disconnect_unregisters_socket(self):
+        print('Testing selector disconnect ...')
+        alice = self.connect(b'alice')
+        alice.close()
+        self.peers.remove(alice)
+        self.pump()
+
+        self.assertEqual(self.server.clients, {})
+        # only the listening socket is left in the selector
+        self.assertEqual(len(self.server.selector.get_map()), 1)
+        print()
+
+    def test_slow_consumer_is_disconnected(self):
+        print('Testing slow consumer disconnect ...')
+        self.server.close()
+        self.server = ChatServer(port=0, high_water_mark=4096)
+        alice = self.connect(b'alice')
+        self.connect(b'bob')
+        self.shrink_send_buffer(b'bob')
+
+        # bob never reads, so his queue grows until the high-water mark
+        alice.setblocking(False)
+        for _ in range(2000):
+            try:
+                alice.send(b'x' * 1000)
+            except BlockingIOError:
+                pass
+            self.pump(1)
+            if len(self.server.clients) == 1:
+                break
+
+        self.assertEqual([client.user for client in self.server.clients.values()], [b'alice'])
+        self.assertEqual(self.server.slow_disconnects, 1)
+        print()
+
+    def test_slow_consumer_is_shed(self):
+        print('Testing slow consumer shedding ...')
+        self.server.close()
+        self.server = ChatServer(port=0, high_water_mark=4096, slow_consumer='shed')
+        alice = self.connect(b'alice')
+        self.connect(b'bob')
+        self.shrink_send_buffer(b'bob')
+
+        alice.setblocking(False)
+        for _ in range(2000):
+            try:
+                alice.send(b'x' * 1000)
+            except BlockingIOError:
+                pass
+            self.pump(1)
+            stats = self.server.queue_stats()
+            if stats['bob']['dropped']:
+                break
+
+        self.assertEqual(len(self.server.clients), 2)
+        self.assertGreater(stats['bob']['dropped'], 0)
+        self.assertLessEqual(stats['bob']['queued'], 4096)
+        print()
+
+
+class TestChatRooms(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ChatServer(port=0)
+        self.peers = {}
+
+    def tearDown(self):
+        for peer in self.peers.values():
+            peer.close()
+        self.server.close()
+
+    def connect(self, nickname):
+        peer = socket.create_connection((self.server.host, self.server.port))
+        peer.settimeout(2)
+        peer.send(nickname)
+        self.peers[nickname] = peer
+        self.pump()
+        return peer
+
+    def say(self, nickname, message):
+        self.peers[nickname].send(message)
+        self.pump()
+
+    def pump(self, rounds=3):
+        for _ in range(rounds):
+            self.server.run_once(timeout=0.05)
+
+    def received(self, nickname):
+        peer = self.peers[nickname]
+        peer.setblocking(False)
+        try:
+            return peer.recv(65536)
+        except BlockingIOError:
+            return b''
+        finally:
+            peer.settimeout(2)
+
+    def members(self, room):
+        return sorted(client.user for client in self.server.rooms.get(room, ()))
+
+    def test_clients_start_in_the_default_room(self):
+        print('Testing default room ...')
+        self.connect(b'alice')
+        self.connect(b'bob')
+        self.assertEqual(self.members(DEFAULT_ROOM), [b'alice', b'bob'])
+        print()
+
+    def test_message_only_reaches_room_members(self):
+        print('Testing room fan-out ...')
+        for nickname in (b'alice', b'bob', b'carol'):
+            self.connect(nickname)
+        self.say(b'alice', b'/join dev')
+        self.say(b'bob', b'/join dev')
+        self.assertEqual(self.members(b'dev'), [b'alice', b'bob'])
+        self.received(b'alice')
+
+        self.say(b'bob', b'build is green')
+
+        self.assertEqual(self.received(b'alice'), b'bob: build is green')
+        self.assertEqual(self.received(b'carol'), b'')
+        print()
+
+    def test_part_and_disconnect_update_both_indexes(self):
+        print('Testing part and disconnect ...')
+        self.connect(b'alice')
+        self.say(b'alice', b'/JOIN dev')
+        self.say(b'alice', b'/part lobby')
+        self.assertEqual(self.members(DEFAULT_ROOM), [])
+        self.assertNotIn(DEFAULT_ROOM, self.server.rooms)
+
+        client = next(iter(self.server.clients.values()))
+        self.assertEqual(client.rooms, {b'dev'})
+
+        self.peers.pop(b'alice').close()
+        self.pump()
+        self.assertEqual(self.server.rooms, {})
+        print()
+
+    def test_parting_the_current_room(self):
+        print('Testing part of the current room ...')
+        self.connect(b'alice')
+        self.say(b'alice', b'/join dev')
+        self.say(b'alice', b'/part dev')
+        self.say(b'alice', b'/part lobby')
+        self.received(b'alice')
+
+        self.say(b'alice', b'anyone?')
+        self.assertIn(b'not in a room', self.received(b'alice'))
+        print()
+
+
+class TestChatHistory(unittest.TestCase):
+
+    def test_ring_keeps_the_newest_messages(self):
+        print('Testing history ring ...')
+        history = MessageHistory(3)
+        self.assertEqual(history.replay(), b'')
+        for i in range(5):
+            history.append(b'%d;' % i)
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.replay(), b'2;3;4;')
+        # only the newest messages that fit
+        self.assertEqual(history.replay(5), b'3;4;')
+        self.assertEqual(history.replay(1), b'')
+        self.assertEqual(history.replay(newline=True), b'2;\n3;\n4;\n')
+        history.append(b'5\n')
+        self.assertEqual(history.replay(6, newline=True), b'4;\n5\n')
+        print()
+
+    def test_history_is_replayed_on_join(self):
+        print('Testing history replay ...')
+        server = ChatServer(port=0, history_size=2)
+        peers = []
+
+        def pump():
+            for _ in range(3):
+                server.run_once(timeout=0.05)
+
+        def connect(nickname):
+            peer = socket.create_connection((server.host, server.port))
+            peer.settimeout(2)
+            peers.append(peer)
+            peer.send(nickname)
+            pump()
+            return peer
+
+        try:
+            alice = connect(b'alice')
+            for text in (b'one', b'two', b'three'):
+                alice.send(text)
+                pump()
+            bob = connect(b'bob')
+            self.assertEqual(bob.recv(1024), b'alice: two\nalice: three\n')
+        finally:
+            for peer in peers:
+                peer.close()
+            server.close()
+        print()
+
+    def test_replay_stays_under_the_high_water_mark(self):
+        print('Testing history replay limit ...')
+        server = ChatServer(port=0, history_size=10, high_water_mark=64)
+        try:
+            for text in (b'one', b'two', b'three'):
+                server.remember(DEFAULT_ROOM, b'alice: ' + text * 3)
+            peer = socket.create_connection((server.host, server.port))
+            with peer:
+                peer.settimeout(2)
+                peer.send(b'bob')
+                for _ in range(3):
+                    server.run_once(timeout=0.05)
+                # half of the 64 byte mark holds the newest message only
+                self.assertEqual(peer.recv(1024), b'alice: threethreethree\n')
+                self.assertEqual(len(server.clients), 1)
+        finally:
+            server.close()
+        print()
+
+    def test_segment_log_survives_a_restart(self):
+        print('Testing history log ...')
+        with tempfile.TemporaryDirectory() as directory:
+            log = SegmentLog(directory, framed=True, segment_size=64, max_segments=2)
+            for i in range(10):
+                log.append(b'lobby', encode_frame(b'message %d' % i))
+            log.close()
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+            # a record torn by a crash is ignored
+            with open(os.path.join(directory, log.segments[-1]), 'ab') as f:
+                f.write(LOG_RECORD.pack(5, 100) + b'lob')
+
+            server = ChatServer(port=0, framed=True, history_size=3, history_log=directory)
+            try:
+                self.assertEqual(server.history[b'lobby'].replay(),
+                                 b''.join(encode_frame(b'message %d' % i) for i in (7, 8, 9)))
+            finally:
+                server.close()
+
+            # the same segments are ignored by an unframed server
+            server = ChatServer(port=0, history_log=directory)
+            try:
+                self.assertEqual(server.history, {})
+            finally:
+                server.close()
+        print()
+
+
+class TestFrameDecoder(unittest.TestCase):
+
+    def test_coalesced_frames_are_split(self):
+        print('Testing coalesced frames ...')
+        decoder = FrameDecoder()
+        decoder.feed(encode_frame(b'alice') + encode_frame(b'hello') + encode_frame(b''))
+        self.assertEqual([bytes(frame) for frame in decoder.frames()], [b'alice', b'hello', b''])
+        self.assertEqual(len(decoder), 0)
+        print()
+
+    def test_split_frame_waits_for_the_rest(self):
+        print('Testing split frame ...')
+        decoder = FrameDecoder()
+        data = encode_frame(b'hello world')
+        for i in range(len(data) - 1):
+            decoder.feed(data[i:i + 1])
+            self.assertEqual(list(decoder.frames()), [])
+        decoder.feed(data[-1:])
+        self.assertEqual([bytes(frame) for frame in decoder.frames()], [b'hello world'])
+        print()
+
+    def test_buffer_is_reused_across_reads(self):
+        print('Testing frame buffer reuse ...')
+        decoder = FrameDecoder(max_frame_size=16, buffer_size=32)
+        received = []
+        for i in range(100):
+            decoder.feed(encode_frame(b'message %02d' % i))
+            received.extend(bytes(frame) for frame in decoder.frames())
+        self.assertEqual(received, [b'message %02d' % i for i in range(100)])
+        print()
+
+    def test_oversized_frame_is_rejected(self):
+        print('Testing oversized frame ...')
+        decoder = FrameDecoder(max_frame_size=8)
+        decoder.feed(FRAME_HEADER.pack(9))
+        with self.assertRaises(ValueError):
+            list(decoder.frames())
+        print()
+
+    def test_framed_server_round_trip(self):
+        print('Testing framed server ...')
+        server = ChatServer(port=0, framed=True)
+        alice = socket.create_connection((server.host, server.port))
+        bob = socket.create_connection((server.host, server.port))
+        try:
+            for peer in (alice, bob):
+                peer.settimeout(2)
+            # handshake and two messages in a single segment from alice
+            bob.sendall(encode_frame(b'bob'))
+            server.run_once(timeout=0.05)
+            server.run_once(timeout=0.05)
+            alice.sendall(encode_frame(b'alice') + encode_frame(b'one') + encode_frame(b'two'))
+            for _ in range(3):
+                server.run_once(timeout=0.05)
+
+            decoder = FrameDecoder()
+            frames = []
+            while len(frames) < 2:
+                decoder.recv_from(bob)
+                frames.extend(bytes(frame) for frame in decoder.frames())
+            self.assertEqual(frames, [b'alice: one', b'alice: two'])
+        finally:
+            alice.close()
+            bob.close()
+            server.close()
+        print()
+
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT') and hasattr(os, 'fork'), 'needs SO_REUSEPORT and fork()')
+class TestShardedChatServer(unittest.TestCase):
+
+    def test_broadcast_reaches_every_shard(self):
+        print('Testing sharded broadcast ...')
+        pids, port = start_shards(2, port=0, framed=True)
+        peers = []
+        try:
+            for i in range(8):
+                peer = socket.create_connection((HOST, port))
+                peer.settimeout(5)
+                # the join notice confirms the worker has registered the client
+                peer.sendall(encode_frame(b'user%d' % i) + encode_frame(b'/join lobby'))
+                self.assertEqual(self.read_frames(peer, 1), [b'* joined lobby'])
+                peers.append(peer)
+
+            peers[0].sendall(encode_frame(b'hello'))
+            for peer in peers[1:]:
+                self.assertEqual(self.read_frames(peer, 1), [b'user0: hello'])
+        finally:
+            for peer in peers:
+                peer.close()
+            stop_shards(pids)
+        print()
+
+    def read_frames(self, peer, count):
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < count:
+            self.assertTrue(decoder.recv_from(peer))
+            frames.extend(bytes(frame) for frame in decoder.frames())
+        return frames
+
+    def test_bus_relays_between_shards(self):
+        print('Testing shard bus ...')
+        # two shards in this process, linked by a single socketpair
+        first, second = ShardBus(1), ShardBus(1)
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        first.links[a] = BusLink(a, first.high_water_mark, ShardBus.MAX_MESSAGE)
+        second.links[b] = BusLink(b, second.high_water_mark, ShardBus.MAX_MESSAGE)
+        first_selector, second_selector = selectors.DefaultSelector(), selectors.DefaultSelector()
+        try:
+            first.register(first_selector)
+            second.register(second_selector)
+            first.publish(b'dev', b'alice: hi', first_selector)
+            first.publish(b'dev', b'alice: again', first_selector)
+
+            relayed = []
+            for key, mask in second_selector.select(1):
+                relayed.extend(second.handle(key.fileobj, mask, second_selector))
+            self.assertEqual([(room, bytes(message)) for room, message in relayed],
+                             [(b'dev', b'alice: hi'), (b'dev', b'alice: again')])
+            self.assertEqual((first.published, second.delivered, first.dropped), (2, 2, 0))
+        finally:
+            first.close()
+            second.close()
+            first_selector.close()
+            second_selector.close()
+        print()
+
+    def test_broken_bus_link_is_dropped(self):
+        print('Testing broken shard bus links ...')
+        bus = ShardBus(1)
+        selector = selectors.DefaultSelector()
+        try:
+            # a frame longer than any shard sends, then a peer that went away
+            for peer_sends in (FRAME_HEADER.pack(ShardBus.MAX_MESSAGE + 1), None):
+                a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+                bus.links[a] = BusLink(a, bus.high_water_mark, ShardBus.MAX_MESSAGE)
+                selector.register(a, selectors.EVENT_READ, bus)
+                if peer_sends is not None:
+                    b.sendall(peer_sends)
+                    mask = selectors.EVENT_READ
+                else:
+                    bus.links[a].outbox.write(b'queued')
+                    mask = selectors.EVENT_WRITE
+                b.close()
+                with patch('builtins.print') as mock_print:
+                    self.assertEqual(bus.handle(a, mask, selector), [])
+                self.assertTrue(mock_print.call_args[0][0].startswith('Dropping shard bus link: '))
+                self.assertEqual((bus.links, a.fileno()), ({}, -1))
+                self.assertEqual(len(selector.get_map()), 0)
+            # publishing to a peer that went away drops the link as well
+            a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            bus.links[a] = BusLink(a, bus.high_water_mark, ShardBus.MAX_MESSAGE)
+            selector.register(a, selectors.EVENT_READ, bus)
+            b.close()
+            with patch('builtins.print'):
+                bus.publish(b'dev', b'alice: hi', selector)
+            self.assertEqual((bus.links, bus.published), ({}, 0))
+        finally:
+            bus.close()
+            selector.close()
+        print()
+
+
+class TestOutboundBuffer(unittest.TestCase):
+
+    def test_skip_bytes(self):
+        print('Testing skip_bytes ...')
+        parts = (b'abc', b'de', b'fgh')
+        self.assertEqual([bytes(part) for part in skip_bytes(parts, 0)], [b'abc', b'de', b'fgh'])
+        self.assertEqual([bytes(part) for part in skip_bytes(parts, 4)], [b'e', b'fgh'])
+        self.assertEqual([bytes(part) for part in skip_bytes(parts, 5)], [b'fgh'])
+        print()
+
+    def test_write_respects_limit(self):
+        print('Testing outbound buffer limit ...')
+        outbox = OutboundBuffer(limit=10)
+        self.assertTrue(outbox.write(b'12345678'))
+        self.assertFalse(outbox.write(b'abc'))
+        self.assertEqual(len(outbox), 8)
+        print()
+
+    def test_wrapped_data_is_sent_in_order(self):
+        print('Testing outbound buffer wrap around ...')
+        a, b = socket.socketpair()
+        try:
+            outbox = OutboundBuffer(limit=OutboundBuffer.INITIAL_CAPACITY)
+            outbox.write(b'a' * 3000)
+            # consume the first 2000 bytes so the next write wraps around
+            outbox._head, outbox._size = 2000, 1000
+            outbox.write(b'b' * 2000)
+            self.assertEqual(outbox.capacity, OutboundBuffer.INITIAL_CAPACITY)
+
+            sent = outbox.send_to(a)
+            self.assertEqual(sent, 3000)
+            self.assertEqual(len(outbox), 0)
+            b.settimeout(2)
+            received = b''
+            while len(received) < 3000:
+                received += b.recv(4096)
+            self.assertEqual(received, b'a' * 1000 + b'b' * 2000)
+        finally:
+            a.close()
+            b.close()
+        print()
+
+
 if __name__ == "__main__":
-    # uncomment this to test the communication between server and client on your local computer
-    # start_server()
+    # python simple-groupd-chat-server.py epoll       -> selectors/epoll based server
+    # python simple-groupd-chat-server.py framed      -> same, with length-prefixed messages
+    # python simple-groupd-chat-server.py shards [N]  -> N framed SO_REUSEPORT worker processes
+    # python simple-groupd-chat-server.py stats       -> start_server() with stats on PORT + 1
+    # python simple-groupd-chat-server.py bench       -> wakeup cost per connection count
+    if len(sys.argv) == 2 and sys.argv[1] == 'epoll':
+        ChatServer().serve_forever()
+    elif len(sys.argv) == 2 and sys.argv[1] == 'framed':
+        ChatServer(framed=True).serve_forever()
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == 'shards':
+        serve_sharded(int(sys.argv[2]) if len(sys.argv) == 3 else None, framed=True)
+    elif len(sys.argv) == 2 and sys.argv[1] == 'stats':
+        start_server(LoopStats(port=PORT + 1))
+    elif len(sys.argv) == 2 and sys.argv[1] == 'bench':
+        benchmark_wakeup()
+    else:
+        # uncomment this to test the communication between server and client on your local computer
+        # start_server()
 
-    # uncomment this before submitting to domjudge
-    runner = unittest.TextTestRunner(stream=NullWriter())
-    unittest.main(testRunner=runner, exit=False)
+        # uncomment this before submitting to domjudge
+        runner = unittest.TextTestRunner(stream=NullWriter())
+        unittest.main(testRunner=runner, exit=False)
@@ -3,9 +3,27 @@ from unittest import mock
 from io import StringIO
 import socket
 import select
+import time
 import sys
 import os
 
+# the deadline heap and the connection limit are shared with the other
+# servers, they live in common/ at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.connections import MAX_CONNECTIONS, Deadlines, run_select_loop, turn_away
+
+
+# seconds from the first byte of a command line to its CRLF
+COMMAND_TIMEOUT = 30
+# an idle control connection, between commands, is closed after this
+IDLE_TIMEOUT = 300
+# bytes a command may take before the client is told so and closed
+MAX_REQUEST_SIZE = 4096
+TIMED_OUT = b'421 Timeout, closing control connection\r\n'
+TOO_MANY = b'421 Too many connections, try again later\r\n'
+TOO_LONG = b'500 Command too long, closing control connection\r\n'
+NOT_UTF8 = b'501 Command is not UTF-8\r\n'
+
 
 class FTPServer:
     def __init__(self, host="127.0.0.1", port=2000):
@@ -21,17 +39,21 @@ class FTPServer:
         self.sock.setblocking(False)
         self.inputs = [self.sock]
         self.client_data = {}
+        self.deadlines = Deadlines()
 
         print(f"Listening on {self.host}:{self.port}")
 
     def start(self):
         while True:
-            readable, _, _ = select.select(self.inputs, [], [])
+            readable, _, _ = select.select(self.inputs, [], [], self.deadlines.timeout(time.monotonic()))
             for s in readable:
                 if s is self.sock:
                     # accept client
                     client_sock, client_addr = self.sock.accept()
                     client_sock.setblocking(False)
+                    if len(self.client_data) >= MAX_CONNECTIONS:
+                        turn_away(client_sock, TOO_MANY)
+                        continue
 
                     # append to inputs
                     self.inputs.append(client_sock)
@@ -44,26 +66,40 @@ class FTPServer:
 
                     # send welcome message
                     client_sock.sendall(b'220 Welcome to the FTP server\r\n')
+                    self.deadlines.set(client_sock, time.monotonic() + IDLE_TIMEOUT)
                 else:
                     # receive data
-                    data = s.recv(1024)
+                    try:
+                        data = s.recv(1024)
+                    except OSError:
+                        data = b''
                     if data:
+                        started = not self.client_data[s]
                         self.client_data[s] += data
                         if b'\r\n' in self.client_data[s]:
                             self.handle_client(s)
+                            if s in self.client_data:
+                                self.deadlines.set(s, time.monotonic() + IDLE_TIMEOUT)
+                        elif len(self.client_data[s]) > MAX_REQUEST_SIZE:
+                            self.close_client(s, TOO_LONG)
+                        elif started:
+                            # the rest of the command does not move this
+                            self.deadlines.set(s, time.monotonic() + COMMAND_TIMEOUT)
                     else:
-                        # remove socket from inputs
-                        self.inputs.remove(s)
-                        # delete from client_data dict
-                        del self.client_data[s]
+                        self.close_client(s)
 
-                        # close socket
-                        s.close()
+            for s in self.deadlines.expired(time.monotonic()):
+                self.close_client(s, TIMED_OUT)
 
     def handle_client(self, client_sock):
         # decode data and don't forget to strip
-        data = self.client_data[client_sock].decode('utf-8').strip()
+        data = self.client_data[client_sock]
         self.client_data[client_sock] = b''
+        try:
+            data = data.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            client_sock.sendall(NOT_UTF8)
+            return
         print(f"Received command: {data}")
 
         # use startswith to fill in the blanks
@@ -85,15 +121,20 @@ class FTPServer:
         elif data.upper().startswith('QUIT'):
             # send goodbye message
             client_sock.sendall(b'221 Goodbye\r\n')
-            # remove socket from inputs
-            self.inputs.remove(client_sock)
-            # delete from client_data dict
-            del self.client_data[client_sock]
-            # close socket
-            client_sock.close()
+            self.close_client(client_sock)
         else:
             client_sock.sendall(b'502 Command not implemented\r\n')
 
+    def close_client(self, client_sock, message=None):
+        """Forget a client and close it, after a last reply if there is one."""
+        self.inputs.remove(client_sock)
+        del self.client_data[client_sock]
+        self.deadlines.discard(client_sock)
+        if message is not None:
+            turn_away(client_sock, message)
+        else:
+            client_sock.close()
+
 
 # A 'null' stream that discards anything written to it
 class NullWriter(StringIO):
@@ -142,6 +183,65 @@ class TestFTPServer(unittest.TestCase):
         self.server.handle_client(client_sock)
         client_sock.sendall.assert_called_with(b'502 Command not implemented\r\n')
 
+    def test_handle_client_not_utf8(self):
+        client_sock = mock.Mock()
+        self.server.client_data = {client_sock: b'MKD \xff\xfe\r\n'}
+        self.server.handle_client(client_sock)
+        client_sock.sendall.assert_called_with(NOT_UTF8)
+        client_sock.close.assert_not_called()
+        self.assertEqual(self.server.client_data[client_sock], b'')
+
+    def connect(self, *socks):
+        """Register mock clients as if they had just connected at time 0."""
+        for sock in socks:
+            self.server.inputs.append(sock)
+            self.server.client_data[sock] = b''
+            self.server.deadlines.set(sock, IDLE_TIMEOUT)
+
+    def test_timeouts(self):
+        idle, slow = mock.Mock(), mock.Mock()
+        # a command line without its CRLF, started at 1 and still open at 20
+        slow.recv.side_effect = [b'MK', b'D slow_dir']
+        self.connect(idle, slow)
+        steps = [(1, [slow]), (20, [slow]), (1 + COMMAND_TIMEOUT, []), (IDLE_TIMEOUT, [])]
+        timeouts = run_select_loop(self.server.start, steps)
+        self.assertEqual(timeouts, [IDLE_TIMEOUT, COMMAND_TIMEOUT, COMMAND_TIMEOUT - 19,
+                                    IDLE_TIMEOUT - 1 - COMMAND_TIMEOUT, None])
+        for sock in (idle, slow):
+            sock.send.assert_called_once_with(TIMED_OUT)
+            sock.sendall.assert_not_called()
+        self.assertEqual(self.server.inputs, [self.server.sock])
+        self.assertEqual(self.server.client_data, {})
+
+    def test_command_too_long(self):
+        client_sock = mock.Mock()
+        reads = [b'MKD ' + b'a' * 1020] * (MAX_REQUEST_SIZE // 1024 + 1)
+        client_sock.recv.side_effect = reads
+        self.connect(client_sock)
+        run_select_loop(self.server.start, [(0, [client_sock])] * len(reads))
+        client_sock.send.assert_called_once_with(TOO_LONG)
+        client_sock.sendall.assert_not_called()
+        client_sock.close.assert_called_once()
+        self.assertEqual(self.server.inputs, [self.server.sock])
+        self.assertEqual(self.server.client_data, {})
+
+    def test_too_many_connections(self):
+        listener = mock.Mock()
+        client_sock = mock.Mock()
+        listener.accept.return_value = (client_sock, ('127.0.0.1', 54321))
+        real_sock, self.server.sock = self.server.sock, listener
+        self.server.inputs = [listener]
+        try:
+            with mock.patch.dict(globals(), MAX_CONNECTIONS=0):
+                run_select_loop(self.server.start, [(0, [listener])])
+        finally:
+            self.server.sock = real_sock
+        client_sock.send.assert_called_once_with(TOO_MANY)
+        client_sock.close.assert_called_once()
+        # no 220 welcome for a client that is turned away
+        client_sock.sendall.assert_not_called()
+        self.assertEqual(self.server.inputs, [listener])
+
 if __name__ == "__main__":
     if len(sys.argv) == 2 and sys.argv[1] == 'run':
         ftp_server = FTPServer()